@@ -23,6 +23,12 @@ def estimate_sharpness(filepath,fs=None):
             im = Image.open(f).convert('L') # to grayscale
 
     array = np.asarray(im, dtype=np.int32)
+    return sharpness_contrast(array)
+
+def sharpness_contrast(array):
+    """
+    Sharpness (mean gradient magnitude) and contrast (standard deviation) of a grayscale image array
+    """
     contrast = array.std()
     gy, gx = np.gradient(array)
     gnorm = np.sqrt(gx**2 + gy**2)
@@ -44,10 +50,40 @@ def average_color(filepath,fs=None):
         with open(filepath, 'rb') as f:
             img = io.imread(f)
             
+    return image_average_color(img)
+
+def image_average_color(img):
+    """
+    Average r, g, b values and their average for an image array
+    """
     av = img.mean(axis=0).mean(axis=0)
     avall = av.mean(axis=0)
     return av, avall
 
+def image_quality(img, step=4):
+    """
+    Cheap image quality score used to weight cameras when blending, from the same metrics
+    as estimate_sharpness and average_color, computed on an image array that is already decoded.
+    Fogged, water-spotted or badly exposed frames score lower than clean ones.
+    Input:
+        img - image array (rows, columns[, colors])
+        step - decimation applied before computing the metrics
+    Returned:
+        score, sharpness, contrast, avall
+    """
+    sub = np.asarray(img)[::step, ::step]
+    if sub.ndim == 3:
+        # same luma weights PIL uses for convert('L')
+        gray = sub[:, :, :3] @ np.array([0.299, 0.587, 0.114])
+    else:
+        gray = sub.astype(np.float64)
+    sharpness, contrast = sharpness_contrast(gray)
+    av, avall = image_average_color(sub)
+    # frames that are nearly black or blown out carry little information
+    exposure = np.clip(min(avall, 255. - avall)/32., 0., 1.)
+    score = np.sqrt(sharpness*contrast)*exposure
+    return score, sharpness, contrast, avall
+
 def detect_blur_fft(filepath, size=60, vis=False, fs=None):
     """
     Use high-frequency content of image fft to determine blur
@@ -226,6 +262,8 @@ def local_transform_points( xo, yo, ang, flag, xin, yin):
         yout - Local (Y) or Geo (N) coord depending on transformation direction
     """
 
+    cos_ang = np.cos(ang)
+    sin_ang = np.sin(ang)
     if flag == 1:
         # transform from world -> local
         # translate from origin
@@ -233,19 +271,98 @@ def local_transform_points( xo, yo, ang, flag, xin, yin):
         norp = yin-yo
 
         #rotate
-        xout = easp*np.cos(ang)+norp*np.sin(ang)
-        yout = norp*np.cos(ang)-easp*np.sin(ang)
+        xout = easp*cos_ang+norp*sin_ang
+        yout = norp*cos_ang-easp*sin_ang
 
     if flag == 0:
         # rotate
-        xout = xin*np.cos(ang)-yin*np.sin(ang)
-        yout = yin*np.cos(ang)+xin*np.sin(ang)
+        xout = xin*cos_ang-yin*sin_ang
+        yout = yin*cos_ang+xin*sin_ang
         # translate
         xout = xout+xo
         yout = yout+yo
 
     return xout, yout
 
+class LocalTransform(object):
+    """Local <-> Geographical transform of local_transform_points with the rotation precomputed,
+    for large point clouds.
+    Notes:
+        - transform works in place on an (n, >=2) float64 buffer (x, y in the first two columns,
+          other columns such as z are untouched), a chunk of rows at a time, so the only extra
+          memory is two chunk-sized temporaries however many points there are.
+        - Same results as local_transform_points with the same xo, yo and ang.
+    Args:
+        xo, yo (float): location of the local origin (0,0) in Geographical coordinates
+        ang (float): angle of the local X axis, counter-clockwise from the Geo X, in radians
+        chunk (int): rows transformed at a time
+    """
+    def __init__(self, xo, yo, ang, chunk=262144):
+        self.xo = float(xo)
+        self.yo = float(yo)
+        self.ang = float(ang)
+        self.cos = np.cos(self.ang)
+        self.sin = np.sin(self.ang)
+        self.chunk = chunk
+        self._a = np.empty(chunk)
+        self._b = np.empty(chunk)
+
+    @classmethod
+    def from_local_origin(cls, local_origin, chunk=262144):
+        """Make the transform of a local origin dict (x, y and angd in degrees)"""
+        return cls(local_origin['x'], local_origin['y'], np.deg2rad(local_origin['angd']), chunk)
+
+    def transform(self, points, flag, out=None):
+        """Transform points between Geographical and local coordinates
+        Arguments:
+            points (np.ndarray): (n, >=2) float64 array with x, y in the first two columns
+            flag (int): Geo-->local (1) or local-->Geo (0), as in local_transform_points
+            out (np.ndarray): array to write to, same shape as points. Pass points itself to
+                transform in place. Default a new array.
+        Returns:
+            out (np.ndarray)
+        """
+        if out is None:
+            out = np.array(points, dtype=np.float64)
+        elif out is not points:
+            out[...] = points
+        c = self.cos
+        s = self.sin if flag == 1 else -self.sin
+        for start in range(0, len(out), self.chunk):
+            x = out[start:start + self.chunk, 0]
+            y = out[start:start + self.chunk, 1]
+            a = self._a[:len(x)]
+            b = self._b[:len(x)]
+            if flag == 1:
+                x -= self.xo
+                y -= self.yo
+            # x' = x cos + y sin, y' = y cos - x sin (with -sin for local-->Geo)
+            np.multiply(x, c, out=a)
+            np.multiply(y, s, out=b)
+            a += b
+            np.multiply(y, c, out=b)
+            x *= s
+            b -= x
+            x[...] = a
+            y[...] = b
+            if flag == 0:
+                x += self.xo
+                y += self.yo
+        return out
+
+    def to_local(self, points, out=None):
+        """Geo-->local (see transform)"""
+        return self.transform(points, 1, out)
+
+    def to_geo(self, points, out=None):
+        """local-->Geo (see transform)"""
+        return self.transform(points, 0, out)
+
+    def stream(self, chunks, flag):
+        """Transform each chunk of a point stream in place and yield it (see point_cloud)"""
+        for points in chunks:
+            yield self.transform(points, flag, out=points)
+
 def local_transform_extrinsics(local_xo,local_yo,local_angd,flag,extrinsics_in):
     """
     Tranforms between Local World Coordinates and Geographical
@@ -278,7 +395,7 @@ def local_transform_extrinsics(local_xo,local_yo,local_angd,flag,extrinsics_in):
 
     if flag == 0:
         # local to world
-        extrinsics_out['x'], extrinsics_out['y'] = local_transform_points(local_xo,local_yo,local_ang,0,extrinsics_in['x'],extrinsics_in['y'])
+        extrinsics_out['x'], extrinsics_out['y'] = local_transform_points(local_xo,local_yo,local_angr,0,extrinsics_in['x'],extrinsics_in['y'])
         extrinsics_out['a'] = extrinsics_in['a']-local_angr
 
     return extrinsics_out
@@ -310,7 +427,7 @@ def assembleP(extrinsics, intrinsics):
     # I: identity matrix augmented by camera center, puts image in camera coordinates
     IC = np.vstack((
         np.eye(3),
-        -extrinsics['x'],-extrinsics['y'],-extrinsics['z']
+        -np.array([extrinsics['x'], extrinsics['y'], extrinsics['z']])
         )).T
     KR = np.matmul(K, R)
     P = np.matmul(KR, IC)
@@ -352,3 +469,145 @@ def angle2R(azimuth, tilt, swing):
     R[2, 2] = -np.cos(t)
 
     return R
+
+def angle2R_batch(azimuth, tilt, swing):
+    """Assembles rotation matrices for arrays of azimuth, tilt, and swing (roll)
+    Notes:
+        - Same matrix as angle2R, for any number of poses in one vectorized computation
+    Arguments:
+        azimuth, tilt, swing (np.ndarray): angles in radians, broadcastable to (n,)
+    Returns:
+        R (np.ndarray): (n, 3, 3) rotation matrices
+    """
+    a, t, s = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v, dtype=np.float64)) for v in (azimuth, tilt, swing)))
+    ca, sa = np.cos(a), np.sin(a)
+    ct, st = np.cos(t), np.sin(t)
+    cs, ss = np.cos(s), np.sin(s)
+    R = np.empty(a.shape + (3, 3))
+
+    R[..., 0, 0] = ca*cs + sa*ct*ss
+    R[..., 0, 1] = -cs*sa + ss*ct*ca
+    R[..., 0, 2] = ss*st
+
+    R[..., 1, 0] = -ss*ca + cs*ct*sa
+    R[..., 1, 1] = ss*sa + cs*ct*ca
+    R[..., 1, 2] = cs*st
+
+    R[..., 2, 0] = st*sa
+    R[..., 2, 1] = st*ca
+    R[..., 2, 2] = -ct
+
+    return R
+
+def assembleP_batch(xyz, angles, intrinsics):
+    """Assembles Projective (P) matrices for arrays of camera poses
+    Notes:
+        - Same matrices as assembleP, for any number of poses in one vectorized computation
+        - intrinsics values may be scalars (one lens) or (n,) arrays (one per pose)
+    Arguments:
+        xyz (np.ndarray): (n, 3) camera positions
+        angles (np.ndarray): (n, 3) azimuth, tilt and roll in radians
+        intrinsics (dict): lens calibration profile
+    Returns:
+        P (np.ndarray): (n, 3, 4) projective matrices, normalized so P[:, 2, 3] = 1
+        R (np.ndarray): (n, 3, 3) rotation matrices
+    """
+    xyz = np.atleast_2d(np.asarray(xyz, dtype=np.float64))
+    angles = np.atleast_2d(np.asarray(angles, dtype=np.float64))
+    R = angle2R_batch(angles[:, 0], angles[:, 1], angles[:, 2])
+    n = len(R)
+    # K: intrinsic matrix for every pose
+    K = np.zeros((n, 3, 3))
+    K[:, 0, 0] = intrinsics['fx']
+    K[:, 0, 2] = intrinsics['c0U']
+    K[:, 1, 1] = -np.asarray(intrinsics['fy'])
+    K[:, 1, 2] = intrinsics['c0V']
+    K[:, 2, 2] = 1.
+    KR = np.matmul(K, R)
+    # [KR | -KR C]
+    P = np.concatenate((KR, -np.matmul(KR, np.broadcast_to(xyz, (n, 3))[:, :, np.newaxis])), axis=2)
+    P = P/P[:, 2:3, 3:4]
+    return P, R
+
+def lcp_distort(lcp, x, y, jacobian=False):
+    """Applies the lcp radial and tangential distortion to normalized image coordinates.
+    Notes:
+        - Same model as the distortion in the forward projection (x = (u - c0U)/fx, y = (v - c0V)/fy)
+        - The analytic Jacobian is what undistort_UV needs for its Newton steps
+    Arguments:
+        lcp (dict): Lens Calibration Profile (intrinsics)
+        x, y (np.ndarray): undistorted normalized coordinates
+        jacobian (bool): also return the partial derivatives of xd, yd with respect to x, y
+    Returns:
+        xd, yd (np.ndarray): distorted normalized coordinates
+        (dxd_dx, dxd_dy, dyd_dx, dyd_dy) (tuple): if jacobian
+    """
+    d1, d2, d3, t1, t2 = lcp['d1'], lcp['d2'], lcp['d3'], lcp['t1'], lcp['t2']
+    r2 = x*x + y*y
+    fr = 1. + r2*(d1 + r2*(d2 + r2*d3))
+    xd = x*fr + 2.*t1*x*y + t2*(r2 + 2.*x*x)
+    yd = y*fr + t1*(r2 + 2.*y*y) + 2.*t2*x*y
+    if not jacobian:
+        return xd, yd
+    # d(fr)/d(r2)
+    dfr = d1 + r2*(2.*d2 + 3.*d3*r2)
+    cross = 2.*x*y*dfr
+    dxd_dx = fr + 2.*x*x*dfr + 2.*t1*y + 6.*t2*x
+    dxd_dy = cross + 2.*t1*x + 2.*t2*y
+    dyd_dx = cross + 2.*t1*x + 2.*t2*y
+    dyd_dy = fr + 2.*y*y*dfr + 6.*t1*y + 2.*t2*x
+    return xd, yd, (dxd_dx, dxd_dy, dyd_dx, dyd_dy)
+
+def _undistort_normalized(lcp, xd, yd, niter, tol):
+    """Newton iteration for undistort_UV on one chunk of normalized coordinates"""
+    x = xd.copy()
+    y = yd.copy()
+    active = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    for _ in range(niter):
+        if len(active) == 0:
+            break
+        # plain slices while every point is still iterating avoid the cost of fancy indexing
+        sel = slice(None) if len(active) == len(x) else active
+        xa = x[sel]
+        ya = y[sel]
+        fx, fy, (a, b, c, d) = lcp_distort(lcp, xa, ya, jacobian=True)
+        rx = fx - xd[sel]
+        ry = fy - yd[sel]
+        det = a*d - b*c
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x[sel] = xa - (d*rx - b*ry)/det
+            y[sel] = ya - (a*ry - c*rx)/det
+        active = active[(np.abs(rx) > tol) | (np.abs(ry) > tol)]
+    # anything still moving after niter steps did not converge
+    x[active] = np.nan
+    y[active] = np.nan
+    return x, y
+
+def undistort_UV(lcp, Ud, Vd, niter=20, tol=1e-10, chunk=65536):
+    """Removes the lcp lens distortion from distorted pixel coordinates.
+    Notes:
+        - Inverts lcp_distort by Newton iteration with its analytic 2x2 Jacobian, starting
+          from the distorted coordinates. Points are iterated together in chunks small enough
+          to stay in cache, and only the ones that have not converged are updated, so it
+          handles millions of points per second.
+        - Points that do not converge (far outside the range the model was fitted for)
+          are returned as NaN.
+    Arguments:
+        lcp (dict): Lens Calibration Profile (intrinsics)
+        Ud, Vd (np.ndarray): distorted pixel coordinates, any matching shape
+        niter (int): maximum number of Newton steps
+        tol (float): convergence tolerance in normalized coordinates
+        chunk (int): number of points iterated together
+    Returns:
+        U, V (np.ndarray): undistorted pixel coordinates, same shape as Ud
+    """
+    shape = np.shape(Ud)
+    xd = (np.ravel(Ud).astype(np.float64) - lcp['c0U']) / lcp['fx']
+    yd = (np.ravel(Vd).astype(np.float64) - lcp['c0V']) / lcp['fy']
+    U = np.empty_like(xd)
+    V = np.empty_like(yd)
+    for i in range(0, len(xd), chunk):
+        x, y = _undistort_normalized(lcp, xd[i:i + chunk], yd[i:i + chunk], niter, tol)
+        U[i:i + chunk] = x*lcp['fx'] + lcp['c0U']
+        V[i:i + chunk] = y*lcp['fy'] + lcp['c0V']
+    return U.reshape(shape), V.reshape(shape)
@@ -18,10 +18,12 @@ import calendar
 import datetime
 from dateutil import tz
 import sys
+import hashlib
 
 from coastcam_funcs import *
 from calibration_crs import *
 from rectifier_crs import *
+from station_bundle import parse_bundle, bundle_lists
 
 ###### FUNCTIONS ######
 def unix2datetime(unixnumber):
@@ -217,6 +219,35 @@ print('Loading function')
 s3 = boto3.client('s3')
 s3_resource = boto3.resource('s3')
 
+#fill the area of a camera that misses a timestamp from its last rectified frame, if it is no older than CACHE_MAX_AGE seconds
+FILL_FROM_CACHE = True
+CACHE_MAX_AGE = 3600
+
+#upload each camera's rectified view, cropped to its footprint, next to the merge
+UPLOAD_CAMERA_TILES = True
+
+#image types merged for every timestamp. They share each camera's lookup tables and weights (from the timex)
+MERGE_PRODUCTS = ['timex', 'var', 'bright', 'dark', 'snap']
+
+#upload the ground resolution of the merge (metres per pixel along x and y) once per set of calibrations
+UPLOAD_RESOLUTION_MAP = True
+
+#upload the positional uncertainty of the merge (metres, from CALIBRATION_SIGMAS) once per set of calibrations
+UPLOAD_UNCERTAINTY_MAP = True
+
+#1-sigma calibration errors used for the uncertainty map: metres for x, y, z and radians for azimuth, tilt and roll
+CALIBRATION_SIGMAS = {'x': 0.05, 'y': 0.05, 'z': 0.05, 'a': 0.001, 't': 0.001, 'r': 0.001}
+
+#rectifiers kept between invocations of a warm Lambda container, so lookup tables are only built once
+RECTIFIERS = {}
+
+#correct each frame for camera motion (wind, thermal) measured against the camera's reference image, if it has one
+STABILIZE_FRAMES = True
+
+#(ETag, frame stabilizer) by reference image key, kept between invocations like the rectifiers.
+#The ETag is checked on every invocation, so a replaced or deleted reference image is picked up
+STABILIZERS = {}
+
 def lambda_handler(event='none', context='none'):
     '''
     This function is executed when the Lambda function is triggered on a new image upload.
@@ -265,8 +296,9 @@ def lambda_handler(event='none', context='none'):
     print('station:', station)
     
     try:
-        ###only want timex images merged###
-        if key_elements[-1].endswith('timex.jpg'):
+        ###only want the merged image types merged###
+        trigger_product = key_elements[-1].split('.')[-2]
+        if key_elements[-1].endswith('.jpg') and trigger_product in MERGE_PRODUCTS:
             #get list of cameras for station
             camera_list = []
             camera_prefix = 'cameras/' + station + '/'
@@ -294,65 +326,77 @@ def lambda_handler(event='none', context='none'):
                             station+"_localOrigin"]
               yaml_lists.append(file_names)
         
-            extrinsic_cal_files = []
-            intrinsic_cal_files = []
-            metadata_files = []
-            for file_list in yaml_lists:
-                extrinsic_cal_files.append(file_list[0] + '.yaml')
-                intrinsic_cal_files.append(file_list[1] + '.yaml')
-                metadata_files.append(file_list[2] + '.yaml')
+            #one station bundle (all cameras and the local origin in one JSON file) if there is one,
+            #otherwise the separate YAML files
+            bundle_key = 'cameras/parameters/' + station + '/' + station + '_bundle.json'
+            try:
+                bundle = parse_bundle(s3.get_object(Bucket=bucket, Key=bundle_key)['Body'].read())
+                metadata_list, intrinsics_list, extrinsics_list, local_origin = bundle_lists(bundle, [camera.camera_number for camera in cameras])
+                print(f'calibrations loaded from {bundle_key}')
+            except Exception as e:
+                print(f'no usable station bundle ({e}), loading YAML files')
+                bundle = None
+            
+            if bundle is None:
+                extrinsic_cal_files = []
+                intrinsic_cal_files = []
+                metadata_files = []
+                for file_list in yaml_lists:
+                    extrinsic_cal_files.append(file_list[0] + '.yaml')
+                    intrinsic_cal_files.append(file_list[1] + '.yaml')
+                    metadata_files.append(file_list[2] + '.yaml')
         
-            #YAML files are located in S3
-            #store YAML files in Lambda function /tmp directory while function executes
-            i = 0
-            for file in extrinsic_cal_files:
-                file_path = 'cameras/parameters/' + station + '/' + file
-                #!!! in AWS Lambda console use '/tmp/, but when working locally use './tmp/'
-                download_path = '/tmp/' + file
-                extrinsic_cal_files[i] = download_path
-                with open(download_path, 'wb') as yaml_file:
-                    s3.download_fileobj(bucket, file_path, yaml_file)
-                i = i + 1
+                #YAML files are located in S3
+                #store YAML files in Lambda function /tmp directory while function executes
+                i = 0
+                for file in extrinsic_cal_files:
+                    file_path = 'cameras/parameters/' + station + '/' + file
+                    #!!! in AWS Lambda console use '/tmp/, but when working locally use './tmp/'
+                    download_path = '/tmp/' + file
+                    extrinsic_cal_files[i] = download_path
+                    with open(download_path, 'wb') as yaml_file:
+                        s3.download_fileobj(bucket, file_path, yaml_file)
+                    i = i + 1
             
-            i = 0
-            for file in intrinsic_cal_files:
-                file_path = 'cameras/parameters/' + station + '/' + file
-                download_path = '/tmp/' + file
-                intrinsic_cal_files[i] = download_path
-                with open(download_path, 'wb') as yaml_file:
-                    s3.download_fileobj(bucket, file_path, yaml_file)
-                i = i + 1
+                i = 0
+                for file in intrinsic_cal_files:
+                    file_path = 'cameras/parameters/' + station + '/' + file
+                    download_path = '/tmp/' + file
+                    intrinsic_cal_files[i] = download_path
+                    with open(download_path, 'wb') as yaml_file:
+                        s3.download_fileobj(bucket, file_path, yaml_file)
+                    i = i + 1
                     
-            i = 0       
-            for file in metadata_files:
-                file_path = 'cameras/parameters/' + station + '/' + file
-                download_path = '/tmp/' + file
-                metadata_files[i] = download_path
+                i = 0       
+                for file in metadata_files:
+                    file_path = 'cameras/parameters/' + station + '/' + file
+                    download_path = '/tmp/' + file
+                    metadata_files[i] = download_path
+                    with open(download_path, 'wb') as yaml_file:
+                        s3.download_fileobj(bucket, file_path, yaml_file)
+                    i = i + 1
+            
+                #only 1 local origin file, don't need to do loop
+                file_path = 'cameras/parameters/' + station + '/' + file_names[3] + '.yaml'
+                download_path = '/tmp/' + file_names[3] + '.yaml'
                 with open(download_path, 'wb') as yaml_file:
                     s3.download_fileobj(bucket, file_path, yaml_file)
-                i = i + 1
-            
-            #only 1 local origin file, don't need to do loop
-            file_path = 'cameras/parameters/' + station + '/' + file_names[3] + '.yaml'
-            download_path = '/tmp/' + file_names[3] + '.yaml'
-            with open(download_path, 'wb') as yaml_file:
-                s3.download_fileobj(bucket, file_path, yaml_file)
             
-            #create YAML dictionaries
-            local_origin = yaml2dict(download_path)
-            metadata_list = []
-            intrinsics_list = []
-            extrinsics_list = []
-            for file in metadata_files:
-                metadata_list.append(yaml2dict(file))
-            extrinsics_list = []
-            for file in extrinsic_cal_files:
-                extrinsics_list.append( yaml2dict(file) )
-            intrinsics_list = []
-            for file in intrinsic_cal_files:
-                intrinsics_list.append( yaml2dict(file) )
+                #create YAML dictionaries
+                local_origin = yaml2dict(download_path)
+                metadata_list = []
+                intrinsics_list = []
+                extrinsics_list = []
+                for file in metadata_files:
+                    metadata_list.append(yaml2dict(file))
+                extrinsics_list = []
+                for file in extrinsic_cal_files:
+                    extrinsics_list.append( yaml2dict(file) )
+                intrinsics_list = []
+                for file in intrinsic_cal_files:
+                    intrinsics_list.append( yaml2dict(file) )
             
-            calibration = CameraCalibration(metadata_list[0],intrinsics_list[0],extrinsics_list[0],local_origin)
+            calibration = get_calibration(metadata_list[0],intrinsics_list[0],extrinsics_list[0],local_origin)
     
             xmin = -10
             xmax = 400
@@ -362,15 +406,17 @@ def lambda_handler(event='none', context='none'):
             dy = 1
             z =  0
             
-            rectifier_grid = TargetGrid(
-                [xmin, xmax],
-                [ymin, ymax],
-                dx,
-                dy,
-                z
-            )
-            
-            rectifier = Rectifier(rectifier_grid)
+            grid_key = (xmin, xmax, ymin, ymax, dx, dy, z)
+            if grid_key not in RECTIFIERS:
+                rectifier_grid = TargetGrid(
+                    [xmin, xmax],
+                    [ymin, ymax],
+                    dx,
+                    dy,
+                    z
+                )
+                RECTIFIERS[grid_key] = Rectifier(rectifier_grid)
+            rectifier = RECTIFIERS[grid_key]
             
             year = key_elements[3]
             day = key_elements[4]
@@ -394,63 +440,255 @@ def lambda_handler(event='none', context='none'):
             
             short_station = 'madbeach'
             
-            #keep track of which cameras have imagery for the given unix time
-            image_files_list = []
-            time_cam_list = []
-            for camera in cameras:
-                image_filepath = camera.filepath + '/' + year + '/' + day + '/raw/' + unix_time + '.' + day_of_week + '.' + month_formatted + '.' + filename_day + '_' + hour + '_' + minute + '_' + second + '.' + timezone + '.' + filename_year + '.' + short_station + '.' + camera.camera_number.lower() + '.timex.jpg'
-                print('image_filepath:', image_filepath)
+            merge_dir = 'cameras/' + station + '/cx/merge/' + str(year) + '/' + str(day) + '/'
+            
+            #each camera's unnormalised contribution to the merge of each product is kept in S3 per timestamp, so a
+            #camera that arrives later only rectifies its own images and adds them to the ones already there.
+            #The last digit of the unix time differs between products, so the timestamp ends in 0 here
+            merge_stamp = unix_time[:-1] + '0'
+            state_prefix = 'cameras/' + station + '/cx/merge_state/' + str(year) + '/' + str(day) + '/' + merge_stamp + '/'
+            trigger_camera = key_elements[2].upper()
+            cache_prefix = 'cameras/' + station + '/cx/merge_cache/'
+            merge_time = date_time_obj.timestamp()
+            
+            #cameras with a calibration history use the calibration valid at the image time, so reprocessing
+            #old imagery uses the geometry of the time. Without one (or outside its intervals) the current YAML is used
+            for c, camera in enumerate(cameras):
+                history_key = 'cameras/parameters/' + station + '/' + station + '_' + camera.camera_number + '_calibration_history.yaml'
+                history_path = '/tmp/' + station + '_' + camera.camera_number + '_calibration_history.yaml'
                 try:
-                    #if exists, download image to tmp folder
-                    s3.head_object(Bucket=bucket, Key=image_filepath)
+                    s3.head_object(Bucket=bucket, Key=history_key)
+                    with open(history_path, 'wb') as yaml_file:
+                        s3.download_fileobj(bucket, history_key, yaml_file)
+                except:
+                    continue
+                history = CalibrationHistory.from_yaml(history_path, metadata_list[c], local_origin, intrinsics_list[c])
+                calibration_at_time = history.lookup(merge_time)
+                if calibration_at_time is None:
+                    print(f'{camera.camera_number} calibration history has no interval at {unix_time}, using current calibration')
+                else:
+                    intrinsics_list[c], extrinsics_list[c] = calibration_at_time
+                    print(f'{camera.camera_number} calibration from history interval {history.interval(merge_time)}')
+            contributions = {product: [] for product in MERGE_PRODUCTS}
+            missing_cameras = {product: [] for product in MERGE_PRODUCTS}
+            product_times = {}
+            updated_products = []
+            for c, camera in enumerate(cameras):
+                cam = camera.camera_number.lower()
+                
+                #raw images of this camera at this timestamp, by product
+                raw_files = {}
+                raw_prefix = camera.filepath + '/' + year + '/' + day + '/raw/' + unix_time[:-1]
+                listing = s3.list_objects_v2(Bucket=bucket, Prefix=raw_prefix)
+                for obj in listing.get('Contents', []):
+                    raw_filename = getPathElements(obj['Key'])[-1]
+                    for product in MERGE_PRODUCTS:
+                        if raw_filename.endswith('.' + cam + '.' + product + '.jpg'):
+                            raw_files[product] = obj['Key']
+                            product_times.setdefault(product, unixFromFilename(raw_filename))
+                
+                #only the triggering image is always rectified. Every other camera/product reuses its saved
+                #contribution, and is only rectified (and its merge updated) if it has none yet
+                new_files = {}
+                for product in MERGE_PRODUCTS:
+                    state_key = state_prefix + cam + '.' + product + '.npz'
+                    state_path = '/tmp/' + merge_stamp + '.' + cam + '.' + product + '.npz'
+                    if camera.camera_number != trigger_camera or product != trigger_product:
+                        try:
+                            s3.head_object(Bucket=bucket, Key=state_key)
+                            with open(state_path, 'wb') as state_file:
+                                s3.download_fileobj(bucket, state_key, state_file)
+                            contributions[product].append(MergeAccumulator.load(state_path))
+                            print(f'{camera.camera_number} {product} merge state loaded from {state_key}')
+                            continue
+                        except:
+                            pass
                     
-                    download_path = '/tmp/' + unix_time + '.' + camera.camera_number.lower() + '.timex.jpg'
+                    if product not in raw_files:
+                        print(f'{camera.camera_number} does not have a {product} image at time {unix_time}')
+                        missing_cameras[product].append(camera)
+                        continue
+                    print('image_filepath:', raw_files[product])
+                    download_path = '/tmp/' + merge_stamp + '.' + cam + '.' + product + '.jpg'
                     with open(download_path, 'wb') as img_file:
-                        s3.download_fileobj(bucket, image_filepath, img_file)
-                        
-                    image_files_list.append(download_path)
-                    time_cam_list.append(camera.camera_number)
+                        s3.download_fileobj(bucket, raw_files[product], img_file)
+                    new_files[product] = [download_path]
+                
+                if not new_files:
+                    continue
+                
+                #optional static obstruction mask (pilings, railings, houses) for this camera
+                mask_path = None
+                mask_key = 'cameras/parameters/' + station + '/' + station + '_' + camera.camera_number + '_mask.png'
+                try:
+                    s3.head_object(Bucket=bucket, Key=mask_key)
+                    mask_path = '/tmp/' + station + '_' + camera.camera_number + '_mask.png'
+                    with open(mask_path, 'wb') as mask_file:
+                        s3.download_fileobj(bucket, mask_key, mask_file)
                 except:
-                    print(f'{camera.camera_number} does not have an image at time {unix_time}')
-            
-            #rectify imagery        
-            if len(time_cam_list) != len(cameras):
-                temp_intrinsics = []
-                temp_extrinsics = []
-        
-                c = 0
-                for camera in cameras:
-                    if camera.camera_number not in time_cam_list:
-                        c = c + 1
-                    else:
-                        temp_intrinsics.append(intrinsics_list[c])
-                        temp_extrinsics.append(extrinsics_list[c])
-                        c = c + 1
-                        
-                rectified_image = rectifier.rectify_images(metadata_list[0], image_files_list, temp_intrinsics, temp_extrinsics, local_origin)      
-            else:
-                rectified_image = rectifier.rectify_images(metadata_list[0], image_files_list, intrinsics_list, extrinsics_list, local_origin)
-             
-            ofile = '/tmp/' + unix_time + '.timex.merge.jpg'
-            plt.imshow( np.flip(rectified_image, 0), extent=[xmin, xmax, ymin, ymax])
-            plt.axis('on')
-            plt.savefig(ofile, dpi=200)
+                    mask_path = None
+                
+                #optional reference image (e.g. the timex the camera was calibrated on) to measure camera motion against
+                stabilizer = None
+                reference_key = 'cameras/parameters/' + station + '/' + station + '_' + camera.camera_number + '_reference.jpg'
+                if STABILIZE_FRAMES:
+                    try:
+                        reference_etag = s3.head_object(Bucket=bucket, Key=reference_key)['ETag']
+                    except:
+                        reference_etag = None
+                        STABILIZERS.pop(reference_key, None)
+                    if reference_etag is not None:
+                        if reference_key not in STABILIZERS or STABILIZERS[reference_key][0] != reference_etag:
+                            try:
+                                reference_path = '/tmp/' + station + '_' + camera.camera_number + '_reference.jpg'
+                                with open(reference_path, 'wb') as reference_file:
+                                    s3.download_fileobj(bucket, reference_key, reference_file)
+                                STABILIZERS[reference_key] = (reference_etag, FrameStabilizer(read_image(reference_path)))
+                            except:
+                                #not retried until the reference image changes
+                                STABILIZERS[reference_key] = (reference_etag, None)
+                        stabilizer = STABILIZERS[reference_key][1]
+                
+                #quality score and camera motion of this timestamp, measured on the first image rectified (the timex
+                #when it is there) and reused for the products that arrive later, so all products share the same weights
+                measurements_key = state_prefix + cam + '.measurements.json'
+                measurements_path = '/tmp/' + merge_stamp + '.' + cam + '.measurements.json'
+                try:
+                    s3.head_object(Bucket=bucket, Key=measurements_key)
+                    with open(measurements_path, 'wb') as measurements_file:
+                        s3.download_fileobj(bucket, measurements_key, measurements_file)
+                    with open(measurements_path, 'r') as measurements_file:
+                        measurements = json.load(measurements_file)
+                except:
+                    measurements = {}
+                saved_measurements = dict(measurements)
+                
+                #rectify only this camera and save its contributions for later arrivals
+                tiles = {} if UPLOAD_CAMERA_TILES else None
+                camera_contributions = rectifier.accumulate_products(metadata_list[0], new_files, [intrinsics_list[c]], [extrinsics_list[c]], local_origin, cameras=[camera.camera_number], quality_weighting=True, mask_list=[mask_path], tiles=tiles, stabilizers=[stabilizer], measurements=[measurements])
+                if measurements != saved_measurements:
+                    with open(measurements_path, 'w') as measurements_file:
+                        json.dump(measurements, measurements_file)
+                    with open(measurements_path, 'rb') as measurements_file:
+                        s3.upload_fileobj(measurements_file, bucket, measurements_key)
+                for product, contribution in camera_contributions.items():
+                    state_key = state_prefix + cam + '.' + product + '.npz'
+                    state_path = '/tmp/' + merge_stamp + '.' + cam + '.' + product + '.npz'
+                    contribution.save(state_path)
+                    with open(state_path, 'rb') as state_file:
+                        s3.upload_fileobj(state_file, bucket, state_key)
+                    contributions[product].append(contribution)
+                    if product not in updated_products:
+                        updated_products.append(product)
+                    
+                    #this camera's rectified view, from the pixels sampled for the merge
+                    if UPLOAD_CAMERA_TILES:
+                        tile_path = '/tmp/' + merge_stamp + '.' + cam + '.' + product + '.rectified.png'
+                        tiles[product][0].save(tile_path)
+                        tile_key = merge_dir + getPathElements(raw_files[product])[-1].replace('.jpg', '.rectified.png')
+                        with open(tile_path, 'rb') as tile_img:
+                            s3.upload_fileobj(tile_img, bucket, tile_key)
+                        print(f'{tile_key} uploaded to S3')
+                    
+                    #keep the newest rectified frame of each camera to fill in for it when it misses a timestamp
+                    if FILL_FROM_CACHE:
+                        cache_key = cache_prefix + cam + '.' + product + '.npz'
+                        try:
+                            cached_time = float(s3.head_object(Bucket=bucket, Key=cache_key)['Metadata']['time'])
+                        except:
+                            cached_time = -1
+                        if merge_time >= cached_time:
+                            cache_path = '/tmp/' + cam + '.' + product + '.cache.npz'
+                            CachedFrame.from_accumulator(contribution, merge_time).save(cache_path)
+                            with open(cache_path, 'rb') as cache_file:
+                                s3.upload_fileobj(cache_file, bucket, cache_key, ExtraArgs={'Metadata': {'time': str(merge_time)}})
             
-            #ofile = '/tmp/' + unix_time + '.timex.merge.jpg'
-            #imageio.imwrite(ofile,np.flip(rectified_image,0),format='jpg')
+            #ground resolution of the merge, only computed and uploaded when the calibrations change
+            if UPLOAD_RESOLUTION_MAP and updated_products:
+                calibrations = [get_calibration(metadata_list[0], intrinsics_list[c], extrinsics_list[c], local_origin) for c in range(len(cameras))]
+                calibrations_hash = hashlib.sha1(''.join(calibration_key(cal) for cal in calibrations).encode()).hexdigest()[:12]
+                resolution_key = 'cameras/' + station + '/cx/resolution/' + short_station + '.cx.resolution.' + calibrations_hash + '.npz'
+                try:
+                    s3.head_object(Bucket=bucket, Key=resolution_key)
+                except:
+                    res_x, res_y = rectifier.merged_resolution(calibrations)
+                    resolution_path = '/tmp/' + short_station + '.cx.resolution.npz'
+                    np.savez_compressed(resolution_path, x=res_x.astype(np.float32), y=res_y.astype(np.float32),
+                                        xlims=[xmin, xmax], ylims=[ymin, ymax], dx=dx, dy=dy)
+                    with open(resolution_path, 'rb') as resolution_file:
+                        s3.upload_fileobj(resolution_file, bucket, resolution_key)
+                    print(f'{resolution_key} uploaded to S3')
             
-            merge_filename = f"{unix_time}.{day_of_week}.{month_formatted}.{filename_day}_{hour}_{minute}_{second}.{timezone}.{filename_year}.{short_station}.cx.timex.merge.jpg"
+            #positional uncertainty of the merge, also only computed and uploaded when the calibrations change
+            if UPLOAD_UNCERTAINTY_MAP and updated_products:
+                calibrations = [get_calibration(metadata_list[0], intrinsics_list[c], extrinsics_list[c], local_origin) for c in range(len(cameras))]
+                calibrations_hash = hashlib.sha1(''.join(calibration_key(cal) for cal in calibrations).encode()).hexdigest()[:12]
+                uncertainty_key = 'cameras/' + station + '/cx/uncertainty/' + short_station + '.cx.uncertainty.' + calibrations_hash + '.npz'
+                try:
+                    s3.head_object(Bucket=bucket, Key=uncertainty_key)
+                except:
+                    uncertainty = rectifier.merged_uncertainty(calibrations, CALIBRATION_SIGMAS)
+                    uncertainty_path = '/tmp/' + short_station + '.cx.uncertainty.npz'
+                    np.savez_compressed(uncertainty_path, x=uncertainty['x'].astype(np.float32), y=uncertainty['y'].astype(np.float32),
+                                        radial=uncertainty['radial'].astype(np.float32), xlims=[xmin, xmax], ylims=[ymin, ymax], dx=dx, dy=dy,
+                                        sigmas=json.dumps(CALIBRATION_SIGMAS))
+                    with open(uncertainty_path, 'rb') as uncertainty_file:
+                        s3.upload_fileobj(uncertainty_file, bucket, uncertainty_key)
+                    print(f'{uncertainty_key} uploaded to S3')
             
-            upload_key = 'cameras/' + station + '/cx/merge/' + str(year) + '/' + str(day) + '/'+ merge_filename
-            print('upload key', upload_key)
+            #only products with new contributions are merged again
+            for product in updated_products:
+                #match exposure and color of neighbouring cameras before they are blended
+                accumulator = rectifier.balance_contributions(contributions[product])
+                print(f'cameras in {product} merge:', accumulator.cameras)
                 
-            with open(ofile, 'rb') as merged_img:
-                s3.upload_fileobj(merged_img, bucket, upload_key)
+                provenance = None
+                if FILL_FROM_CACHE and missing_cameras[product]:
+                    cached_frames = []
+                    for camera in missing_cameras[product]:
+                        cache_key = cache_prefix + camera.camera_number.lower() + '.' + product + '.npz'
+                        cache_path = '/tmp/' + camera.camera_number.lower() + '.' + product + '.cache.npz'
+                        try:
+                            with open(cache_path, 'wb') as cache_file:
+                                s3.download_fileobj(bucket, cache_key, cache_file)
+                            cached_frames.append(CachedFrame.load(cache_path))
+                        except:
+                            print(f'no cached {product} frame for {camera.camera_number}')
+                    rectified_image, provenance = rectifier.fill_from_cache(accumulator, cached_frames, merge_time, CACHE_MAX_AGE)
+                else:
+                    rectified_image = accumulator.merged()
+                
+                product_time = product_times.get(product, unix_time)
+                ofile = '/tmp/' + product_time + '.' + product + '.merge.jpg'
+                plt.figure()
+                plt.imshow( np.flip(rectified_image, 0), extent=[xmin, xmax, ymin, ymax])
+                plt.axis('on')
+                plt.savefig(ofile, dpi=200)
+                plt.close()
+                
+                #ofile = '/tmp/' + unix_time + '.timex.merge.jpg'
+                #imageio.imwrite(ofile,np.flip(rectified_image,0),format='jpg')
+                
+                merge_filename = f"{product_time}.{day_of_week}.{month_formatted}.{filename_day}_{hour}_{minute}_{second}.{timezone}.{filename_year}.{short_station}.cx.{product}.merge.jpg"
+                upload_key = merge_dir + merge_filename
+                print('upload key', upload_key)
+                    
+                with open(ofile, 'rb') as merged_img:
+                    s3.upload_fileobj(merged_img, bucket, upload_key)
+                    
+                print(f'{upload_key} uploaded to S3')
                 
-            print(f'{upload_key} uploaded to S3')
+                #provenance band: 1 = live camera, 2 = filled from the recent-frame cache, 0 = no data
+                if provenance is not None:
+                    provenance_file = '/tmp/' + product_time + '.' + product + '.merge.provenance.png'
+                    imageio.imwrite(provenance_file, np.flip(provenance, 0))
+                    provenance_key = upload_key.replace('.merge.jpg', '.merge.provenance.png')
+                    with open(provenance_file, 'rb') as provenance_img:
+                        s3.upload_fileobj(provenance_img, bucket, provenance_key)
+                    print(f'{provenance_key} uploaded to S3')
     
             
-        ###images that are not timex will only be copied
+        ###images that are not merged will only be copied
         else:
             print(f'{new_key} copied')
             
@@ -0,0 +1,49 @@
+"""
+Compare time and peak memory of feathering and multi-band blending in Rectifier.rectify_images
+on the synthetic station. The first multi-band call builds the cached seam structures, so it is
+reported separately from the steady-state cost per merge.
+Usage:
+    python benchmarks/bench_blending.py [repeats]
+"""
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from synthetic_station import *
+from rectifier_crs import Rectifier, TargetGrid
+
+
+def run(rectifier, files, blend):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    M = rectifier.rectify_images(metadata, files, intrinsics_list, extrinsics_list, local_origin, blend=blend)
+    elapsed = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return M, elapsed, peak
+
+
+def main(repeats=5):
+    with tempfile.TemporaryDirectory() as folder:
+        files = make_images(folder)
+        grid = TargetGrid(xlims, ylims, 1, 1, 0)
+        rectifier = Rectifier(grid)
+        # fill the lookup table cache so both modes start from the same state
+        rectifier.rectify_images(metadata, files, intrinsics_list, extrinsics_list, local_origin)
+
+        print(f'grid {grid.X.shape}, {len(files)} cameras, {repeats} repeats')
+        for blend in ['feather', 'multiband']:
+            _, first, first_peak = run(rectifier, files, blend)
+            times = []
+            peaks = []
+            for _ in range(repeats):
+                M, elapsed, peak = run(rectifier, files, blend)
+                times.append(elapsed)
+                peaks.append(peak)
+            print(f'{blend:>10}: first {first:.3f} s ({first_peak/2**20:.0f} MiB), '
+                  f'then {np.median(times):.3f} s median ({max(peaks)/2**20:.0f} MiB peak)')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,55 @@
+"""
+Pose series from ground control points on the synthetic station: GCPs seen by each camera are
+projected with the forward model used for rectifying (distort_UV), picks get pixel noise, and
+solve_extrinsics recovers every pose of the series from perturbed starting poses in one batch.
+Also checks the analytic Jacobian against finite differences.
+Usage:
+    python benchmarks/bench_extrinsic_solver.py [nposes]
+"""
+import sys
+import time
+
+from synthetic_station import *
+from calibration_crs import CameraCalibration
+from extrinsic_solver import BETA_KEYS, project_points, solve_extrinsics
+from rectifier_crs import distort_UV
+
+
+def main(nposes=5000, ngcps=12, noise=0.5):
+    rng = np.random.default_rng(0)
+    for c in range(len(azimuths)):
+        lcp = intrinsics_list[c]
+        beta = np.array([extrinsics_list[c][k] for k in BETA_KEYS])
+        calibration = CameraCalibration(metadata, lcp, extrinsics_list[c], local_origin)
+        xyz = np.column_stack((rng.uniform(xlims[0], xlims[1], 1000),
+                               rng.uniform(ylims[0], ylims[1], 1000),
+                               rng.uniform(0., 3., 1000)))
+        Ud, Vd, flag = distort_UV(calibration, xyz)
+        xyz = xyz[flag > 0][:ngcps]
+        Ud, Vd, _, J = project_points(beta, lcp, xyz, jacobian=True)
+
+        h = 1e-6
+        J_fd = np.empty_like(J)
+        for k in range(6):
+            step = np.zeros(6)
+            step[k] = h
+            U1, V1, _ = project_points(beta + step, lcp, xyz)
+            U2, V2, _ = project_points(beta - step, lcp, xyz)
+            J_fd[..., 0, k] = (U1 - U2)/(2*h)
+            J_fd[..., 1, k] = (V1 - V2)/(2*h)
+
+        UV = np.stack((Ud[0], Vd[0]), axis=-1) + rng.normal(0., noise, (nposes, len(xyz), 2))
+        beta0 = beta + rng.normal(0., 1., (nposes, 6))*[2., 2., 1., 0.02, 0.02, 0.02]
+        t0 = time.perf_counter()
+        solved, rms, niter = solve_extrinsics(beta0, lcp, xyz, UV)
+        solve_time = time.perf_counter() - t0
+        error = np.abs(solved - beta)
+        print(f'camera {c + 1}: {len(xyz)} GCPs, Jacobian relative error {np.abs(J - J_fd).max()/np.abs(J).max():.1e}')
+        print(f'  {nposes} poses in {solve_time:.2f} s ({nposes/solve_time:.0f}/s), median rms {np.median(rms):.2f} px, '
+              f'max {niter.max()} iterations, {np.sum(rms > 3*noise)} poor fits')
+        print(f'  median |error| xyz {np.median(error[:, :3], axis=0).round(3)} m, '
+              f'angles {np.rad2deg(np.median(error[:, 3:], axis=0)).round(4)} deg')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,53 @@
+"""
+Camera footprints and the coverage index on the synthetic station: footprint polygons are compared
+with the grid cells distort_UV finds valid for each camera, and the time to build the index and to
+answer point and region queries is measured.
+Usage:
+    python benchmarks/bench_footprints.py
+"""
+import time
+
+from synthetic_station import *
+from calibration_crs import CameraCalibration
+from footprints import FOOTPRINTS, CoverageIndex
+from rectifier_crs import TargetGrid, distort_UV
+
+
+def main():
+    target_grid = TargetGrid(xlims, ylims, 1, 1, 0.)
+    cameras = [f'c{c + 1}' for c in range(len(azimuths))]
+    calibrations = [CameraCalibration(metadata, intrinsics_list[c], extrinsics_list[c], local_origin) for c in range(len(azimuths))]
+
+    t0 = time.perf_counter()
+    index = CoverageIndex.from_calibrations(cameras, calibrations, z=0., xlims=xlims, ylims=ylims)
+    build_time = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    CoverageIndex.from_calibrations(cameras, calibrations, z=0., xlims=xlims, ylims=ylims)
+    cached_time = time.perf_counter() - t0
+    print(f'index of {len(index)} cameras: {1000*build_time:.1f} ms to build, {1000*cached_time:.2f} ms from cached footprints')
+
+    covered = index.coverage(target_grid.X, target_grid.Y)
+    for c, calibration in enumerate(calibrations):
+        _, _, flag = distort_UV(calibration, target_grid.xyz)
+        seen = flag.reshape(target_grid.X.shape, order='F') > 0
+        agree = np.mean(covered[c] == seen)
+        print(f'  {cameras[c]}: {len(index.footprints[cameras[c]])} vertices, {seen.sum()} cells seen, '
+              f'footprint agrees on {agree:.2%} of the grid ({np.sum(covered[c] & ~seen)} extra, {np.sum(seen & ~covered[c])} missed)')
+    print(f'  grid extent from footprints: x {index.grid_extent()[0]}, y {index.grid_extent()[1]}')
+
+    rng = np.random.default_rng(0)
+    points = np.column_stack((rng.uniform(xlims[0], xlims[1], 10000), rng.uniform(ylims[0], ylims[1], 10000)))
+    t0 = time.perf_counter()
+    for x, y in points:
+        index.cameras_at(x, y)
+    point_time = (time.perf_counter() - t0)/len(points)
+    t0 = time.perf_counter()
+    for x, y in points[:1000]:
+        index.cameras_in([x - 25., x + 25.], [y - 25., y + 25.])
+    roi_time = (time.perf_counter() - t0)/1000
+    print(f'point query {1e6*point_time:.0f} us, 50 m region query {1e6*roi_time:.0f} us; '
+          f'e.g. cameras at (100, -200): {index.cameras_at(100., -200.)}, region x 0-50 y -100-0: {index.cameras_in([0, 50], [-100, 0])}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Round trip and throughput of the inverse projection (CameraCalibration.image_to_world) on the
+synthetic station: random ground points are projected with the forward model used for rectifying
+(distort_UV), mapped back to the ground, and compared with where they started, on a plane and on
+a sloping, rippled DEM.
+Usage:
+    python benchmarks/bench_inverse_projection.py [npoints]
+"""
+import sys
+import time
+
+from synthetic_station import *
+from calibration_crs import CameraCalibration
+from coastcam_funcs import undistort_UV
+from rectifier_crs import distort_UV
+
+
+def dem(x, y):
+    """Sloping beach with alongshore ripples"""
+    return 0.5 + 0.04*x + 0.5*np.sin(y/30.)
+
+
+def main(npoints=1000000):
+    rng = np.random.default_rng(0)
+    xyz = np.column_stack((rng.uniform(xlims[0], xlims[1], npoints),
+                           rng.uniform(ylims[0], ylims[1], npoints),
+                           np.zeros(npoints)))
+
+    for c in range(len(azimuths)):
+        calibration = CameraCalibration(metadata, intrinsics_list[c], extrinsics_list[c], local_origin)
+        print(f'camera {c + 1}')
+        for surface in ['plane', 'dem']:
+            if surface == 'dem':
+                xyz[:, 2] = dem(xyz[:, 0], xyz[:, 1])
+            else:
+                xyz[:, 2] = 0.
+            Ud, Vd, flag = distort_UV(calibration, xyz)
+            seen = flag > 0
+            Ud = Ud[seen]
+            Vd = Vd[seen]
+
+            t0 = time.perf_counter()
+            U, V = undistort_UV(calibration.lcp, Ud, Vd)
+            undistort_time = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            x, y, z = calibration.image_to_world(Ud, Vd, 0., dem=dem if surface == 'dem' else None)
+            inverse_time = time.perf_counter() - t0
+
+            error = np.hypot(x - xyz[seen, 0], y - xyz[seen, 1])
+            print(f'  {surface:>5}: {seen.sum()} points, undistort {seen.sum()/undistort_time/1e6:.1f} M/s, '
+                  f'image_to_world {seen.sum()/inverse_time/1e6:.1f} M/s, '
+                  f'max error {np.nanmax(error):.2e} m (z {np.nanmax(np.abs(z - xyz[seen, 2])):.2e} m), '
+                  f'{np.isnan(error).sum()} failed')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
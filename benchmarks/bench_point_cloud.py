@@ -0,0 +1,90 @@
+"""
+Streaming a Geographical point cloud into a local DEM on the synthetic station grid: points on a
+sloping beach are written as .npy, .las and .csv, streamed through LocalTransform in chunks and
+gridded with DemGridder. Reports throughput, peak memory (tracemalloc) and DEM error, and checks
+LocalTransform against local_transform_points.
+Usage:
+    python benchmarks/bench_point_cloud.py [npoints]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from synthetic_station import *
+from coastcam_funcs import LocalTransform, local_transform_points
+from point_cloud import grid_point_cloud
+from rectifier_crs import TargetGrid
+
+
+def beach(x, y):
+    """Sloping beach with alongshore ripples"""
+    return 0.5 + 0.04*x + 0.5*np.sin(y/30.)
+
+
+def write_las(las_file, xyz, scale=0.001):
+    """Write a minimal LAS 1.2 file (point format 0) of x, y, z"""
+    origin = np.floor(xyz.min(axis=0))
+    header = bytearray(227)
+    header[0:4] = b'LASF'
+    header[24:26] = bytes([1, 2])
+    header[94:96] = np.array([227], '<u2').tobytes()
+    header[96:100] = np.array([227], '<u4').tobytes()
+    header[104] = 0
+    header[105:107] = np.array([20], '<u2').tobytes()
+    header[107:111] = np.array([len(xyz)], '<u4').tobytes()
+    header[131:155] = np.array([scale]*3, '<f8').tobytes()
+    header[155:179] = origin.astype('<f8').tobytes()
+    records = np.zeros(len(xyz), dtype=np.dtype({'names': ['X', 'Y', 'Z'], 'formats': ['<i4']*3,
+                                                  'offsets': [0, 4, 8], 'itemsize': 20}))
+    for axis, name in enumerate(['X', 'Y', 'Z']):
+        records[name] = np.rint((xyz[:, axis] - origin[axis])/scale)
+    with open(las_file, 'wb') as outfile:
+        outfile.write(header)
+        records.tofile(outfile)
+
+
+def main(npoints=5000000):
+    rng = np.random.default_rng(0)
+    local = np.column_stack((rng.uniform(xlims[0], xlims[1], npoints), rng.uniform(ylims[0], ylims[1], npoints), np.zeros(npoints)))
+    local[:, 2] = beach(local[:, 0], local[:, 1])
+    x, y = local_transform_points(local_origin['x'], local_origin['y'], np.deg2rad(local_origin['angd']), 0, local[:, 0], local[:, 1])
+    geo = np.column_stack((x, y, local[:, 2]))
+
+    transform = LocalTransform.from_local_origin(local_origin)
+    t0 = time.perf_counter()
+    x_ref, y_ref = local_transform_points(transform.xo, transform.yo, transform.ang, 1, geo[:, 0], geo[:, 1])
+    function_time = time.perf_counter() - t0
+    points = geo.copy()
+    t0 = time.perf_counter()
+    transform.to_local(points, out=points)
+    inplace_time = time.perf_counter() - t0
+    print(f'{npoints} points: local_transform_points {function_time:.2f} s, LocalTransform in place {inplace_time:.2f} s, '
+          f'max difference {max(np.abs(points[:, 0] - x_ref).max(), np.abs(points[:, 1] - y_ref).max()):.1e} m')
+
+    target_grid = TargetGrid(xlims, ylims, 1, 1, 0.)
+    truth = beach(target_grid.X, target_grid.Y)
+    with tempfile.TemporaryDirectory() as folder:
+        files = {'npy': os.path.join(folder, 'points.npy'), 'las': os.path.join(folder, 'points.las'),
+                 'csv': os.path.join(folder, 'points.csv')}
+        np.save(files['npy'], geo)
+        write_las(files['las'], geo)
+        ncsv = min(npoints, 500000)
+        np.savetxt(files['csv'], geo[:ncsv], delimiter=',', fmt='%.3f', header='x,y,z', comments='')
+        del points, x_ref, y_ref
+        for kind, points_file in files.items():
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            gridder, n = grid_point_cloud(points_file, target_grid, local_origin, chunk=250000)
+            elapsed = time.perf_counter() - t0
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            error = np.abs(gridder.dem() - truth)
+            print(f'  {kind}: {n} points in {elapsed:.2f} s ({n/elapsed/1e6:.1f} M/s), peak memory {peak/1e6:.0f} MB '
+                  f'(file {os.path.getsize(points_file)/1e6:.0f} MB), {np.mean(gridder.count > 0):.0%} of nodes, '
+                  f'median DEM error {np.nanmedian(error):.3f} m')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000000)
@@ -0,0 +1,40 @@
+"""
+Check angle2R_batch and assembleP_batch against the scalar angle2R and assembleP for random poses
+around the synthetic station cameras, and compare their speed.
+Usage:
+    python benchmarks/bench_pose_batch.py [nposes]
+"""
+import sys
+import time
+
+from synthetic_station import *
+from coastcam_funcs import angle2R, angle2R_batch, assembleP, assembleP_batch
+
+
+def main(nposes=10000):
+    rng = np.random.default_rng(0)
+    intrinsics = intrinsics_list[0]
+    xyz = np.array([[e['x'], e['y'], e['z']] for e in extrinsics_list])[rng.integers(0, len(azimuths), nposes)]
+    xyz = xyz + rng.normal(0., 1., (nposes, 3))
+    angles = np.column_stack((rng.uniform(0., 2*np.pi, nposes),
+                              rng.uniform(np.deg2rad(60.), np.deg2rad(89.), nposes),
+                              rng.normal(0., 0.02, nposes)))
+
+    t0 = time.perf_counter()
+    R_scalar = np.stack([angle2R(*a) for a in angles])
+    P_scalar = np.stack([assembleP({'x': x[0], 'y': x[1], 'z': x[2], 'a': a[0], 't': a[1], 'r': a[2]}, intrinsics)
+                         for x, a in zip(xyz, angles)])
+    scalar_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    R_batch = angle2R_batch(angles[:, 0], angles[:, 1], angles[:, 2])
+    P_batch, _ = assembleP_batch(xyz, angles, intrinsics)
+    batch_time = time.perf_counter() - t0
+
+    print(f'{nposes} poses: scalar {scalar_time:.3f} s, batch {batch_time:.4f} s ({scalar_time/batch_time:.0f}x)')
+    print(f'max |R difference| {np.abs(R_batch - R_scalar).max():.2e}')
+    print(f'max relative |P difference| {(np.abs(P_batch - P_scalar)/np.abs(P_scalar).max(axis=(1, 2), keepdims=True)).max():.2e}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
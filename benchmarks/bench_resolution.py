@@ -0,0 +1,60 @@
+"""
+Resolution weights on regular, rotated (GeoTargetGrid) and adaptive grids of the synthetic station:
+weights are pixels per grid cell, so a rotated grid with the same spacing must match the regular grid
+at the same ground points, and an adaptive node must be 4**level times the regular weight. Also checks
+that a resolution-weighted merge on the adaptive grid has data.
+Usage:
+    python benchmarks/bench_resolution.py
+"""
+import tempfile
+import time
+
+from synthetic_station import *
+from calibration_crs import CameraCalibration
+from coastcam_funcs import local_transform_points
+from rectifier_crs import AdaptiveTargetGrid, GeoTargetGrid, Rectifier, TargetGrid
+
+
+def nearest_regular(grid, X, Y):
+    """Flat index of the regular grid node nearest each local (X, Y)"""
+    i = np.clip(np.rint(X - xlims[0]).astype(int), 0, grid.X.shape[1] - 1)
+    j = np.clip(np.rint(Y - ylims[0]).astype(int), 0, grid.X.shape[0] - 1)
+    return j*grid.X.shape[1] + i
+
+
+def compare(name, weight, expected):
+    """Print the spread of weight/expected where both are positive"""
+    both = (weight > 0) & (expected > 0)
+    ratio = weight[both]/expected[both]
+    print(f'  {name}: {np.mean(weight > 0):.0%} of nodes weighted, weight / expected median {np.median(ratio):.3f}, '
+          f'5-95% {np.percentile(ratio, 5):.3f}-{np.percentile(ratio, 95):.3f}')
+
+
+def main():
+    calibrations = [CameraCalibration(metadata, intrinsics_list[c], extrinsics_list[c], local_origin) for c in range(len(azimuths))]
+    regular = TargetGrid(xlims, ylims, 1, 1, 0.)
+    E0, N0 = local_transform_points(local_origin['x'], local_origin['y'], np.deg2rad(local_origin['angd']), 0, 50., -300.)
+    rotated = GeoTargetGrid(local_origin, (200, 200), origin=(E0, N0), rotation=45., dx=1, dy=1, z=0.)
+    adaptive = AdaptiveTargetGrid(xlims, ylims, 1, 1, 0., camera_xy=[(-20., -200.)], near_distance=50.)
+    print(f'cell areas: regular {regular.cell_area()}, rotated {rotated.cell_area():.3f}, '
+          f'adaptive {np.unique(adaptive.cell_area()).tolist()}')
+
+    rectifiers = {name: Rectifier(grid) for name, grid in [('regular', regular), ('rotated', rotated), ('adaptive', adaptive)]}
+    for c, calibration in enumerate(calibrations):
+        print(f'camera {c + 1}')
+        weights = {name: rectifier.resolution_map(calibration)['weight'] for name, rectifier in rectifiers.items()}
+        reference = weights['regular'].ravel()
+        compare('rotated', weights['rotated'].ravel(), reference[nearest_regular(regular, rotated.X.ravel(), rotated.Y.ravel())])
+        compare('adaptive', weights['adaptive'].ravel(),
+                adaptive.cell_area().ravel()*reference[nearest_regular(regular, adaptive.X.ravel(), adaptive.Y.ravel())])
+
+    with tempfile.TemporaryDirectory() as folder:
+        files = make_images(folder)
+        t0 = time.perf_counter()
+        M = rectifiers['adaptive'].rectify_images(metadata, files, intrinsics_list, extrinsics_list, local_origin, resolution_weighting=True)
+        print(f'resolution-weighted merge on the adaptive grid: {np.mean(np.any(M > 0, axis=-1)):.0%} of nodes with data '
+              f'in {time.perf_counter() - t0:.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Frame stabilization on the synthetic station:
+  - FrameStabilizer.measure on frames whose content is shifted by known sub-pixel amounts
+  - Rectifier.stabilized_lookup (first-order correction) against rebuilding the lookup table
+    for the moved camera pose, and the time each takes per frame
+Usage:
+    python benchmarks/bench_stabilization.py
+"""
+import tempfile
+import time
+
+from scipy.ndimage import shift as shift_image
+
+from synthetic_station import *
+from calibration_crs import CameraCalibration
+from rectifier_crs import FrameStabilizer, Rectifier, TargetGrid, read_image
+
+
+def main():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as folder:
+        files = make_images(folder)
+        reference = read_image(files[0])
+
+    stabilizer = FrameStabilizer(reference)
+    errors = []
+    times = []
+    for _ in range(20):
+        dU, dV = rng.uniform(-12., 12., 2)
+        frame = shift_image(reference, (dV, dU, 0), order=1, mode='nearest')
+        for scale, image in ((1, frame), (2, frame[::2, ::2])):
+            t0 = time.perf_counter()
+            mU, mV, peak = stabilizer.measure(image)
+            times.append(time.perf_counter() - t0)
+            errors.append(np.hypot(mU - dU, mV - dV))
+    print(f'measure: {stabilizer.size} decimated grid, {1000*np.median(times):.1f} ms per frame, '
+          f'shift error median {np.median(errors):.2f} px, max {np.max(errors):.2f} px')
+
+    rectifier = Rectifier(TargetGrid(xlims, ylims, 1, 1, 0.))
+    for c in range(len(azimuths)):
+        calibration = CameraCalibration(metadata, intrinsics_list[c], extrinsics_list[c], local_origin)
+        lookup = rectifier.camera_lookup(calibration, (NV, NU))
+        t0 = time.perf_counter()
+        rectifier.angle_jacobian(lookup)
+        jacobian_time = time.perf_counter() - t0
+        for da, dt in ((0.002, 0.), (0., -0.003), (0.004, 0.004)):
+            moved = dict(extrinsics_list[c], a=extrinsics_list[c]['a'] + da, t=extrinsics_list[c]['t'] + dt)
+            t0 = time.perf_counter()
+            rebuilt = Rectifier(rectifier.target_grid).camera_lookup(CameraCalibration(metadata, intrinsics_list[c], moved, local_origin), (NV, NU))
+            rebuild_time = time.perf_counter() - t0
+            # cells seen before and after the move
+            index = np.intersect1d(lookup['index'], rebuilt['index'])
+            U = rebuilt['U']
+            V = rebuilt['V']
+            # the content shift a stabilizer would measure: the average movement over the footprint
+            dU = np.mean(U.ravel()[index] - lookup['U'].ravel()[index])
+            dV = np.mean(V.ravel()[index] - lookup['V'].ravel()[index])
+            t0 = time.perf_counter()
+            corrected = rectifier.stabilized_lookup(lookup, dU, dV)
+            correct_time = time.perf_counter() - t0
+            before = np.hypot(U.ravel()[index] - lookup['U'].ravel()[index], V.ravel()[index] - lookup['V'].ravel()[index])
+            after = np.hypot(U.ravel()[index] - corrected['U'].ravel()[index], V.ravel()[index] - corrected['V'].ravel()[index])
+            da_found, dt_found, _ = corrected['pose_correction']
+            print(f'camera {c + 1} da {da:+.3f} dt {dt:+.3f} rad: shift ({dU:+.1f}, {dV:+.1f}) px, found da {da_found:+.4f} dt {dt_found:+.4f}, '
+                  f'lookup error max {before.max():.2f} -> {after.max():.3f} px, '
+                  f'correction {1000*correct_time:.1f} ms vs rebuild {1000*rebuild_time:.0f} ms (Jacobian once {1000*jacobian_time:.0f} ms)')
+
+
+if __name__ == '__main__':
+    main()
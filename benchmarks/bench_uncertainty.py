@@ -0,0 +1,70 @@
+"""
+Monte Carlo positional uncertainty maps on the synthetic station grid: time for Rectifier.uncertainty_map
+and merged_uncertainty, and a check of the first-order ground error against exact re-intersection
+(perturbed CameraCalibration objects and image_to_world) at a sample of cells.
+Usage:
+    python benchmarks/bench_uncertainty.py [nsamples]
+"""
+import sys
+import time
+
+from synthetic_station import *
+from calibration_crs import CameraCalibration
+from extrinsic_solver import BETA_KEYS
+from rectifier_crs import Rectifier, TargetGrid, distort_UV
+
+SIGMAS = {'x': 0.05, 'y': 0.05, 'z': 0.05, 'a': 0.001, 't': 0.001, 'r': 0.001, 'fx': 2., 'fy': 2., 'd1': 0.002}
+
+
+def main(nsamples=1000):
+    target_grid = TargetGrid(xlims, ylims, 1, 1, 0.)
+    rectifier = Rectifier(target_grid)
+    calibrations = [CameraCalibration(metadata, intrinsics_list[c], extrinsics_list[c], local_origin) for c in range(len(azimuths))]
+    for calibration in calibrations:
+        rectifier.resolution_map(calibration)
+
+    t0 = time.perf_counter()
+    merged = rectifier.merged_uncertainty(calibrations, SIGMAS, nsamples=nsamples)
+    merge_time = time.perf_counter() - t0
+    print(f'{target_grid.X.shape} grid, {nsamples} samples: {len(calibrations)} cameras in {merge_time:.2f} s, '
+          f'merged radial uncertainty 5/50/95% {np.nanpercentile(merged["radial"], [5, 50, 95]).round(2)} m')
+
+    # exact: the nominal pixel of a cell re-intersected with the plane by each perturbed calibration
+    rng = np.random.default_rng(1)
+    calibration = calibrations[1]
+    uncertainty = rectifier.uncertainty_map(calibration, SIGMAS, nsamples=nsamples)
+    seen = np.flatnonzero(~np.isnan(uncertainty['radial']))
+    cells = rng.choice(seen, 50, replace=False)
+    x = target_grid.X.ravel()[cells]
+    y = target_grid.Y.ravel()[cells]
+    U, V, _ = project_xy(calibration, x, y)
+    nexact = 1000
+    t0 = time.perf_counter()
+    squared = np.zeros(len(cells))
+    for _ in range(nexact):
+        extrinsics = {k: calibration.local_extrinsics[k] + rng.normal()*SIGMAS.get(k, 0.) for k in BETA_KEYS}
+        intrinsics = {k: v + rng.normal()*SIGMAS[k] if k in SIGMAS else v for k, v in calibration.lcp.items()}
+        perturbed = CameraCalibration(dict(metadata, coordinate_system='xyz'), intrinsics, extrinsics, local_origin)
+        xp, yp, _ = perturbed.image_to_world(U, V, 0.)
+        squared += (xp - x)**2 + (yp - y)**2
+    exact_time = time.perf_counter() - t0
+    exact = np.sqrt(squared/nexact)
+    ratio = uncertainty['radial'].ravel()[cells]/exact
+    print(f'  camera 2 alone {1000*time_map(rectifier, calibration, nsamples):.0f} ms; exact re-intersection of 50 cells x {nexact} '
+          f'calibrations {exact_time:.1f} s; map / exact radial error: median {np.median(ratio):.3f}, range {ratio.min():.2f}-{ratio.max():.2f}')
+
+
+def project_xy(calibration, x, y):
+    """Nominal distorted pixel coordinates of ground points at z = 0"""
+    return distort_UV(calibration, np.column_stack((x, y, np.zeros_like(x))))
+
+
+def time_map(rectifier, calibration, nsamples):
+    """Time of one uncertainty map, not cached"""
+    t0 = time.perf_counter()
+    Rectifier(rectifier.target_grid).uncertainty_map(calibration, SIGMAS, nsamples=nsamples)
+    return time.perf_counter() - t0
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,47 @@
+"""
+Synthetic CoastCam station used by the benchmark scripts: three cameras on a pole looking offshore,
+with lens parameters of the same order as the Madeira Beach cameras, and textured test images.
+The station library is imported from the Madeira Beach folder (the station folders hold identical copies).
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Madeira Beach'))
+
+import imageio
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+NU = 1600
+NV = 1200
+
+metadata = {'name': 'synthetic', 'serial_number': 0, 'camera_number': 'c1',
+            'calibration_date': '2021-01-01', 'coordinate_system': 'xyz'}
+
+local_origin = {'x': 1000., 'y': 2000., 'angd': 30.}
+
+azimuths = [45., 90., 135.]
+
+intrinsics_list = [{'NU': NU, 'NV': NV, 'c0U': NU/2 + 3, 'c0V': NV/2 - 4, 'fx': 1400., 'fy': 1410.,
+                    'd1': -0.12, 'd2': 0.03, 'd3': 0., 't1': 0.0008, 't2': -0.0005,
+                    'r': np.arange(5.)} for a in azimuths]
+
+extrinsics_list = [{'x': -20., 'y': -200., 'z': 18., 'a': np.deg2rad(a), 't': np.deg2rad(78.),
+                    'r': np.deg2rad(0.5)} for a in azimuths]
+
+# same grid as the Madeira Beach handler
+xlims = [-10, 400]
+ylims = [-400, 0]
+
+
+def make_images(folder, seed=0):
+    """Write one smooth random texture image per camera and return the file names"""
+    rng = np.random.default_rng(seed)
+    files = []
+    for i in range(len(azimuths)):
+        image = gaussian_filter(rng.random((NV, NU, 3)), (6, 6, 0))
+        image = (image - image.min())/(image.max() - image.min())*200 + 20 + 10*i
+        file = os.path.join(folder, f'synthetic.c{i+1}.timex.jpg')
+        imageio.imwrite(file, image.astype(np.uint8), quality=92)
+        files.append(file)
+    return files
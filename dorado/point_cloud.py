@@ -0,0 +1,186 @@
+"""
+Streaming survey point clouds (lidar, GNSS) into local coordinates and DEM grids for rectification.
+Points are read in fixed-size chunks into one reused buffer, transformed in place by LocalTransform,
+and binned onto the target grid, so memory stays constant for any number of points.
+
+Readers yield (n, 3) float64 x, y, z chunks from .npy (memory-mapped), .csv/.txt (x, y, z in the
+first three columns) and .las (uncompressed LAS 1.0-1.4) files. A chunk is only valid until the next
+one is read; copy it to keep it.
+
+Grid a point cloud in Geographical coordinates onto a local target grid:
+    python point_cloud.py <points file> <localOrigin.yaml> <dem.npz> --xlims -10 400 --ylims -400 0 [--dx 1] [--local]
+"""
+import argparse
+import itertools
+import os
+
+import numpy as np
+
+from coastcam_funcs import LocalTransform, yaml2dict
+
+
+def read_points_npy(points_file, chunk=1000000):
+    """Yield chunks of an (n, >=3) .npy array, memory-mapped so only one chunk is in memory"""
+    points = np.load(points_file, mmap_mode='r')
+    buffer = np.empty((min(chunk, len(points)), 3))
+    for start in range(0, len(points), chunk):
+        n = min(chunk, len(points) - start)
+        buffer[:n] = points[start:start + n, :3]
+        yield buffer[:n]
+
+
+def read_points_csv(points_file, chunk=1000000, delimiter=',', skiprows=1, usecols=(0, 1, 2)):
+    """Yield chunks of x, y, z from a delimited text file (skiprows header lines are skipped)"""
+    buffer = np.empty((chunk, 3))
+    with open(points_file, 'r') as infile:
+        for _ in range(skiprows):
+            next(infile, None)
+        while True:
+            lines = list(itertools.islice(infile, chunk))
+            if not lines:
+                break
+            values = np.loadtxt(lines, delimiter=delimiter, usecols=usecols, ndmin=2)
+            buffer[:len(values)] = values
+            yield buffer[:len(values)]
+
+
+def las_header(points_file):
+    """Return the fields of a LAS header needed to read the point records
+    Returns:
+        header (dict): 'offset' (to the first point), 'record_length', 'npoints', 'scale' and
+            'origin' (offset added to the scaled integer coordinates)
+    """
+    with open(points_file, 'rb') as infile:
+        raw = infile.read(255)
+    if raw[:4] != b'LASF':
+        raise ValueError(f'{points_file} is not a LAS file')
+    minor = raw[25]
+    npoints = int(np.frombuffer(raw, '<u4', 1, 107)[0])
+    if minor >= 4 and npoints == 0:
+        # LAS 1.4 keeps counts over 2^32 in a 64-bit field
+        npoints = int(np.frombuffer(raw, '<u8', 1, 247)[0])
+    return {'offset': int(np.frombuffer(raw, '<u4', 1, 96)[0]),
+            'record_length': int(np.frombuffer(raw, '<u2', 1, 105)[0]),
+            'npoints': npoints,
+            'scale': np.frombuffer(raw, '<f8', 3, 131).copy(),
+            'origin': np.frombuffer(raw, '<f8', 3, 155).copy()}
+
+
+def read_points_las(points_file, chunk=1000000):
+    """Yield chunks of x, y, z from an uncompressed LAS file, memory-mapped"""
+    header = las_header(points_file)
+    record = np.dtype({'names': ['X', 'Y', 'Z'], 'formats': ['<i4']*3, 'offsets': [0, 4, 8],
+                       'itemsize': header['record_length']})
+    records = np.memmap(points_file, dtype=record, mode='r', offset=header['offset'], shape=(header['npoints'],))
+    buffer = np.empty((min(chunk, header['npoints']), 3))
+    for start in range(0, header['npoints'], chunk):
+        block = records[start:start + chunk]
+        n = len(block)
+        for axis, name in enumerate(['X', 'Y', 'Z']):
+            np.multiply(block[name], header['scale'][axis], out=buffer[:n, axis])
+            buffer[:n, axis] += header['origin'][axis]
+        yield buffer[:n]
+
+
+def read_points(points_file, chunk=1000000):
+    """Yield chunks of x, y, z from a .npy, .las or delimited text file"""
+    extension = os.path.splitext(points_file)[1].lower()
+    if extension == '.npy':
+        return read_points_npy(points_file, chunk)
+    if extension == '.las':
+        return read_points_las(points_file, chunk)
+    return read_points_csv(points_file, chunk)
+
+
+class DemGridder(object):
+    """Bins a stream of local x, y, z points onto the nodes of a target grid.
+    Notes:
+        - Each point goes to its nearest node; the DEM is the mean z of a node's points. Only
+          running sums and counts the size of the grid are kept.
+    Args:
+        target_grid (TargetGrid): grid to build the DEM on (regular X and Y)
+    Attributes:
+        x, y (np.ndarray): node coordinates along x and y
+        total (np.ndarray): sum of z at each node
+        count (np.ndarray): number of points at each node
+    """
+    def __init__(self, target_grid):
+        self.x = target_grid.X[0, :]
+        self.y = target_grid.Y[:, 0]
+        self.dx = self.x[1] - self.x[0]
+        self.dy = self.y[1] - self.y[0]
+        self.total = np.zeros(target_grid.X.shape)
+        self.count = np.zeros(target_grid.X.shape, dtype=np.int64)
+
+    def add(self, points):
+        """Add an (n, >=3) chunk of local x, y, z points"""
+        i = np.rint((points[:, 0] - self.x[0])/self.dx).astype(np.int64)
+        j = np.rint((points[:, 1] - self.y[0])/self.dy).astype(np.int64)
+        inside = (i >= 0) & (i < len(self.x)) & (j >= 0) & (j < len(self.y))
+        flat = j[inside]*len(self.x) + i[inside]
+        self.total += np.bincount(flat, weights=points[inside, 2], minlength=self.total.size).reshape(self.total.shape)
+        self.count += np.bincount(flat, minlength=self.count.size).reshape(self.count.shape)
+
+    def add_stream(self, chunks):
+        """Add every chunk of a point stream, returning the number of points read"""
+        npoints = 0
+        for points in chunks:
+            self.add(points)
+            npoints += len(points)
+        return npoints
+
+    def dem(self):
+        """Return the mean z at each node, NaN at nodes without points"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.total/self.count, np.nan)
+
+    def apply(self, target_grid):
+        """Set the target grid elevations to the DEM where it has points (the grid z elsewhere)"""
+        dem = self.dem()
+        target_grid.Z = np.where(np.isnan(dem), target_grid.Z, dem)
+        target_grid.xyz = target_grid._xyz_grid()
+        return target_grid
+
+    def save(self, dem_file):
+        """Write x, y, z (NaN where empty) and count to an npz file"""
+        np.savez_compressed(dem_file, x=self.x, y=self.y, z=self.dem(), count=self.count)
+
+
+def grid_point_cloud(points_file, target_grid, local_origin=None, chunk=1000000):
+    """Grid a point cloud file onto a target grid
+    Arguments:
+        points_file (str): .npy, .las or delimited text file of x, y, z points
+        target_grid (TargetGrid): local grid for the DEM
+        local_origin (dict): local origin if the points are in Geographical coordinates, None if local
+        chunk (int): points read at a time
+    Returns:
+        gridder (DemGridder), npoints (int)
+    """
+    chunks = read_points(points_file, chunk)
+    if local_origin is not None:
+        chunks = LocalTransform.from_local_origin(local_origin).stream(chunks, 1)
+    gridder = DemGridder(target_grid)
+    npoints = gridder.add_stream(chunks)
+    return gridder, npoints
+
+
+if __name__ == '__main__':
+    from rectifier_crs import TargetGrid
+
+    parser = argparse.ArgumentParser(description='Grid a survey point cloud onto a local target grid')
+    parser.add_argument('points_file', help='.npy, .las or csv of x, y, z')
+    parser.add_argument('local_origin_file', help='<station>_localOrigin.yaml')
+    parser.add_argument('dem_file', help='output .npz')
+    parser.add_argument('--xlims', type=float, nargs=2, required=True)
+    parser.add_argument('--ylims', type=float, nargs=2, required=True)
+    parser.add_argument('--dx', type=float, default=1.)
+    parser.add_argument('--dy', type=float, default=1.)
+    parser.add_argument('--local', action='store_true', help='points are already in local coordinates')
+    parser.add_argument('--chunk', type=int, default=1000000)
+    args = parser.parse_args()
+
+    local_origin = None if args.local else yaml2dict(args.local_origin_file)
+    target_grid = TargetGrid(args.xlims, args.ylims, args.dx, args.dy)
+    gridder, npoints = grid_point_cloud(args.points_file, target_grid, local_origin, args.chunk)
+    gridder.save(args.dem_file)
+    print(f'{args.dem_file}: {npoints} points, {np.sum(gridder.count > 0)} of {gridder.count.size} nodes')
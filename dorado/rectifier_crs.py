@@ -1,9 +1,22 @@
+import hashlib
+import io
+import json
+import os
+
 import imageio
 import numpy as np
+from PIL import Image, PngImagePlugin
 from scipy.interpolate import RectBivariateSpline, RegularGridInterpolator
+from scipy.ndimage import convolve1d
+from scipy.sparse import csr_matrix
 from scipy.ndimage.morphology import distance_transform_edt
 
-from calibration_crs import CameraCalibration #CRS
+from calibration_crs import get_calibration #CRS
+from coastcam_funcs import image_quality, lcp_distort, local_transform_points
+from extrinsic_solver import BETA_KEYS, project_points
+
+# lens calibration profile values used by the distortion model
+LCP_KEYS = ('NU', 'NV', 'c0U', 'c0V', 'fx', 'fy', 'd1', 'd2', 'd3', 't1', 't2')
 
 
 class TargetGrid(object):
@@ -20,12 +33,15 @@ class TargetGrid(object):
         dy (float) - resolution of grid in y direction (same units as camera calibration)
         z (float) - static value to estimate elevation at everypoint in the x, y grid
     Attributes:
+        dx, dy (float): grid resolution
         X (np.ndarray): Local grid coordinates in x-direction.
         Y (np.ndarray): Local grid coordinates in y-direction.
         Z (np.ndarray): Local grid coordinates in z-direction.
         xyz (np.ndarray): The grid where pixels are compiled from images for rectification.
     """
     def __init__(self, xlims, ylims, dx=1, dy=1, z=-0.91):
+        self.dx = dx
+        self.dy = dy
         x = np.arange(xlims[0], xlims[1]+dx, dx)
         y = np.arange(ylims[0], ylims[1]+dx, dy)
         self.X, self.Y = np.meshgrid(x, y)
@@ -38,6 +54,1024 @@ class TargetGrid(object):
         z = self.Z.copy().T.flatten()
         return np.vstack((x, y, z)).T
 
+    def cell_area(self):
+        """Return the ground area of the cell each node stands for (a scalar or the shape of X)"""
+        return abs(self.dx*self.dy)
+
+    def edge_distance(self, valid):
+        """Return distance (in grid cells) from each valid node to the nearest invalid node
+        Arguments:
+            valid (np.ndarray): boolean array the shape of X
+        Returns:
+            D (np.ndarray): Euclidean distance transform of valid
+        """
+        return distance_transform_edt(valid)
+
+
+class GeoTargetGrid(TargetGrid):
+    """Grid defined in geographic coordinates, rectified directly without a second resampling pass.
+    Notes:
+        - Nodes are laid out by an affine transform from (column, row) to geographic (E, N):
+            E = a*col + b*row + c
+            N = d*col + e*row + f
+          which is the same coefficient order used by rasterio/affine.
+        - The geographic nodes are converted to the local coordinates of the camera calibrations
+          in one vectorized step, so the grid can be rotated arbitrarily relative to the local axes.
+        - Row 0 of the rectified image is row 0 of the grid, so a north-up grid (negative e)
+          comes out in the usual raster orientation.
+    Args:
+        local_origin (dict) - local origin with 'x', 'y' (geographic) and 'angd' (degrees), as in CameraCalibration
+        shape (tuple) - (nrows, ncols) of the grid
+        transform (sequence) - affine coefficients (a, b, c, d, e, f). Overrides origin, rotation, dx and dy.
+        origin (sequence) - geographic (E, N) of node (0, 0), used when transform is None
+        rotation (float) - angle of the grid columns relative to geographic E, positive counter-clockwise. Units are degrees.
+        dx (float) - node spacing along grid columns (same units as camera calibration)
+        dy (float) - node spacing along grid rows; use a negative value for a north-up grid
+        z (float) - static value to estimate elevation at everypoint in the grid
+    Attributes:
+        transform (np.ndarray): affine coefficients (a, b, c, d, e, f)
+        E (np.ndarray): Geographic grid coordinates in E-direction.
+        N (np.ndarray): Geographic grid coordinates in N-direction.
+        X (np.ndarray): Local grid coordinates in x-direction.
+        Y (np.ndarray): Local grid coordinates in y-direction.
+        Z (np.ndarray): Local grid coordinates in z-direction.
+        xyz (np.ndarray): The grid where pixels are compiled from images for rectification.
+    """
+    def __init__(self, local_origin, shape, transform=None, origin=(0., 0.), rotation=0., dx=1, dy=1, z=-0.91):
+        if transform is None:
+            transform = affine_from_origin(origin, rotation, dx, dy)
+        self.transform = np.asarray(transform, dtype='float64')
+        a, b, c, d, e, f = self.transform
+
+        col, row = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]))
+        self.E = a*col + b*row + c
+        self.N = d*col + e*row + f
+
+        # geographic -> local for every node at once
+        self.X, self.Y = local_transform_points(
+            local_origin['x'], local_origin['y'], np.deg2rad(local_origin['angd']),
+            1,
+            self.E, self.N)
+        self.Z = np.zeros_like(self.X) + z
+        self.xyz = self._xyz_grid()
+
+    def cell_area(self):
+        """Return the ground area of a cell, from the determinant of the affine transform"""
+        a, b, _, d, e, _ = self.transform
+        return abs(a*e - b*d)
+
+
+class AdaptiveTargetGrid(TargetGrid):
+    """Variable-resolution grid made of square blocks whose cell size grows away from the cameras.
+    Notes:
+        - The domain is the same as TargetGrid(xlims, ylims, dx, dy), which is the base raster
+          returned by to_raster(). It is cut into blocks of block_size x block_size base cells.
+        - Each block gets a cell size of 2**level base cells, with level chosen from the spacing
+          function at the block center, so coarse blocks sample 4**level times fewer nodes.
+        - The spacing function defaults to dx * (distance to nearest camera) / near_distance,
+          i.e. full resolution within near_distance of a camera.
+        - Nodes of all blocks are stored in one flat list; X, Y and Z have shape (nnodes, 1) so
+          the Rectifier can sample them like any other grid. Merged results are turned back
+          into a regular raster with to_raster().
+    Args:
+        xlims (ndarray) - min and max (inclusive) in the x-direction (e.g. [-50, 650])
+        ylims (ndarray) - min and max (inclusive) in the y-direction (e.g. [0, 2501])
+        dx (float) - finest resolution of grid in x direction (same units as camera calibration)
+        dy (float) - finest resolution of grid in y direction (same units as camera calibration)
+        z (float) - static value to estimate elevation at everypoint in the x, y grid
+        spacing (function) - spacing(x, y) returning the wanted cell size at local (x, y) arrays.
+            Overrides camera_xy.
+        camera_xy (list) - local (x, y) of each camera, used by the default spacing function
+        near_distance (float) - distance from the cameras over which the finest resolution is kept
+        block_size (int) - block width in base cells (rounded up to a multiple of 2**max_level)
+        max_level (int) - coarsest level, cell size dx * 2**max_level
+    Attributes:
+        blocks (np.ndarray): structured array with one entry per block:
+            i0, j0 (base column and row of the block corner), level, ncols, nrows and
+            start (offset of the first node of the block in the flat node list)
+        raster_shape (tuple): shape of the base raster
+        X (np.ndarray): Local grid coordinates in x-direction.
+        Y (np.ndarray): Local grid coordinates in y-direction.
+        Z (np.ndarray): Local grid coordinates in z-direction.
+        xyz (np.ndarray): The grid where pixels are compiled from images for rectification.
+    """
+    block_dtype = np.dtype([('i0', 'i4'), ('j0', 'i4'), ('level', 'i4'),
+                            ('ncols', 'i4'), ('nrows', 'i4'), ('start', 'i8')])
+
+    def __init__(self, xlims, ylims, dx=1, dy=1, z=-0.91, spacing=None, camera_xy=None,
+                 near_distance=100., block_size=32, max_level=3):
+        self.x0 = xlims[0]
+        self.y0 = ylims[0]
+        self.dx = dx
+        self.dy = dy
+        self.max_level = max_level
+        nx = len(np.arange(xlims[0], xlims[1]+dx, dx))
+        ny = len(np.arange(ylims[0], ylims[1]+dy, dy))
+        self.raster_shape = (ny, nx)
+
+        # blocks must hold a whole number of the coarsest cells
+        coarsest = 2**max_level
+        self.block_size = B = int(np.ceil(block_size/coarsest))*coarsest
+        j0, i0 = np.meshgrid(np.arange(0, ny, B), np.arange(0, nx, B), indexing='ij')
+        i0 = i0.flatten()
+        j0 = j0.flatten()
+        width = np.minimum(B, nx - i0)
+        height = np.minimum(B, ny - j0)
+
+        # cell size wanted at the block centers
+        xc = self.x0 + (i0 + width/2.)*dx
+        yc = self.y0 + (j0 + height/2.)*dy
+        if spacing is not None:
+            s = np.broadcast_to(spacing(xc, yc), xc.shape)
+        elif camera_xy is not None:
+            cams = np.atleast_2d(np.asarray(camera_xy, dtype='float64'))
+            dist = np.min(np.hypot(xc[:, np.newaxis] - cams[:, 0],
+                                   yc[:, np.newaxis] - cams[:, 1]), axis=1)
+            s = min(dx, dy)*dist/near_distance
+        else:
+            s = np.full(xc.shape, min(dx, dy))
+        with np.errstate(divide='ignore'):
+            level = np.floor(np.log2(np.maximum(s, 1e-12)/min(dx, dy)))
+        level = np.clip(level, 0, max_level).astype(int)
+
+        f = 2**level
+        ncols = -(-width//f)
+        nrows = -(-height//f)
+        counts = ncols*nrows
+        self.blocks = np.zeros(len(i0), dtype=self.block_dtype)
+        self.blocks['i0'] = i0
+        self.blocks['j0'] = j0
+        self.blocks['level'] = level
+        self.blocks['ncols'] = ncols
+        self.blocks['nrows'] = nrows
+        self.blocks['start'] = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+        # node positions: each node sits at the center of its 2**level x 2**level group of base cells
+        icol, jrow = self._node_base_index()
+        x = self.x0 + icol*dx
+        y = self.y0 + jrow*dy
+        self.X = x[:, np.newaxis]
+        self.Y = y[:, np.newaxis]
+        self.Z = np.zeros_like(self.X) + z
+        self.xyz = self._xyz_grid()
+        self._raster_index = None
+
+    def _node_base_index(self):
+        """Return fractional base (column, row) of every node, in flat node order"""
+        b = self.blocks
+        f = 2**b['level']
+        counts = b['ncols']*b['nrows']
+        # index of each node within its block, without a Python loop over blocks
+        block_of_node = np.repeat(np.arange(len(b)), counts)
+        k = np.arange(counts.sum()) - np.repeat(b['start'], counts)
+        ncols = b['ncols'][block_of_node]
+        fn = f[block_of_node]
+        m = k % ncols
+        n = k // ncols
+        icol = b['i0'][block_of_node] + m*fn + (fn - 1)/2.
+        jrow = b['j0'][block_of_node] + n*fn + (fn - 1)/2.
+        return icol, jrow
+
+    def cell_area(self):
+        """Return the ground area of each node's cell, dx*dy*4**level, the shape of X"""
+        b = self.blocks
+        level = np.repeat(b['level'], b['ncols']*b['nrows'])
+        return (abs(self.dx*self.dy)*4.0**level).reshape(self.X.shape)
+
+    @property
+    def raster_index(self):
+        """Lookup table giving the node that covers each cell of the base raster (flat, C order)"""
+        if self._raster_index is None:
+            ny, nx = self.raster_shape
+            b = self.blocks
+            index = np.empty(self.raster_shape, dtype='i8')
+            for blk in b:
+                B = self.block_size
+                f = 2**blk['level']
+                h = min(B, ny - blk['j0'])
+                w = min(B, nx - blk['i0'])
+                local = blk['start'] + np.arange(blk['ncols']*blk['nrows']).reshape(blk['nrows'], blk['ncols'])
+                local = np.repeat(np.repeat(local, f, axis=0), f, axis=1)
+                index[blk['j0']:blk['j0']+h, blk['i0']:blk['i0']+w] = local[:h, :w]
+            self._raster_index = index.ravel()
+        return self._raster_index
+
+    def to_raster(self, values):
+        """Return node values as a regular raster at the finest resolution
+        Arguments:
+            values (np.ndarray): values per node, shape (nnodes, ...) or (nnodes, 1, ...)
+        Returns:
+            raster (np.ndarray): shape raster_shape + trailing dimensions of values
+        """
+        values = np.asarray(values)
+        if values.ndim > 1 and values.shape[1] == 1:
+            values = values[:, 0]
+        return values[self.raster_index].reshape(self.raster_shape + values.shape[1:])
+
+    def edge_distance(self, valid):
+        """Return distance from each valid node to the nearest invalid area
+        Notes:
+            - Computed on a raster of the coarsest cell size, so the cost does not depend
+              on the finest resolution. Units are coarsest cells.
+        Arguments:
+            valid (np.ndarray): boolean array the shape of X
+        Returns:
+            D (np.ndarray): distance for each node, the shape of X
+        """
+        F = 2**self.max_level
+        icol, jrow = self._node_base_index()
+        ci = (icol//F).astype(int)
+        cj = (jrow//F).astype(int)
+        ny, nx = self.raster_shape
+        coarse = np.zeros((-(-ny//F), -(-nx//F)), dtype=bool)
+        coarse[cj[valid.ravel()], ci[valid.ravel()]] = True
+        D = distance_transform_edt(coarse)[cj, ci]
+        return (D*valid.ravel()).reshape(self.X.shape)
+
+
+def affine_from_origin(origin, rotation, dx, dy):
+    """Return affine coefficients (a, b, c, d, e, f) for a grid given its origin, rotation and spacing
+    Arguments:
+        origin (sequence): geographic (E, N) of node (0, 0)
+        rotation (float): angle of grid columns relative to geographic E, positive counter-clockwise, degrees
+        dx (float): node spacing along grid columns
+        dy (float): node spacing along grid rows (negative for north-up)
+    Returns:
+        transform (tuple): affine coefficients
+    """
+    ang = np.deg2rad(rotation)
+    return (dx*np.cos(ang), -dy*np.sin(ang), origin[0],
+            dx*np.sin(ang), dy*np.cos(ang), origin[1])
+
+
+def distort_UV(calibration, xyz):
+    """Return distorted image coordinates (Ud, Vd) and validity flag for world points
+    Notes:
+        - Pinhole projection with P, then the lcp radial and tangential distortion model
+        - flag is 0 for points outside the image, behind the camera, or where the
+          tangential distortion is larger than at the image corners
+    Arguments:
+        calibration (CameraCalibration): camera calibration
+        xyz (np.ndarray): (n, 3) local world coordinates
+    Returns:
+        Ud, Vd, flag (np.ndarray): (n,) arrays
+    """
+    # get UV for pinhole camera
+    xyz = np.vstack((
+        xyz.T,
+        np.ones((len(xyz),))
+    ))
+    UV = np.matmul(calibration.P, xyz)
+
+    # make homogenous
+    div = np.tile(UV[2, :], (3, 1))
+    UV = UV / div
+
+    # get and rename
+    NU = calibration.lcp['NU']
+    NV = calibration.lcp['NV']
+    c0U = calibration.lcp['c0U']
+    c0V = calibration.lcp['c0V']
+    fx = calibration.lcp['fx']
+    fy = calibration.lcp['fy']
+    d1 = calibration.lcp['d1']
+    d2 = calibration.lcp['d2']
+    d3 = calibration.lcp['d3']
+    t1 = calibration.lcp['t1']
+    t2 = calibration.lcp['t2']
+    u = UV[0, :]
+    v = UV[1, :]
+
+    # normalize distances
+    x = (u - c0U) / fx
+    y = (v - c0V) / fy
+    # radial distortion
+    r2 = x*x + y*y
+    fr = 1. + d1*r2 + d2*r2*r2 + d3*r2*r2*r2
+    # tangential distorion
+    dx=2.*t1*x*y + t2*(r2+2.*x*x)
+    dy=t1*(r2+2.*y*y) + 2.*t2*x*y
+    # apply correction, answer in chip pixel units
+    xd = x*fr + dx
+    yd = y*fr + dy
+    Ud = xd*fx+c0U
+    Vd = yd*fy+c0V
+
+    # Declare array for flagged values
+    flag = np.ones_like(Ud)
+
+    # find negative UV coordinates
+    flag[np.where( Ud<0.)]=0.
+    flag[np.where( Vd<0.)]=0.
+    # find UVd coordinates greater than image size
+    flag[np.where( Ud>=NU)]=0.
+    flag[np.where( Vd>=NV)]=0.
+
+    # Determine if Tangential Distortion is within Range
+    #  Find Maximum possible tangential distortion at corners
+    Um=np.array((0, 0, NU, NU))
+    Vm=np.array((0, NV, NV, 0))
+
+    # Normalization
+    xm = (Um-c0U)/fx
+    ym = (Vm-c0V)/fy
+    r2m = xm*xm + ym*ym
+
+    # Tangential Distortion
+    dxm=2.*t1*xm*ym + t2*(r2m+2.*xm*xm)
+    dym=t1*(r2m+2.*ym*ym) + 2.*t2*xm*ym
+
+    # Find Values Larger than those at corners
+    flag[np.where(np.abs(dy)>np.max(np.abs(dym)))]=0.
+    flag[np.where(np.abs(dx)>np.max(np.abs(dxm)))]=0.
+
+    # find negative Zc values and add to flag
+    xyzC = np.matmul(calibration.R,np.matmul(calibration.IC,xyz))
+    flag[np.where(xyzC[2,:]<=0.)]=0.
+    return Ud, Vd, flag
+
+
+class CameraStack(object):
+    """All cameras of a station stacked for projecting the same world points into every camera at once.
+    Notes:
+        - P matrices, lens parameters and the camera axis are stacked into (ncam, ...) arrays, and
+          N points are projected into every camera by one broadcast computation with the same
+          distortion model and flag logic as distort_UV.
+        - Points are processed in chunks so temporaries stay a few MB whatever N is.
+    Args:
+        calibrations (list): CameraCalibration of each camera
+    Attributes:
+        calibrations (list): CameraCalibration of each camera
+        key (tuple): calibration_key of each camera
+        P (np.ndarray): (ncam, 3, 4) projective matrices
+        lcp (dict): (ncam, 1) array of each LCP_KEYS value
+        axis (np.ndarray): (ncam, 3) camera viewing direction (third row of R)
+        center (np.ndarray): (ncam, 3) camera positions
+        max_dx, max_dy (np.ndarray): (ncam, 1) tangential distortion at the image corners
+    """
+    def __init__(self, calibrations):
+        self.calibrations = list(calibrations)
+        self.key = tuple(calibration_key(calibration) for calibration in self.calibrations)
+        self.P = np.stack([calibration.P for calibration in self.calibrations])
+        self.lcp = {k: np.array([[float(calibration.lcp[k])] for calibration in self.calibrations])
+                    for k in LCP_KEYS}
+        self.axis = np.stack([calibration.R[2] for calibration in self.calibrations])
+        self.center = np.stack([calibration.beta[:3] for calibration in self.calibrations])
+
+        # maximum possible tangential distortion, at the image corners
+        lcp = self.lcp
+        Um = np.array((0., 0., 1., 1.))*lcp['NU']
+        Vm = np.array((0., 1., 1., 0.))*lcp['NV']
+        xm = (Um - lcp['c0U'])/lcp['fx']
+        ym = (Vm - lcp['c0V'])/lcp['fy']
+        r2m = xm*xm + ym*ym
+        self.max_dx = np.abs(2.*lcp['t1']*xm*ym + lcp['t2']*(r2m + 2.*xm*xm)).max(axis=1, keepdims=True)
+        self.max_dy = np.abs(lcp['t1']*(r2m + 2.*ym*ym) + 2.*lcp['t2']*xm*ym).max(axis=1, keepdims=True)
+
+    def __len__(self):
+        return len(self.calibrations)
+
+    def _project_chunk(self, xyz):
+        lcp = self.lcp
+        UV = np.matmul(self.P[:, :, :3], xyz.T) + self.P[:, :, 3:]
+        u = UV[:, 0]/UV[:, 2]
+        v = UV[:, 1]/UV[:, 2]
+
+        # lcp radial and tangential distortion, as in distort_UV
+        x = (u - lcp['c0U'])/lcp['fx']
+        y = (v - lcp['c0V'])/lcp['fy']
+        r2 = x*x + y*y
+        fr = 1. + lcp['d1']*r2 + lcp['d2']*r2*r2 + lcp['d3']*r2*r2*r2
+        dx = 2.*lcp['t1']*x*y + lcp['t2']*(r2 + 2.*x*x)
+        dy = lcp['t1']*(r2 + 2.*y*y) + 2.*lcp['t2']*x*y
+        Ud = (x*fr + dx)*lcp['fx'] + lcp['c0U']
+        Vd = (y*fr + dy)*lcp['fy'] + lcp['c0V']
+
+        # in front of the camera
+        zc = np.matmul(self.axis, xyz.T) - np.sum(self.axis*self.center, axis=1, keepdims=True)
+        with np.errstate(invalid='ignore'):
+            valid = ((Ud >= 0.) & (Vd >= 0.) & (Ud < lcp['NU']) & (Vd < lcp['NV']) &
+                     (np.abs(dx) <= self.max_dx) & (np.abs(dy) <= self.max_dy) & (zc > 0.))
+        return Ud, Vd, valid
+
+    def project(self, xyz, chunk=65536):
+        """Project world points into every camera
+        Arguments:
+            xyz (np.ndarray): (N, 3) local world coordinates
+            chunk (int): points projected together
+        Returns:
+            Ud, Vd (np.ndarray): (ncam, N) distorted image coordinates
+            valid (np.ndarray): (ncam, N) boolean, the flag of distort_UV
+        """
+        xyz = np.atleast_2d(np.asarray(xyz, dtype='float64'))
+        n = len(xyz)
+        Ud = np.empty((len(self), n))
+        Vd = np.empty((len(self), n))
+        valid = np.empty((len(self), n), dtype=bool)
+        for i in range(0, n, chunk):
+            Ud[:, i:i + chunk], Vd[:, i:i + chunk], valid[:, i:i + chunk] = self._project_chunk(xyz[i:i + chunk])
+        return Ud, Vd, valid
+
+    def coverage(self, xyz):
+        """Return the number of cameras that see each world point"""
+        return self.project(xyz)[2].sum(axis=0)
+
+
+def calibration_key(calibration):
+    """Return the key of a calibration used by every cache derived from it
+    Notes:
+        - The content hash of the calibration inputs (calibration_hash), so calibrations
+          rebuilt from the same YAML share cached lookup tables, weights and footprints
+    """
+    return calibration.key
+
+
+def lcp_key(lcp):
+    """Return a key identifying a lens model, for caches that only depend on the intrinsics"""
+    return hashlib.sha1(repr([float(lcp[k]) for k in LCP_KEYS]).encode()).hexdigest()
+
+
+def read_image(image_file, fs=None, scale=1):
+    """Read an image from the file system or from S3 with fsspec
+    Notes:
+        - scale of 2, 4 or 8 has libjpeg decode a reduced image in the DCT domain (PIL draft),
+          which is much faster than a full decode. Other formats are decoded at full size,
+          so compare the shape of the result with image_size to get the scale used.
+    """
+    if scale == 1:
+        if fs:
+            # using fsspec for S3 files
+            with fs.open(image_file) as f:
+                image = imageio.imread(f)
+        else:
+            # regular file system
+            image = imageio.imread(image_file)
+        return image
+
+    if fs:
+        with fs.open(image_file) as f:
+            im = Image.open(io.BytesIO(f.read()))
+    else:
+        im = Image.open(image_file)
+    im.draft(im.mode, (im.size[0]//scale, im.size[1]//scale))
+    return np.asarray(im)
+
+
+def image_size(image_file, fs=None):
+    """Return (rows, columns) of an image from its header, without decoding it"""
+    if fs:
+        with fs.open(image_file) as f:
+            width, height = Image.open(f).size
+    else:
+        width, height = Image.open(image_file).size
+    return height, width
+
+
+def decode_scale(U, V, valid):
+    """Return the coarsest JPEG decode scale (1, 2, 4 or 8) that still meets the grid sampling density
+    Notes:
+        - Every grid cell covers |det(J)| image pixels, from the differences of U and V
+          between neighbouring cells. Decoding at 1/s keeps at least one decoded pixel per
+          cell wherever that area is at least s**2.
+        - Only defined for 2-D grids; other grids always decode at full size.
+    Arguments:
+        U, V (np.ndarray): lookup table image coordinates on the grid
+        valid (np.ndarray): cells seen by the camera
+    Returns:
+        scale (int)
+    """
+    if U.ndim != 2 or min(U.shape) < 2:
+        return 1
+    dU0 = np.diff(U, axis=0)[:, :-1]
+    dV0 = np.diff(V, axis=0)[:, :-1]
+    dU1 = np.diff(U, axis=1)[:-1]
+    dV1 = np.diff(V, axis=1)[:-1]
+    cells = valid[1:, 1:] & valid[:-1, 1:] & valid[1:, :-1] & valid[:-1, :-1]
+    if not cells.any():
+        return 1
+    area = np.abs(dU0*dV1 - dU1*dV0)[cells].min()
+    for scale in (8, 4, 2):
+        if scale*scale <= area:
+            return scale
+    return 1
+
+
+def bilinear_sample(image, U, V):
+    """Return bilinear image values at (U, V), NaN outside the image
+    Notes:
+        - Same valid range and result as get_pixels with 'rgi', but only for the given points
+    Arguments:
+        image (np.ndarray [nv, nu, nc]): image
+        U, V (np.ndarray): (n,) pixel coordinates
+    Returns:
+        K (np.ndarray): (n, nc) pixel values
+    """
+    nv, nu = image.shape[:2]
+    image = image.reshape(nv, nu, -1)
+    with np.errstate(invalid='ignore'):
+        valid = (U > 1) & (U <= nu - 1) & (V > 1) & (V <= nv - 1)
+    u = U[valid]
+    v = V[valid]
+    i = np.minimum(u.astype(int), nu - 2)
+    j = np.minimum(v.astype(int), nv - 2)
+    fu = (u - i)[:, np.newaxis]
+    fv = (v - j)[:, np.newaxis]
+    K = np.full((len(U), image.shape[2]), np.nan)
+    K[valid] = ((1 - fv)*((1 - fu)*image[j, i] + fu*image[j, i + 1]) +
+                fv*((1 - fu)*image[j + 1, i] + fu*image[j + 1, i + 1]))
+    return K
+
+
+class PointSampler(object):
+    """Samples images at arbitrary world points (e.g. cross-shore transects).
+    Notes:
+        - Points are projected once per calibration with distort_UV, the same distortion
+          and flag logic used by Rectifier, and the result is cached.
+        - Cost scales with the number of points, not the area of a grid.
+    Args:
+        xyz (np.ndarray) - (n, 3) local coordinates of the points
+        ncolors (int) - Number of colors in camera images.
+    Attributes:
+        xyz (np.ndarray): (n, 3) local coordinates of the points
+        transect_start (np.ndarray): index of the first point of each transect (from_transects only)
+        lookup (dict): (U, V, flag) for each calibration, keyed by calibration_key
+    """
+    def __init__(self, xyz, ncolors=3):
+        self.xyz = np.atleast_2d(np.asarray(xyz, dtype='float64'))
+        self.ncolors = ncolors
+        self.transect_start = np.array([0])
+        self.lookup = {}
+
+    @classmethod
+    def from_transects(cls, transects, spacing=1., z=-0.91, ncolors=3):
+        """Make a sampler with points every spacing along straight transects
+        Arguments:
+            transects (list): ((x0, y0), (x1, y1)) endpoints of each transect in local coordinates
+            spacing (float): distance between points along each transect
+            z (float): elevation of the points
+        """
+        xyz = []
+        start = [0]
+        for (x0, y0), (x1, y1) in transects:
+            n = int(np.floor(np.hypot(x1 - x0, y1 - y0)/spacing)) + 1
+            s = np.linspace(0., 1., n) if n > 1 else np.zeros(1)
+            xyz.append(np.column_stack((x0 + s*(x1 - x0), y0 + s*(y1 - y0), np.full(n, z))))
+            start.append(start[-1] + n)
+        sampler = cls(np.vstack(xyz), ncolors)
+        sampler.transect_start = np.array(start[:-1])
+        return sampler
+
+    def split(self, values, axis=None):
+        """Split per-point values into a list with one array per transect
+        Arguments:
+            values (np.ndarray): values with one entry per point along one axis, e.g. (n,), (n, ncolors)
+                from sample, (nimages, n) or (nimages, n, ncolors) from sample_images
+            axis (int): the points axis. By default the second last axis if the last one holds the
+                colors, otherwise the last axis with one entry per point.
+        Returns:
+            parts (list): values of each transect
+        """
+        values = np.asarray(values)
+        if axis is None:
+            n = len(self.xyz)
+            if values.ndim > 1 and values.shape[-1] == self.ncolors and values.shape[-2] == n:
+                axis = -2
+            elif values.shape[-1] == n:
+                axis = -1
+            else:
+                points_axes = [i for i, size in enumerate(values.shape) if size == n]
+                if not points_axes:
+                    raise ValueError(f'no axis of values {values.shape} has one entry for each of the {n} points')
+                axis = points_axes[-1]
+        return np.split(values, self.transect_start[1:], axis=axis)
+
+    def project(self, calibration):
+        """Return cached (U, V, flag) of the points for a calibration"""
+        key = calibration_key(calibration)
+        if key not in self.lookup:
+            self.lookup[key] = distort_UV(calibration, self.xyz)
+        return self.lookup[key]
+
+    def project_all(self, calibrations):
+        """Project the points into every calibration not cached yet with one CameraStack call"""
+        missing = {}
+        for calibration in calibrations:
+            key = calibration_key(calibration)
+            if key not in self.lookup:
+                missing[key] = calibration
+        if missing:
+            Ud, Vd, valid = CameraStack(missing.values()).project(self.xyz)
+            for i, key in enumerate(missing):
+                self.lookup[key] = (Ud[i], Vd[i], valid[i].astype(np.float64))
+
+    def sample(self, calibration, image):
+        """Return (n, ncolors) image values at the points, NaN where not seen by the camera"""
+        U, V, flag = self.project(calibration)
+        K = bilinear_sample(image, U*flag, V*flag)
+        return K[:, :self.ncolors]
+
+    def sample_images(self, image_files, calibrations, fs=None):
+        """Sample any number of images at the points
+        Arguments:
+            image_files (list): List of image files
+            calibrations (list): CameraCalibration for each image file. Images from the
+                same camera share the cached projection.
+            fs: (object): fsspec file spec object for folder on S3 bucket. If none, normal file system will be used.
+        Returns:
+            K (np.ndarray): (nimages, n, ncolors) pixel values
+        """
+        K = np.full((len(image_files), len(self.xyz), self.ncolors), np.nan)
+        self.project_all(calibrations)
+        for i, (image_file, calibration) in enumerate(zip(image_files, calibrations)):
+            K[i] = self.sample(calibration, read_image(image_file, fs))
+        return K
+
+
+class UndistortionRemap(object):
+    """Maps raw camera frames to lens-corrected (undistorted) frames with the same K.
+    Notes:
+        - Built once from the intrinsics: every output pixel is pushed through lcp_distort to
+          find where it lies in the raw frame, and its four neighbouring raw pixels and bilinear
+          weights are stored as one row of a sparse matrix. Undistorting is then a single sparse
+          product, and a batch of frames is one product with more columns.
+        - Use undistortion_remap to get the cached remap of a lens.
+        - Output pixels that fall outside the raw frame are 0.
+    Args:
+        lcp (dict) - Lens Calibration Profile (intrinsics)
+        shape (tuple) - (rows, columns) of the frames, default (NV, NU). Frames of another size
+            (e.g. reduced decodes) have the lens model scaled to them.
+    Attributes:
+        shape (tuple): (rows, columns) of the frames
+        matrix (scipy.sparse.csr_matrix): (npixels, npixels) gather matrix, float32
+        valid (np.ndarray): output pixels inside the raw frame
+    """
+    def __init__(self, lcp, shape=None):
+        if shape is None:
+            shape = (int(lcp['NV']), int(lcp['NU']))
+        self.shape = tuple(int(n) for n in shape[:2])
+        nv, nu = self.shape
+        scale = nu/float(lcp['NU'])
+
+        # undistorted output pixel centers in full-size normalized coordinates
+        v, u = np.mgrid[0:nv, 0:nu]
+        x = ((u.ravel() + 0.5)/scale - 0.5 - lcp['c0U'])/lcp['fx']
+        y = ((v.ravel() + 0.5)/scale - 0.5 - lcp['c0V'])/lcp['fy']
+        xd, yd = lcp_distort(lcp, x, y)
+        Ud = ((xd*lcp['fx'] + lcp['c0U']) + 0.5)*scale - 0.5
+        Vd = ((yd*lcp['fy'] + lcp['c0V']) + 0.5)*scale - 0.5
+
+        # a small tolerance so the border pixels are not lost to round-off (e.g. no distortion
+        # maps column 0 to -1e-13), then clipped into the frame for the neighbour indices
+        tol = 1e-6
+        self.valid = (Ud >= -tol) & (Ud <= nu - 1 + tol) & (Vd >= -tol) & (Vd <= nv - 1 + tol)
+        rows = np.flatnonzero(self.valid)
+        Ud = np.clip(Ud[rows], 0, nu - 1)
+        Vd = np.clip(Vd[rows], 0, nv - 1)
+        i = np.minimum(np.floor(Ud), nu - 2).astype(np.int32)
+        j = np.minimum(np.floor(Vd), nv - 2).astype(np.int32)
+        wu = (Ud - i).astype(np.float32)
+        wv = (Vd - j).astype(np.float32)
+        base = j*nu + i
+        columns = np.column_stack((base, base + 1, base + nu, base + nu + 1))
+        weights = np.column_stack(((1 - wu)*(1 - wv), wu*(1 - wv), (1 - wu)*wv, wu*wv))
+        indptr = np.zeros(nv*nu + 1, dtype=np.int64)
+        indptr[rows + 1] = 4
+        self.matrix = csr_matrix((weights.ravel(), columns.ravel(), np.cumsum(indptr)),
+                                 shape=(nv*nu, nv*nu))
+
+    def apply(self, images):
+        """Return undistorted frames
+        Arguments:
+            images (np.ndarray): one frame (rows, columns[, colors]) or a stack (nimages, rows, columns[, colors])
+        Returns:
+            undistorted (np.ndarray): same shape and dtype as images
+        """
+        images = np.asarray(images)
+        stacked = images.ndim == 4 or (images.ndim == 3 and images.shape[1:] == self.shape)
+        frames = images if stacked else images[np.newaxis]
+        # pixels down the rows, every color of every frame across the columns
+        npixels = self.shape[0]*self.shape[1]
+        flat = np.moveaxis(frames.reshape(len(frames), npixels, -1), 0, 1).reshape(npixels, -1)
+        out = self.matrix @ flat
+        if np.issubdtype(images.dtype, np.integer):
+            out = np.rint(out)
+        out = np.moveaxis(out.reshape(npixels, len(frames), -1), 1, 0).astype(images.dtype)
+        out = out.reshape(frames.shape)
+        return out if stacked else out[0]
+
+    def undistort_files(self, image_files, output_files, fs=None, batch_size=8):
+        """Undistort image files in batches and write the results
+        Arguments:
+            image_files (list): raw frames of this camera (e.g. a whole day)
+            output_files (list): file to write for each raw frame (format from the extension)
+            fs: (object): fsspec file spec object for folder on S3 bucket. If none, normal file system will be used.
+            batch_size (int): frames undistorted together
+        """
+        for start in range(0, len(image_files), batch_size):
+            batch = image_files[start:start + batch_size]
+            frames = self.apply(np.stack([read_image(image_file, fs) for image_file in batch]))
+            for frame, output_file in zip(frames, output_files[start:start + batch_size]):
+                imageio.imwrite(output_file, frame)
+
+
+# undistortion remaps by lens and frame size, shared by every user in the process
+_UNDISTORTION_REMAPS = {}
+
+
+def undistortion_remap(lcp, shape=None):
+    """Return the cached UndistortionRemap of a lens for frames of a given (rows, columns)"""
+    if shape is None:
+        shape = (int(lcp['NV']), int(lcp['NU']))
+    key = (lcp_key(lcp), tuple(shape[:2]))
+    if key not in _UNDISTORTION_REMAPS:
+        _UNDISTORTION_REMAPS[key] = UndistortionRemap(lcp, shape)
+    return _UNDISTORTION_REMAPS[key]
+
+
+class FrameStabilizer(object):
+    """Measures how far a camera's view has moved from a reference frame.
+    Notes:
+        - Frames are reduced to grayscale and block-averaged by factor, then registered to the
+          reference by FFT phase correlation, with the sub-pixel peak from the larger neighbour
+          (the phase correlation peak is sinc shaped, Foroosh et al. 2002). The reference
+          spectrum is computed once, so each frame costs one small FFT pair.
+        - Frames may be decoded at any scale (e.g. reduced decodes); shifts are always returned
+          in full-size pixels.
+        - Shifts are of the image content: a feature at U in the reference is at U + dU in the frame.
+    Args:
+        reference (np.ndarray): reference frame of the camera (e.g. the timex used for calibration)
+        shape (tuple): (rows, columns) of full-size frames, default reference.shape
+        factor (int): decimation of full-size frames before correlating
+        min_peak (float): correlation peak below which a measurement is not trusted
+        max_shift (float): largest shift, in full-size pixels, that is trusted
+    Attributes:
+        shape (tuple): (rows, columns) of full-size frames
+        size (tuple): (rows, columns) of the decimated frames
+    """
+    def __init__(self, reference, shape=None, factor=8, min_peak=0.05, max_shift=40.):
+        self.shape = tuple(reference.shape[:2]) if shape is None else tuple(shape[:2])
+        self.size = (self.shape[0]//factor, self.shape[1]//factor)
+        self.min_peak = min_peak
+        self.max_shift = max_shift
+        self.window = np.outer(np.hanning(self.size[0]), np.hanning(self.size[1])).astype(np.float32)
+        self.reference = np.conj(np.fft.rfft2(self._small(reference)))
+
+    def _small(self, image):
+        """Return the windowed, zero-mean, decimated grayscale frame"""
+        rows, columns = self.size
+        fv = image.shape[0]//rows
+        fu = image.shape[1]//columns
+        block = image[:rows*fv, :columns*fu]
+        if block.ndim == 3:
+            block = block[:, :, :3]
+            small = block.reshape(rows, fv, columns, fu, -1).mean(axis=(1, 3, 4), dtype=np.float32)
+        else:
+            small = block.reshape(rows, fv, columns, fu).mean(axis=(1, 3), dtype=np.float32)
+        return (small - small.mean())*self.window
+
+    def measure(self, image):
+        """Return the shift of a frame from the reference
+        Arguments:
+            image (np.ndarray): frame at any decode scale
+        Returns:
+            dU, dV (float): shift in full-size pixels, 0 if the measurement is not trusted
+            peak (float): phase correlation peak (1 for a perfect match)
+        """
+        cross = np.fft.rfft2(self._small(image))*self.reference
+        cross /= np.maximum(np.abs(cross), 1e-12)
+        r = np.fft.irfft2(cross, s=self.size)
+        j, i = np.unravel_index(np.argmax(r), r.shape)
+        peak = float(r[j, i])
+        shift = []
+        for k, n, line in ((i, self.size[1], r[j, :]), (j, self.size[0], r[:, i])):
+            # peak and its (wrapped) neighbours
+            lo, hi = line[(k - 1) % n], line[(k + 1) % n]
+            if hi > lo:
+                offset = hi/(hi + peak)
+            else:
+                offset = -lo/(lo + peak)
+            shift.append(((k + n//2) % n - n//2) + offset)
+        dU = shift[0]*self.shape[1]/self.size[1]
+        dV = shift[1]*self.shape[0]/self.size[0]
+        if peak < self.min_peak or np.hypot(dU, dV) > self.max_shift:
+            return 0., 0., peak
+        return dU, dV, peak
+
+
+# 5-tap binomial kernel of the Burt and Adelson pyramid
+PYRAMID_KERNEL = np.array([1., 4., 6., 4., 1.])/16.
+
+
+def _smooth(a):
+    """Smooth the first two axes of an array with PYRAMID_KERNEL"""
+    a = convolve1d(a, PYRAMID_KERNEL, axis=0, mode='nearest')
+    return convolve1d(a, PYRAMID_KERNEL, axis=1, mode='nearest')
+
+
+def pyramid_shapes(shape, nlevels):
+    """Return the (rows, columns) of each pyramid level, finest first"""
+    shapes = [tuple(shape[:2])]
+    for _ in range(nlevels - 1):
+        shapes.append(((shapes[-1][0] + 1)//2, (shapes[-1][1] + 1)//2))
+    return shapes
+
+
+def pyramid_reduce(a):
+    """Blur and decimate the first two axes of an array by two"""
+    return _smooth(a)[::2, ::2]
+
+
+def pyramid_expand(a, shape, norm=None):
+    """Upsample the first two axes of an array to shape by zero insertion and blurring
+    Notes:
+        - norm is the blurred zero-inserted array of ones (computed if None); dividing
+          by it keeps the borders unbiased
+    """
+    up = np.zeros(tuple(shape) + a.shape[2:])
+    up[::2, ::2] = a
+    if norm is None:
+        ones = np.zeros(tuple(shape))
+        ones[::2, ::2] = 1.
+        norm = _smooth(ones)
+    up = _smooth(up)
+    return up/norm.reshape(norm.shape + (1,)*(up.ndim - 2))
+
+
+class MergeAccumulator(object):
+    """Unnormalised merge of rectified images for one timestamp.
+    Notes:
+        - Holds the running sums of weighted pixel intensities (M) and weights (totalW), so
+          cameras can be added as their images arrive and the merge renormalised at any time.
+        - Saved as float32 in a compressed .npz, which is the persisted state for a timestamp.
+          Keys are saved as JSON strings; states saved with calibration_key alone load with
+          unknown ('') keys.
+    Args:
+        shape (tuple) - shape of the target grid
+        ncolors (int) - Number of colors in camera images.
+    Attributes:
+        M (np.ndarray): sum of weighted pixel intensities, shape + (ncolors,)
+        totalW (np.ndarray): sum of weights, shape
+        cameras (list): cameras included in the sums
+        keys (list): camera_lookup key of each camera, (calibration_key, image shape, mask hash),
+            or '' if unknown
+    """
+    def __init__(self, shape, ncolors=3):
+        self.M = np.zeros(tuple(shape) + (ncolors,))
+        self.totalW = np.zeros(tuple(shape))
+        self.cameras = []
+        self.keys = []
+
+    def add(self, K_weighted, W, camera, key=''):
+        """Add one camera's weighted pixel intensities and weights"""
+        K_weighted = np.where(np.isnan(K_weighted), 0., K_weighted)
+        self.M += K_weighted
+        self.totalW += W
+        self.cameras.append(camera)
+        self.keys.append(key)
+
+    def update(self, other):
+        """Add the sums of another MergeAccumulator (e.g. a camera that arrived later)"""
+        self.M += other.M
+        self.totalW += other.totalW
+        self.cameras.extend(other.cameras)
+        self.keys.extend(other.keys)
+
+    def merged(self):
+        """Return the normalised merge as uint8"""
+        # stop divide by 0 warnings
+        with np.errstate(invalid='ignore'):
+            M = self.M / self.totalW[..., np.newaxis]
+
+        #TODO - is there any need to retain the NaNs, or is replacing by zero ok?
+        M[np.isnan(M)]=0
+        # balanced exposures can move values slightly outside the uint8 range
+        return np.clip(M, 0, 255).astype(np.uint8)
+
+    def save(self, file):
+        """Save the sums to a compressed .npz file (path or file object)"""
+        np.savez_compressed(file,
+                            M=self.M.astype(np.float32),
+                            totalW=self.totalW.astype(np.float32),
+                            cameras=np.array(self.cameras, dtype=str),
+                            keys=np.array([json.dumps(k) for k in self.keys], dtype=str))
+
+    @classmethod
+    def load(cls, file):
+        """Load a MergeAccumulator saved with save()"""
+        with np.load(file) as data:
+            accumulator = cls(data['totalW'].shape, data['M'].shape[-1])
+            accumulator.M += data['M']
+            accumulator.totalW += data['totalW']
+            accumulator.cameras = [str(c) for c in data['cameras']]
+            accumulator.keys = ['']*len(accumulator.cameras)
+            if 'keys' in data:
+                for i, k in enumerate(data['keys']):
+                    try:
+                        k = json.loads(str(k))
+                    except ValueError:
+                        continue
+                    if isinstance(k, list) and len(k) == 3:
+                        accumulator.keys[i] = (k[0], tuple(k[1]), k[2])
+        return accumulator
+
+
+# provenance band values of a merge filled from the recent-frame cache
+PROVENANCE_NONE = 0
+PROVENANCE_LIVE = 1
+PROVENANCE_CACHE = 2
+
+
+class CachedFrame(object):
+    """Last rectified pixels of one camera, kept to fill its area when the camera misses a timestamp.
+    Notes:
+        - Stored compactly as uint8 pixels plus a packed validity mask.
+    Args:
+        camera (str) - camera name (e.g. 'C1')
+        time (float) - unix time of the image the pixels came from
+        K (np.ndarray) - rectified pixels, uint8, grid shape + (ncolors,)
+        valid (np.ndarray) - boolean, grid shape, cells the camera saw
+    """
+    def __init__(self, camera, time, K, valid):
+        self.camera = camera
+        self.time = time
+        self.K = K
+        self.valid = valid
+
+    @classmethod
+    def from_accumulator(cls, accumulator, time):
+        """Make a CachedFrame from a single-camera MergeAccumulator"""
+        valid = accumulator.totalW > 0
+        return cls(accumulator.cameras[0], time, accumulator.merged(), valid)
+
+    def save(self, file):
+        """Save to a compressed .npz file (path or file object)"""
+        np.savez_compressed(file,
+                            camera=np.array(self.camera, dtype=str),
+                            time=np.array(self.time, dtype=np.float64),
+                            K=self.K.astype(np.uint8),
+                            valid=np.packbits(self.valid.ravel()),
+                            shape=np.array(self.valid.shape))
+
+    @classmethod
+    def load(cls, file):
+        """Load a CachedFrame saved with save()"""
+        with np.load(file) as data:
+            shape = tuple(data['shape'])
+            valid = np.unpackbits(data['valid'])[:int(np.prod(shape))].astype(bool).reshape(shape)
+            return cls(str(data['camera']), float(data['time']), data['K'], valid)
+
+
+class RectifiedTile(object):
+    """One camera's rectified pixels, cropped to the bounding box of its footprint.
+    Notes:
+        - Made from pixels the merge has already sampled, so it costs a crop and a cast.
+        - window gives the target grid rows and columns the tile covers, so the tiles of
+          every camera line up with each other and with the merge.
+        - Saved as a PNG with an alpha band (0 outside the footprint), rows flipped so north
+          is up like the merge products, and the camera and window in text chunks.
+    Args:
+        camera (str) - camera name (e.g. 'C1')
+        window (tuple) - (row0, row1, col0, col1) slice bounds of the tile in the target grid
+        K (np.ndarray) - rectified pixels, uint8, tile shape + (ncolors,)
+        valid (np.ndarray) - boolean, tile shape, cells the camera saw
+    """
+    def __init__(self, camera, window, K, valid):
+        self.camera = camera
+        self.window = tuple(int(w) for w in window)
+        self.K = K
+        self.valid = valid
+
+    @classmethod
+    def from_pixels(cls, camera, K, valid):
+        """Make a RectifiedTile from sampled pixels (NaN where not seen) on the whole grid"""
+        rows = np.flatnonzero(valid.any(axis=1))
+        cols = np.flatnonzero(valid.any(axis=0))
+        if len(rows) == 0:
+            window = (0, 0, 0, 0)
+        else:
+            window = (rows[0], rows[-1] + 1, cols[0], cols[-1] + 1)
+        K = K[window[0]:window[1], window[2]:window[3]]
+        valid = valid[window[0]:window[1], window[2]:window[3]]
+        K = np.clip(np.where(valid[..., np.newaxis], K, 0), 0, 255).astype(np.uint8)
+        return cls(camera, window, K, valid)
+
+    def save(self, file):
+        """Save as a PNG (path or file object)"""
+        bands = np.concatenate([self.K, 255*self.valid[..., np.newaxis].astype(np.uint8)], axis=-1)
+        info = PngImagePlugin.PngInfo()
+        info.add_text('camera', str(self.camera))
+        info.add_text('window', ' '.join(str(w) for w in self.window))
+        Image.fromarray(np.ascontiguousarray(np.flip(bands, 0))).save(file, format='PNG', pnginfo=info)
+
+    @classmethod
+    def load(cls, file):
+        """Load a RectifiedTile saved with save()"""
+        with Image.open(file) as img:
+            bands = np.flip(np.asarray(img), 0)
+            camera = img.text['camera']
+            window = [int(w) for w in img.text['window'].split()]
+        return cls(camera, window, bands[..., :-1], bands[..., -1] > 0)
+
 
 class Rectifier(object):
     """Georectifies an oblique image given RectifierGrid and ncolors.
@@ -47,95 +1081,309 @@ class Rectifier(object):
         target_grid (TargetGrid): Params and grid used to create georectified image.
         camera_calibration (CameraCalibration): CameraCalibration including intrinsic (LCP) and extrinsic (Beta) coefficients.
         ncolors (int): Number of colors in camera images.
+        reduced_decode (bool): decode images at the decode_scale of their lookup table ('rgi' only)
         U (np.ndarray): horizontal image coordinates
         V (np.ndarray): vertical image coordinates (increasing down)
+        quality_scores (dict): cached image_quality score for each image file version (path, size, modified time),
+            the newest max_quality_scores kept
+        lookup (dict): cached lookup tables (U, V, valid and weights) for each calibration and image size
+        seams (dict): cached multi-band blending structures for each combination of calibrations
+        overlaps (dict): cached flat indices of grid cells seen by each pair of cameras
+        resolutions (dict): cached ground resolution maps for each calibration
+        uncertainties (dict): cached positional uncertainty maps for each calibration and set of uncertainties
     """
-    def __init__(self, target_grid, ncolors=3):
+    # quality scores kept for a warm container, which sees a new image at each /tmp path
+    max_quality_scores = 256
+
+    def __init__(self, target_grid, ncolors=3, reduced_decode=True):
         self.target_grid = target_grid
         self.ncolors = ncolors
+        # decode JPEGs at the coarsest scale the grid can use (see decode_scale)
+        self.reduced_decode = reduced_decode
+        # image_quality score for each image file, so re-merging does not re-score
+        self.quality_scores = {}
+        # geometry only depends on the calibration, so it is computed once and reused for every image
+        self.lookup = {}
+        self.seams = {}
+        self.overlaps = {}
+        self.resolutions = {}
+        self.uncertainties = {}
 
     def _find_distort_UV(self, calibration):
-        # get UV for pinhole camera
-        xyz = np.vstack((
-            self.target_grid.xyz.T,
-            np.ones((len(self.target_grid.xyz),))
-        ))
-        UV = np.matmul(calibration.P, xyz)
-
-        # make homogenous
-        div = np.tile(UV[2, :], (3, 1))
-        UV = UV / div
-
-        # get and rename
-        NU = calibration.lcp['NU']
-        NV = calibration.lcp['NV']
-        c0U = calibration.lcp['c0U']
-        c0V = calibration.lcp['c0V']
-        fx = calibration.lcp['fx']
-        fy = calibration.lcp['fy']
-        d1 = calibration.lcp['d1']
-        d2 = calibration.lcp['d2']
-        d3 = calibration.lcp['d3']
-        t1 = calibration.lcp['t1']
-        t2 = calibration.lcp['t2']
-        u = UV[0, :]
-        v = UV[1, :]
-
-        # normalize distances
-        x = (u - c0U) / fx
-        y = (v - c0V) / fy
-        # radial distortion
-        r2 = x*x + y*y
-        fr = 1. + d1*r2 + d2*r2*r2 + d3*r2*r2*r2
-        # tangential distorion
-        dx=2.*t1*x*y + t2*(r2+2.*x*x)
-        dy=t1*(r2+2.*y*y) + 2.*t2*x*y
-        # apply correction, answer in chip pixel units
-        xd = x*fr + dx
-        yd = y*fr + dy
-        Ud = xd*fx+c0U
-        Vd = yd*fy+c0V
-
-        # Declare array for flagged values
-        flag = np.ones_like(Ud)
-
-        # find negative UV coordinates
-        flag[np.where( Ud<0.)]=0.
-        flag[np.where( Vd<0.)]=0.
-        # find UVd coordinates greater than image size
-        flag[np.where( Ud>=NU)]=0.
-        flag[np.where( Vd>=NV)]=0.
-
-        # Determine if Tangential Distortion is within Range
-        #  Find Maximum possible tangential distortion at corners
-        Um=np.array((0, 0, NU, NU))
-        Vm=np.array((0, NV, NV, 0))
-
-        # Normalization
-        xm = (Um-c0U)/fx
-        ym = (Vm-c0V)/fy
-        r2m = xm*xm + ym*ym
-
-        # Tangential Distortion
-        dxm=2.*t1*xm*ym + t2*(r2m+2.*xm*xm)
-        dym=t1*(r2m+2.*ym*ym) + 2.*t2*xm*ym
-
-        # Find Values Larger than those at corners
-        flag[np.where(np.abs(dy)>np.max(np.abs(dym)))]=0.
-        flag[np.where(np.abs(dx)>np.max(np.abs(dxm)))]=0.
+        Ud, Vd, flag = distort_UV(calibration, self.target_grid.xyz)
 
         DU = Ud.reshape(self.target_grid.X.shape, order='F')
         DV = Vd.reshape(self.target_grid.Y.shape, order='F')
-
-        # find negative Zc values and add to flag
-        UV = np.matmul(calibration.P, xyz)
-        xyzC = np.matmul(calibration.R,np.matmul(calibration.IC,xyz))
-        flag[np.where(xyzC[2,:]<=0.)]=0.
         flag = flag.reshape(self.target_grid.X.shape, order='F')
-        
+
         # apply the flag to zero-out non-valid points
         return DU*flag, DV*flag, flag
 
+    def camera_lookup(self, calibration, image_shape, mask=None):
+        """Return the cached lookup table of a calibration for images of a given size
+        Notes:
+            - valid matches the cells get_pixels returns values for, and W is the weight
+              assemble_image_weights would return, so neither needs the image itself
+            - A static obstruction mask (image-space, 0 where pilings, railings etc. block
+              the view) is sampled once at the grid and ANDed into flag, so masked cells are
+              never sampled and are feathered around like the footprint edge.
+        Arguments:
+            calibration (CameraCalibration): camera calibration
+            image_shape (tuple): shape of the camera images
+            mask (np.ndarray): optional obstruction mask, any size with the image aspect ratio
+        Returns:
+            lookup (dict): 'key', 'U', 'V', 'flag', 'valid', 'index' (flat indices of valid
+                cells), 'W', 'decode_scale' and the 'calibration' for the target grid
+        """
+        mask_key = None if mask is None else hashlib.sha1(np.ascontiguousarray(mask)).hexdigest()
+        key = (calibration_key(calibration), tuple(image_shape[:2]), mask_key)
+        if key not in self.lookup:
+            U, V, flag = self._find_distort_UV(calibration)
+            if mask is not None:
+                # nearest mask pixel for every grid cell seen by the camera
+                seen = flag > 0
+                mi = np.clip(np.round(U[seen]*mask.shape[1]/image_shape[1]).astype(int), 0, mask.shape[1] - 1)
+                mj = np.clip(np.round(V[seen]*mask.shape[0]/image_shape[0]).astype(int), 0, mask.shape[0] - 1)
+                flag[seen] = flag[seen]*(mask[mj, mi] > 0)
+                U = U*flag
+                V = V*flag
+            with np.errstate(invalid='ignore'):
+                valid = ((U > 1) & (U <= image_shape[1] - 1) &
+                         (V > 1) & (V <= image_shape[0] - 1))
+            W = self.target_grid.edge_distance(valid).astype(np.float64)
+            # Not sure when this would happen, but included because it's in the MATLAB code
+            if np.isinf(np.max(W)):
+                W[:] = 1
+            W = W / np.max(W)
+            self.lookup[key] = {'key': key, 'U': U, 'V': V, 'flag': flag, 'valid': valid,
+                                'index': np.flatnonzero(valid), 'W': W,
+                                'decode_scale': decode_scale(U, V, valid),
+                                'calibration': calibration}
+        return self.lookup[key]
+
+    def angle_jacobian(self, lookup):
+        """Return d(U, V)/d(azimuth, tilt) at the valid cells of a lookup table
+        Notes:
+            - Analytic Jacobian of the projection (extrinsic_solver.project_points), computed
+              once and kept in the lookup table with the sums stabilized_lookup needs.
+        Returns:
+            J (dict): 'U', 'V' ((len(index), 2) derivatives of U and V), 'normal' (2x2 sum of
+                J^T J over the cells) and 'sum_U', 'sum_V' (column sums)
+        """
+        if 'angle_jacobian' not in lookup:
+            # lookup arrays are grid shaped (Fortran order of xyz), index is C order
+            i, j = np.unravel_index(lookup['index'], lookup['valid'].shape)
+            xyz = self.target_grid.xyz[i + j*lookup['valid'].shape[0]]
+            calibration = lookup['calibration']
+            J = project_points(calibration.beta, calibration.lcp, xyz, jacobian=True)[3][0]
+            JU = np.ascontiguousarray(J[:, 0, 3:5])
+            JV = np.ascontiguousarray(J[:, 1, 3:5])
+            lookup['angle_jacobian'] = {'U': JU, 'V': JV, 'normal': JU.T @ JU + JV.T @ JV,
+                                        'sum_U': JU.sum(axis=0), 'sum_V': JV.sum(axis=0)}
+        return lookup['angle_jacobian']
+
+    def stabilized_lookup(self, lookup, dU, dV):
+        """Return a lookup table corrected for a measured camera motion
+        Notes:
+            - The shift is turned into the azimuth and tilt change that best explains it over
+              the camera's footprint, and U, V of the valid cells are moved by the first-order
+              change that pose causes. Nothing is re-projected.
+            - valid, W and the key are unchanged so cached seams and overlaps still apply;
+              cells moved past the image edge sample the edge.
+        Arguments:
+            lookup (dict): lookup table from camera_lookup
+            dU, dV (float): shift of the frame in full-size pixels (FrameStabilizer.measure)
+        Returns:
+            lookup (dict): copy with corrected 'U', 'V' and the 'pose_correction' (da, dt, dr) in radians
+        """
+        if dU == 0 and dV == 0:
+            return lookup
+        J = self.angle_jacobian(lookup)
+        correction = np.linalg.solve(J['normal'], J['sum_U']*dU + J['sum_V']*dV)
+        shape = lookup['key'][1]
+        index = lookup['index']
+        U = lookup['U'].copy()
+        V = lookup['V'].copy()
+        U.ravel()[index] = np.clip(U.ravel()[index] + J['U'] @ correction, 1 + 1e-6, shape[1] - 1)
+        V.ravel()[index] = np.clip(V.ravel()[index] + J['V'] @ correction, 1 + 1e-6, shape[0] - 1)
+        return dict(lookup, U=U, V=V, pose_correction=(correction[0], correction[1], 0.))
+
+    def _stabilize(self, image_file, lookup, stabilizer, fs=None, measurements=None):
+        """Return (image, lookup) for an image decoded for sampling and its stabilized lookup table
+        Notes:
+            - A 'shift' (dU, dV) in measurements is used instead of measuring the image, and a
+              measured shift is stored there (see accumulate_products).
+        """
+        image = read_image(image_file, fs, lookup['decode_scale'] if self.reduced_decode else 1)
+        if stabilizer is None:
+            return image, lookup
+        if measurements is not None and 'shift' in measurements:
+            dU, dV = measurements['shift']
+        else:
+            dU, dV, _ = stabilizer.measure(image)
+            if measurements is not None:
+                measurements['shift'] = (float(dU), float(dV))
+        return image, self.stabilized_lookup(lookup, dU, dV)
+
+    def resolution_map(self, calibration, h=0.1):
+        """Return the cached ground resolution of a camera at every grid cell
+        Notes:
+            - From the Jacobian of the projection (distort_UV) by forward differences of h metres:
+              resolution along x is 1/|d(U,V)/dx| metres per pixel, and likewise along y. Local x
+              is cross-shore and y alongshore.
+            - Also holds 'weight', the number of pixels per grid cell (TargetGrid.cell_area over pixel
+              footprint area), used to favour well-resolved cameras when merging
+              (resolution_weighting). It uses the same scale for every camera, so wherever
+              cameras overlap the finer ground resolution has the larger weight.
+        Arguments:
+            calibration (CameraCalibration): camera calibration
+            h (float): finite-difference step in metres
+        Returns:
+            resolution (dict): 'x', 'y' (metres per full-size pixel, NaN where not seen) and
+                'weight' (pixels per grid cell, 0 where not seen), each the shape of the target grid X
+        """
+        key = calibration_key(calibration)
+        if key not in self.resolutions:
+            shape = self.target_grid.X.shape
+            xyz = self.target_grid.xyz
+            U, V, flag = distort_UV(calibration, xyz)
+            resolution = {}
+            for axis, name in enumerate(['x', 'y']):
+                step = np.zeros(3)
+                step[axis] = h
+                Uh, Vh, _ = distort_UV(calibration, xyz + step)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    r = h/np.hypot(Uh - U, Vh - V)
+                r[flag == 0] = np.nan
+                resolution[name] = r.reshape(shape, order='F')
+            area = resolution['x']*resolution['y']
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weight = self.target_grid.cell_area()/area
+            resolution['weight'] = np.where(np.isfinite(weight), weight, 0.)
+            self.resolutions[key] = resolution
+        return self.resolutions[key]
+
+    def merged_resolution(self, calibrations):
+        """Return the ground resolution of the merge of several cameras
+        Notes:
+            - Resolution of each camera weighted by its feathering weight (distance to the
+              footprint edge), as the cameras are blended. Cached through resolution_map.
+        Arguments:
+            calibrations (list): CameraCalibration of each camera
+        Returns:
+            res_x, res_y (np.ndarray): metres per pixel along x and y, NaN where no camera sees
+        """
+        total = 0.
+        res_x = 0.
+        res_y = 0.
+        for calibration in calibrations:
+            resolution = self.resolution_map(calibration)
+            seen = ~np.isnan(resolution['x'])
+            W = self.target_grid.edge_distance(seen).astype(np.float64)
+            W = W / max(np.max(W), 1)
+            total = total + W
+            res_x = res_x + W*np.where(seen, resolution['x'], 0.)
+            res_y = res_y + W*np.where(seen, resolution['y'], 0.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(total > 0, res_x/total, np.nan), np.where(total > 0, res_y/total, np.nan)
+
+    def uncertainty_map(self, calibration, sigmas, nsamples=1000, stride=8, seed=0, chunk=250):
+        """Return the cached positional uncertainty of a camera's rectified pixels at every grid cell
+        Notes:
+            - Monte Carlo: nsamples parameter sets are drawn from independent normal errors of
+              the stated size and the grid is projected with all of them at once (batched
+              extrinsic_solver.project_points, chunk samples at a time). The pixel a cell is
+              sampled from with the nominal calibration would, under a perturbed calibration,
+              show the ground point -J^-1 (dU, dV) away, with J the nominal d(U,V)/d(x,y).
+            - The error varies smoothly, so it is computed every stride cells and interpolated
+              (adaptive grids use every node).
+        Arguments:
+            calibration (CameraCalibration): camera calibration
+            sigmas (dict): 1-sigma errors by parameter: any of x, y, z (m) and a, t, r (radians)
+                of the local extrinsics, and intrinsics keys (fx, fy, c0U, c0V in pixels, d1, d2,
+                d3, t1, t2)
+            nsamples (int): number of parameter sets
+            stride (int): cells between computed nodes
+            seed (int): random seed, so the map of a calibration is reproducible
+            chunk (int): parameter sets projected at a time
+        Returns:
+            uncertainty (dict): 'x', 'y' (rms error along x and y) and 'radial' (rms distance), in
+                metres, NaN where not seen, each the shape of the target grid X
+        """
+        key = (calibration_key(calibration), tuple(sorted(sigmas.items())), nsamples, stride, seed)
+        if key not in self.uncertainties:
+            shape = self.target_grid.X.shape
+            if isinstance(self.target_grid, AdaptiveTargetGrid):
+                stride = 1
+            rows = np.unique(np.r_[0:shape[0]:stride, shape[0] - 1])
+            columns = np.unique(np.r_[0:shape[1]:stride, shape[1] - 1])
+            nodes = np.ix_(rows, columns)
+            xyz = np.column_stack((self.target_grid.X[nodes].ravel(), self.target_grid.Y[nodes].ravel(),
+                                   self.target_grid.Z[nodes].ravel()))
+            beta = calibration.beta
+            lcp = calibration.lcp
+            U0, V0, front, J = project_points(beta, lcp, xyz, jacobian=True)
+            # d(U,V)/d(x,y) of a ground point is minus the derivative by the camera position
+            with np.errstate(invalid='ignore', divide='ignore'):
+                inverse = np.linalg.inv(np.where(front[0, :, np.newaxis, np.newaxis], -J[0, :, :, :2], np.eye(2)))
+
+            rng = np.random.default_rng(seed)
+            beta_sigmas = np.array([sigmas.get(k, 0.) for k in BETA_KEYS])
+            lcp_sigmas = {k: v for k, v in sigmas.items() if k not in BETA_KEYS}
+            total = np.zeros((len(xyz), 2))
+            for start in range(0, nsamples, chunk):
+                m = min(chunk, nsamples - start)
+                betas = beta + rng.normal(size=(m, 6))*beta_sigmas
+                lcps = dict(lcp)
+                for k, sigma in lcp_sigmas.items():
+                    lcps[k] = lcp[k] + sigma*rng.normal(size=(m, 1))
+                U, V, _ = project_points(betas, lcps, xyz)
+                moved = np.stack((U - U0, V - V0), axis=-1)
+                total += np.sum(np.einsum('nij,mnj->mni', inverse, moved)**2, axis=0)
+            error = np.sqrt(total/nsamples).reshape(len(rows), len(columns), 2)
+
+            # nodes the camera does not see take the nearest seen value, so interpolation reaches the footprint edge
+            _, _, flag = distort_UV(calibration, xyz)
+            missing = (flag == 0).reshape(len(rows), len(columns)) | ~np.all(np.isfinite(error), axis=2)
+            if np.all(missing):
+                error[:] = np.nan
+            elif np.any(missing):
+                nearest = distance_transform_edt(missing, return_distances=False, return_indices=True)
+                error = error[nearest[0], nearest[1]]
+            if len(rows) < shape[0] or len(columns) < shape[1]:
+                i, j = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+                interpolate = RegularGridInterpolator((rows, columns), error)
+                error = interpolate(np.column_stack((i.ravel(), j.ravel()))).reshape(shape + (2,))
+            seen = ~np.isnan(self.resolution_map(calibration)['x'])
+            uncertainty = {'x': np.where(seen, error[..., 0], np.nan), 'y': np.where(seen, error[..., 1], np.nan)}
+            uncertainty['radial'] = np.hypot(uncertainty['x'], uncertainty['y'])
+            self.uncertainties[key] = uncertainty
+        return self.uncertainties[key]
+
+    def merged_uncertainty(self, calibrations, sigmas, **kwargs):
+        """Return the positional uncertainty of the merge of several cameras
+        Notes:
+            - Each camera's uncertainty_map weighted by its feathering weight, as in merged_resolution
+        Arguments:
+            calibrations (list): CameraCalibration of each camera
+            sigmas (dict): 1-sigma parameter errors (see uncertainty_map), the same for every camera
+            kwargs: passed to uncertainty_map
+        Returns:
+            uncertainty (dict): 'x', 'y' and 'radial' in metres, NaN where no camera sees
+        """
+        total = 0.
+        merged = {'x': 0., 'y': 0., 'radial': 0.}
+        for calibration in calibrations:
+            uncertainty = self.uncertainty_map(calibration, sigmas, **kwargs)
+            seen = ~np.isnan(uncertainty['x'])
+            W = self.target_grid.edge_distance(seen).astype(np.float64)
+            W = W / max(np.max(W), 1)
+            total = total + W
+            for name in merged:
+                merged[name] = merged[name] + W*np.where(seen, uncertainty[name], 0.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {name: np.where(total > 0, value/total, np.nan) for name, value in merged.items()}
+
     def get_pixels(self, DU, DV, image, interp_method='rgi'):
         """Return pixel values for each xyz point from the image
         Arguments:
@@ -212,7 +1460,7 @@ class Rectifier(object):
         # NaN in K indicates no pixel value at that location
         # edt finds euclidean distance from no value to closest value
         # so, find the nans, then invert so it works with the function
-        W = distance_transform_edt(~np.isnan(K[:, :, 0]))
+        W = self.target_grid.edge_distance(~np.isnan(K[:, :, 0]))
 
         # Not sure when this would happen, but included because it's in the MATLAB code
         if np.isinf(np.max(W)):
@@ -232,7 +1480,478 @@ class Rectifier(object):
         K_weighted = K*W_nonan[:, :, np.newaxis]
         return K_weighted
 
-    def rectify_images(self, metadata, image_files, intrinsic_cal_list, extrinsic_cal_list, local_origin, fs=None, interp_method = 'rgi'):
+    def camera_tile(self, camera, K, valid):
+        """Return a RectifiedTile of one camera's sampled pixels (adaptive grids are rasterised first)"""
+        if isinstance(self.target_grid, AdaptiveTargetGrid):
+            K = self.target_grid.to_raster(K)
+            valid = self.target_grid.to_raster(valid)
+        return RectifiedTile.from_pixels(camera, K, valid)
+
+    def image_quality_score(self, image_file, image, step=4, fs=None):
+        """Return the cached image_quality score of an image, computing it on first use
+        Notes:
+            - Cached by path, size and modified time, so a new image written to the same path
+              (e.g. a download to /tmp) is scored again. Files that cannot be stat'ed are not cached.
+        """
+        try:
+            if fs is None:
+                stat = os.stat(image_file)
+                key = (image_file, stat.st_size, stat.st_mtime_ns)
+            else:
+                info = fs.info(image_file)
+                key = (image_file, info.get('size'), info.get('ETag', info.get('LastModified', info.get('mtime'))))
+        except (OSError, TypeError, ValueError):
+            return float(image_quality(image, step)[0])
+        if key not in self.quality_scores:
+            if len(self.quality_scores) >= self.max_quality_scores:
+                # dicts keep insertion order, so this drops the oldest score
+                del self.quality_scores[next(iter(self.quality_scores))]
+            self.quality_scores[key] = float(image_quality(image, step)[0])
+        return self.quality_scores[key]
+
+    def _camera_mask(self, mask, fs=None):
+        """Return an obstruction mask as a 2-D array (mask may be an array, a file or None)"""
+        if isinstance(mask, str):
+            mask = read_image(mask, fs)
+        if mask is not None and mask.ndim == 3:
+            mask = mask[:, :, 0]
+        return mask
+
+    def _sample_image(self, image_file, lookup, fs=None, image=None):
+        """Return (image, K) for an image sampled at the valid cells of a lookup table ('rgi')"""
+        shape = lookup['key'][1]
+        if image is None:
+            image = read_image(image_file, fs, lookup['decode_scale'] if self.reduced_decode else 1)
+
+        # only the valid cells are sampled (same values as get_pixels at full size)
+        index = lookup['index']
+        U = lookup['U'].ravel()[index]
+        V = lookup['V'].ravel()[index]
+        scale = shape[1]/image.shape[1]
+        if scale != 1:
+            # pixel centers of the reduced image, kept inside it
+            U = np.clip((U + 0.5)/scale - 0.5, 1 + 1e-6, image.shape[1] - 1)
+            V = np.clip((V + 0.5)/scale - 0.5, 1 + 1e-6, image.shape[0] - 1)
+        K = np.full((lookup['valid'].size, self.ncolors), np.nan)
+        K[index] = bilinear_sample(image, U, V)[:, :self.ncolors]
+        return image, K.reshape(lookup['valid'].shape + (self.ncolors,))
+
+    def _sample_images(self, metadata, image_files, intrinsic_cal_list, extrinsic_cal_list, local_origin, fs=None, interp_method='rgi', mask_list=None, stabilizers=None):
+        """Yield (image_file, image, lookup, K) for each image, using cached lookup tables"""
+        if mask_list is None:
+            mask_list = [None]*len(image_files)
+        if stabilizers is None:
+            stabilizers = [None]*len(image_files)
+        for image_file, intrinsic_cal, extrinsic_cal, mask, stabilizer in zip(image_files, intrinsic_cal_list, extrinsic_cal_list, mask_list, stabilizers):
+            # load camera calibration file and find pixel locations
+            camera_calibration = get_calibration(metadata, intrinsic_cal, extrinsic_cal, local_origin)
+            mask = self._camera_mask(mask, fs)
+
+            # load image and sample it at the grid
+            if interp_method == 'rgi':
+                lookup = self.camera_lookup(camera_calibration, image_size(image_file, fs), mask)
+                image, lookup = self._stabilize(image_file, lookup, stabilizer, fs)
+                image, K = self._sample_image(image_file, lookup, fs, image)
+            else:
+                image = read_image(image_file, fs)
+                lookup = self.camera_lookup(camera_calibration, image.shape, mask)
+                K = self.get_pixels(lookup['U'], lookup['V'], image, interp_method=interp_method)
+                K[~lookup['valid']] = np.nan
+            yield image_file, image, lookup, K
+
+    def _check_multiband_grid(self):
+        """Raise ValueError unless the target grid is a regular raster the pyramids can be built on"""
+        if isinstance(self.target_grid, AdaptiveTargetGrid) or min(self.target_grid.X.shape) < 2:
+            raise ValueError(f'multiband blending needs a regular grid with at least 2 nodes along each axis, '
+                             f'not {type(self.target_grid).__name__} of shape {self.target_grid.X.shape}')
+
+    def multiband_structures(self, lookups, nlevels=None):
+        """Return the cached multi-band blending structures for a combination of cameras
+        Notes:
+            - Seams put each grid cell in the camera with the largest feathering weight.
+            - Everything here depends only on the calibrations, so the per-image work of
+              multiband_blend is building the pyramids of the sampled pixels.
+        Arguments:
+            lookups (list): camera_lookup results for the cameras being merged
+            nlevels (int): number of pyramid levels (default: until the coarsest level is ~8 cells)
+        Returns:
+            seams (dict): 'shapes' of the levels, 'norms' for pyramid_expand, per-camera
+                'valid' pyramids (for filling holes), normalised level 'weights' and
+                'covered' (cells seen by any camera)
+        """
+        self._check_multiband_grid()
+        key = (tuple(lookup['key'] for lookup in lookups), nlevels)
+        if key in self.seams:
+            return self.seams[key]
+
+        shape = self.target_grid.X.shape
+        if nlevels is None:
+            nlevels = max(1, int(np.floor(np.log2(min(shape)/8.))) + 1)
+        shapes = pyramid_shapes(shape, nlevels)
+        norms = []
+        for level_shape in shapes[:-1]:
+            ones = np.zeros(level_shape)
+            ones[::2, ::2] = 1.
+            norms.append(_smooth(ones))
+
+        W = np.stack([lookup['W'] for lookup in lookups])
+        valid = np.stack([lookup['valid'] for lookup in lookups])
+        seam = np.argmax(W, axis=0)
+
+        valid_pyramids = []
+        weights = []
+        for i in range(len(lookups)):
+            v = [valid[i].astype(np.float64)]
+            m = [((seam == i) & valid[i]).astype(np.float64)]
+            for _ in range(nlevels - 1):
+                v.append(pyramid_reduce(v[-1]))
+                m.append(pyramid_reduce(m[-1]))
+            valid_pyramids.append(v)
+            weights.append(m)
+        # normalise level weights across cameras
+        for level in range(nlevels):
+            total = sum(w[level] for w in weights)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                for w in weights:
+                    w[level] = np.where(total > 0, w[level]/total, 0.)
+
+        self.seams[key] = {
+            'shapes': shapes,
+            'norms': norms,
+            'valid': valid_pyramids,
+            'weights': weights,
+            'covered': valid.any(axis=0)
+        }
+        return self.seams[key]
+
+    def multiband_blend(self, K_list, lookups, nlevels=None):
+        """Blend sampled camera images with Laplacian pyramids
+        Notes:
+            - Holes outside each camera's footprint are filled at every level by normalised
+              convolution (pyramid of K*valid divided by pyramid of valid) before the
+              Laplacian levels are formed, so footprint edges do not leak into the blend.
+        Arguments:
+            K_list (list): pixel intensities from get_pixels for each camera
+            lookups (list): camera_lookup results for each camera
+            nlevels (int): number of pyramid levels
+        Returns:
+            M (np.ndarray): merged image as uint8
+        """
+        seams = self.multiband_structures(lookups, nlevels)
+        shapes = seams['shapes']
+        norms = seams['norms']
+        nlevels = len(shapes)
+
+        blended = [0.]*nlevels
+        for i, K in enumerate(K_list):
+            # Gaussian pyramid of the sampled pixels with holes filled
+            G = [np.where(np.isnan(K), 0., K)]
+            for _ in range(nlevels - 1):
+                G.append(pyramid_reduce(G[-1]))
+            v = seams['valid'][i]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                F = [np.where(v[l][:, :, np.newaxis] > 0, G[l]/v[l][:, :, np.newaxis], 0.) for l in range(nlevels)]
+            # Laplacian levels, weighted and added into the blend
+            for l in range(nlevels):
+                L = F[l] if l == nlevels - 1 else F[l] - pyramid_expand(F[l + 1], shapes[l], norms[l])
+                blended[l] = blended[l] + seams['weights'][i][l][:, :, np.newaxis]*L
+
+        # collapse the blended pyramid
+        M = blended[-1]
+        for l in range(nlevels - 2, -1, -1):
+            M = pyramid_expand(M, shapes[l], norms[l]) + blended[l]
+        M[~seams['covered']] = 0
+        return np.clip(M, 0, 255).astype(np.uint8)
+
+    def overlap_indices(self, valid_list, key=None):
+        """Return flat indices of the grid cells seen by each pair of cameras
+        Arguments:
+            valid_list (list): boolean arrays of cells seen by each camera
+            key (tuple): cache key for this combination of cameras (not cached if None)
+        Returns:
+            overlaps (dict): {(i, j): flat indices} for each pair i < j with a non-empty overlap
+        """
+        if key is not None and key in self.overlaps:
+            return self.overlaps[key]
+        flat = [np.ravel(valid) for valid in valid_list]
+        overlaps = {}
+        for i in range(len(flat)):
+            for j in range(i + 1, len(flat)):
+                idx = np.flatnonzero(flat[i] & flat[j])
+                if len(idx):
+                    overlaps[(i, j)] = idx
+        if key is not None:
+            self.overlaps[key] = overlaps
+        return overlaps
+
+    def exposure_balance(self, K_list, valid_list, key=None, min_overlap=100, prior=0.1):
+        """Solve for a gain and offset per camera and color that match cameras in their overlaps
+        Notes:
+            - For every pair of cameras the mean and standard deviation of each color over the
+              overlap cells should agree after correction (g*K + o). Pairs are weighted by the
+              square root of their overlap size, and a weak prior towards g=1, o=0 fixes the
+              overall level, so the result is a small linear least-squares problem per color.
+            - The overlap cells come from overlap_indices, cached per combination of cameras,
+              so the per-merge cost is a few reductions over the overlap cells.
+        Arguments:
+            K_list (list): pixel intensities for each camera (NaN where not seen)
+            valid_list (list): boolean arrays of cells seen by each camera
+            key (tuple): cache key for the overlap indices
+            min_overlap (int): pairs with fewer overlapping cells are ignored
+            prior (float): weight of the g=1, o=0 prior relative to the overlap equations
+        Returns:
+            gains, offsets (np.ndarray): (ncameras, ncolors) arrays
+        """
+        ncam = len(K_list)
+        ncolors = K_list[0].shape[-1]
+        flat = [K.reshape(-1, ncolors) for K in K_list]
+        overlaps = self.overlap_indices(valid_list, key)
+        pairs = [(ij, idx) for ij, idx in overlaps.items() if len(idx) >= min_overlap]
+        gains = np.ones((ncam, ncolors))
+        offsets = np.zeros((ncam, ncolors))
+        if not pairs:
+            return gains, offsets
+
+        nmax = max(len(idx) for _, idx in pairs)
+        # mean rows in units of the full intensity range, unknowns [g_0 .. g_n, o_0 .. o_n]
+        A = np.zeros((2*len(pairs) + 2*ncam, 2*ncam))
+        b = np.zeros((A.shape[0], ncolors))
+        stats = []
+        for row, ((i, j), idx) in enumerate(pairs):
+            a = flat[i][idx]
+            c = flat[j][idx]
+            stats.append((a.mean(axis=0), c.mean(axis=0), a.std(axis=0), c.std(axis=0)))
+            w = np.sqrt(len(idx)/nmax)
+            A[2*row, [i, j, ncam + i, ncam + j]] = [w/255., -w/255., w/255., -w/255.]
+            A[2*row + 1, [i, j]] = [w, -w]
+        # prior rows
+        n = 2*len(pairs)
+        A[n + np.arange(ncam), np.arange(ncam)] = prior
+        b[n:n + ncam] = prior
+        A[n + ncam + np.arange(ncam), ncam + np.arange(ncam)] = prior/255.
+
+        for color in range(ncolors):
+            Ac = A.copy()
+            for row, (mean_i, mean_j, std_i, std_j) in enumerate(stats):
+                Ac[2*row, :ncam] *= 0
+                (i, j), _ = pairs[row]
+                Ac[2*row, i] = A[2*row, i]*mean_i[color]
+                Ac[2*row, j] = A[2*row, j]*mean_j[color]
+                # contrast rows are relative to the mean contrast of the pair
+                scale = max(0.5*(std_i[color] + std_j[color]), 1e-6)
+                Ac[2*row + 1, i] = A[2*row + 1, i]*std_i[color]/scale
+                Ac[2*row + 1, j] = A[2*row + 1, j]*std_j[color]/scale
+            x = np.linalg.lstsq(Ac, b[:, color], rcond=None)[0]
+            gains[:, color] = x[:ncam]
+            offsets[:, color] = x[ncam:]
+        return gains, offsets
+
+    def balance_contributions(self, contributions, **kwargs):
+        """Return one MergeAccumulator from single-camera ones, with exposures balanced
+        Notes:
+            - Pixel values are recovered as M/totalW, so saved per-camera merge states can be
+              balanced without resampling any image. Keyword arguments go to exposure_balance.
+        Arguments:
+            contributions (list): MergeAccumulator of each camera
+        Returns:
+            accumulator (MergeAccumulator): balanced merge
+        """
+        valid_list = [c.totalW > 0 for c in contributions]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            K_list = [np.where(valid[..., np.newaxis], c.M/c.totalW[..., np.newaxis], np.nan)
+                      for c, valid in zip(contributions, valid_list)]
+        keys = tuple(k for c in contributions for k in c.keys)
+        if '' in keys:
+            keys = None
+        gains, offsets = self.exposure_balance(K_list, valid_list, keys, **kwargs)
+
+        accumulator = MergeAccumulator(contributions[0].totalW.shape, contributions[0].M.shape[-1])
+        for c, gain, offset in zip(contributions, gains, offsets):
+            accumulator.M += c.M*gain + c.totalW[..., np.newaxis]*offset
+            accumulator.totalW += c.totalW
+            accumulator.cameras.extend(c.cameras)
+            accumulator.keys.extend(c.keys)
+        return accumulator
+
+    def fill_from_cache(self, accumulator, cached_frames, time, max_age=3600.):
+        """Merge, filling areas no live camera covers from recent frames of the missing cameras
+        Notes:
+            - Only cached frames of cameras not in the accumulator, and no older than max_age,
+              are used. They only fill cells without live data and are feathered like live
+              cameras where they overlap each other.
+        Arguments:
+            accumulator (MergeAccumulator): live merge
+            cached_frames (list): CachedFrame of cameras that may be missing
+            time (float): unix time of the merge
+            max_age (float): oldest cached frame to use, in seconds
+        Returns:
+            M (np.ndarray): merged image as uint8
+            provenance (np.ndarray): uint8 band, PROVENANCE_LIVE, PROVENANCE_CACHE or PROVENANCE_NONE per cell
+        """
+        M = accumulator.merged()
+        live = accumulator.totalW > 0
+        provenance = np.where(live, PROVENANCE_LIVE, PROVENANCE_NONE).astype(np.uint8)
+
+        fill = MergeAccumulator(live.shape, M.shape[-1])
+        for frame in cached_frames:
+            if frame.camera in accumulator.cameras or not 0 <= time - frame.time <= max_age:
+                continue
+            W = self.target_grid.edge_distance(frame.valid).astype(np.float64)
+            W = W / max(np.max(W), 1)
+            fill.add(frame.K*W[..., np.newaxis], W, frame.camera)
+        if fill.cameras:
+            holes = ~live & (fill.totalW > 0)
+            M[holes] = fill.merged()[holes]
+            provenance[holes] = PROVENANCE_CACHE
+        return M, provenance
+
+    def accumulate_images(self, metadata, image_files, intrinsic_cal_list, extrinsic_cal_list, local_origin, fs=None, interp_method = 'rgi', cameras=None, accumulator=None, quality_weighting=False, mask_list=None, tiles=None, resolution_weighting=False, stabilizers=None):
+        """Georectify images and add their weighted pixels to an unnormalised merge
+        Notes:
+            - Each camera's weights only depend on its own footprint, so contributions can be
+              added one camera at a time and give the same merge as rectifying all at once.
+        Arguments:
+            metadata (dict):
+            image_files (list): List of image files
+            intrinsic_cal_list (list): list of paths to internal calibrations (one for each camera)
+            extrinsic_cal_list (list): list of paths to external calibrations (one for each camera)
+            local_origin:
+            fs: (object): fsspec file spec object for folder on S3 bucket. If none, normal file system will be used.
+            interp_method: (string): either 'rbs' (rectilinear bicubic spline) or 'rgi' (regular grid interpolator: linear and faster)
+            cameras (list): camera name for each image (e.g. 'C1'). Defaults to the image index.
+            accumulator (MergeAccumulator): merge to add to. A new one is made if None.
+            quality_weighting (bool): multiply each camera's weights by its image quality score
+            mask_list (list): optional static obstruction mask (array or file) for each camera, None for no mask
+            tiles (list): if given, a RectifiedTile of each camera's unweighted pixels is appended to it
+            resolution_weighting (bool): multiply each camera's weights by its cached resolution weight
+            stabilizers (list): optional FrameStabilizer for each camera, None for no stabilization ('rgi' only)
+        Returns:
+            accumulator (MergeAccumulator): unnormalised merge including the supplied images.
+        """
+        if accumulator is None:
+            accumulator = MergeAccumulator(self.target_grid.X.shape, self.ncolors)
+        if cameras is None:
+            cameras = [str(i) for i in range(len(image_files))]
+
+        for cur_idx, (image_file, image, lookup, K) in enumerate(self._sample_images(metadata, image_files, intrinsic_cal_list, extrinsic_cal_list, local_origin, fs, interp_method, mask_list, stabilizers)):
+            W = lookup['W']
+            if resolution_weighting:
+                W = W*self.resolution_map(lookup['calibration'])['weight']
+            if quality_weighting:
+                # same decimation relative to the full image whatever the decode scale
+                step = max(1, int(round(4*image.shape[1]/lookup['key'][1][1])))
+                W = W*self.image_quality_score(image_file, image, step, fs)
+            K_weighted = self.apply_weights_to_pixels(K, W)
+
+            # add up weights and pixel itensities
+            accumulator.add(K_weighted, W, cameras[cur_idx], lookup['key'])
+            if tiles is not None:
+                tiles.append(self.camera_tile(cameras[cur_idx], K, lookup['valid']))
+
+        return accumulator
+
+    def accumulate_products(self, metadata, product_files, intrinsic_cal_list, extrinsic_cal_list, local_origin, fs=None, cameras=None, accumulators=None, quality_weighting=False, mask_list=None, reference='timex', tiles=None, stabilizers=None, measurements=None):
+        """Georectify several image types of one timestamp (e.g. timex, var, bright, dark, snap) with shared geometry
+        Notes:
+            - Each camera's calibration, lookup table and weights are found once and used for
+              every product, so only decoding and sampling are repeated per product.
+            - With quality_weighting, the quality score comes from the reference product's image
+              (the first product present if it is missing), so every product of a camera is
+              merged with the same weights. Sampling is 'rgi'.
+            - With stabilizers, camera motion is measured on the reference product's image and
+              the corrected lookup table is used for every product of that camera.
+            - Products of a timestamp that are rectified in separate calls (as they arrive) keep
+              the same weights and correction through measurements: the quality score and shift
+              are stored there when first measured, and reused by later calls that pass them back.
+        Arguments:
+            metadata (dict):
+            product_files (dict): {product: list of image files (one per camera, None if missing)}
+            intrinsic_cal_list (list): list of paths to internal calibrations (one for each camera)
+            extrinsic_cal_list (list): list of paths to external calibrations (one for each camera)
+            local_origin:
+            fs: (object): fsspec file spec object for folder on S3 bucket. If none, normal file system will be used.
+            cameras (list): camera name for each camera (e.g. 'C1'). Defaults to the camera index.
+            accumulators (dict): {product: MergeAccumulator} to add to. New ones are made if None.
+            quality_weighting (bool): multiply each camera's weights by its image quality score
+            mask_list (list): optional static obstruction mask (array or file) for each camera, None for no mask
+            reference (str): product whose images give the quality scores
+            tiles (dict): if given, RectifiedTiles are appended to tiles[product]
+            stabilizers (list): optional FrameStabilizer for each camera, None for no stabilization
+            measurements (list): optional dict for each camera with the 'quality' score and stabilizer
+                'shift' (dU, dV) to use. Missing values are measured and added to the dict.
+        Returns:
+            accumulators (dict): {product: MergeAccumulator} including the supplied images
+        """
+        ncameras = len(intrinsic_cal_list)
+        if accumulators is None:
+            accumulators = {}
+        for product in product_files:
+            if product not in accumulators:
+                accumulators[product] = MergeAccumulator(self.target_grid.X.shape, self.ncolors)
+        if cameras is None:
+            cameras = [str(i) for i in range(ncameras)]
+        if mask_list is None:
+            mask_list = [None]*ncameras
+        if stabilizers is None:
+            stabilizers = [None]*ncameras
+        if measurements is None:
+            measurements = [{} for _ in range(ncameras)]
+
+        for c in range(ncameras):
+            files = {product: product_files[product][c] for product in product_files if product_files[product][c] is not None}
+            if not files:
+                continue
+            camera_calibration = get_calibration(metadata, intrinsic_cal_list[c], extrinsic_cal_list[c], local_origin)
+            mask = self._camera_mask(mask_list[c], fs)
+            # products of a camera have the same size, so the header of any one gives the lookup
+            first = reference if reference in files else next(iter(files))
+            lookup = self.camera_lookup(camera_calibration, image_size(files[first], fs), mask)
+
+            # the reference product is sampled first, so its quality score sets W for all products
+            W = None
+            for product in [first] + [p for p in files if p != first]:
+                image = None
+                if product == first:
+                    image, lookup = self._stabilize(files[product], lookup, stabilizers[c], fs, measurements[c])
+                image, K = self._sample_image(files[product], lookup, fs, image)
+                if W is None:
+                    W = lookup['W']
+                    if quality_weighting:
+                        if 'quality' not in measurements[c]:
+                            step = max(1, int(round(4*image.shape[1]/lookup['key'][1][1])))
+                            measurements[c]['quality'] = self.image_quality_score(files[product], image, step, fs)
+                        W = W*measurements[c]['quality']
+                accumulators[product].add(self.apply_weights_to_pixels(K, W), W, cameras[c], lookup['key'])
+                if tiles is not None:
+                    tiles.setdefault(product, []).append(self.camera_tile(cameras[c], K, lookup['valid']))
+
+        return accumulators
+
+    def rectify_products(self, metadata, product_files, intrinsic_cal_list, extrinsic_cal_list, local_origin, fs=None, quality_weighting=False, balance=False, mask_list=None, reference='timex'):
+        """Georectify and merge several image types of one timestamp with shared geometry
+        Arguments:
+            see accumulate_products
+            balance (bool): match exposure and color of the cameras in their overlaps, per product
+        Returns:
+            merges (dict): {product: merged image as uint8}
+        """
+        if not balance:
+            accumulators = self.accumulate_products(metadata, product_files, intrinsic_cal_list, extrinsic_cal_list, local_origin, fs=fs, quality_weighting=quality_weighting, mask_list=mask_list, reference=reference)
+            return {product: accumulator.merged() for product, accumulator in accumulators.items()}
+
+        # one accumulator per camera and product, balanced per product
+        contributions = {product: [] for product in product_files}
+        for c in range(len(intrinsic_cal_list)):
+            files = {product: [product_files[product][c]] for product in product_files}
+            masks = None if mask_list is None else [mask_list[c]]
+            camera = self.accumulate_products(metadata, files, [intrinsic_cal_list[c]], [extrinsic_cal_list[c]], local_origin, fs=fs, cameras=[str(c)], quality_weighting=quality_weighting, mask_list=masks, reference=reference)
+            for product, accumulator in camera.items():
+                if accumulator.cameras:
+                    contributions[product].append(accumulator)
+        return {product: self.balance_contributions(contributions[product]).merged()
+                for product in product_files if contributions[product]}
+
+    def rectify_images(self, metadata, image_files, intrinsic_cal_list, extrinsic_cal_list, local_origin, fs=None, interp_method = 'rgi', quality_weighting=False, blend='feather', balance=False, mask_list=None, return_tiles=False, resolution_weighting=False):
         """Georectify and blend images from multiple cameras 
         Arguments:
             metadata (dict):
@@ -243,50 +1962,49 @@ class Rectifier(object):
             fs: (object): fsspec file spec object for folder on S3 bucket. If none, normal file system will be used.
             interp_method: (string): either 'rbs' (rectilinear bicubic spline) or 'rgi' (regular grid interpolator: linear and faster)
             camera_calibration_files (list): List of calibrations for cameras used to get image_files.
+            quality_weighting (bool): multiply each camera's weights by its image quality score (feather only)
+            blend (string): either 'feather' (linear weights by distance to the footprint edge) or
+                'multiband' (Laplacian pyramid blending along cached seams, regular grids only;
+                ValueError for an AdaptiveTargetGrid or a grid with a single node along an axis)
+            balance (bool): match exposure and color of the cameras in their overlaps first
+            mask_list (list): optional static obstruction mask (array or file) for each camera, None for no mask
+            return_tiles (bool): also return each camera's rectified pixels (before balancing),
+                cropped to its footprint, as a by-product of the merge
+            resolution_weighting (bool): favour cameras with finer ground resolution (feather only)
         Returns:
             M (np.ndarray): Georectified images merged from supplied images.
+            tiles (list): RectifiedTile of each camera, named by image index (if return_tiles)
         """
-        # array for final pixel values
-        M = np.tile(
-            np.zeros_like(self.target_grid.X[:, :, np.newaxis]),
-            (self.ncolors,)
-        )
-        # array for weights
-        totalW = M.copy()
+        tiles = [] if return_tiles else None
+        if blend == 'multiband':
+            self._check_multiband_grid()
+            K_list = []
+            lookups = []
+            for cur_idx, (image_file, image, lookup, K) in enumerate(self._sample_images(metadata, image_files, intrinsic_cal_list, extrinsic_cal_list, local_origin, fs, interp_method, mask_list)):
+                K_list.append(K)
+                lookups.append(lookup)
+                if return_tiles:
+                    tiles.append(self.camera_tile(str(cur_idx), K, lookup['valid']))
+            if balance:
+                gains, offsets = self.exposure_balance(K_list, [lookup['valid'] for lookup in lookups],
+                                                       tuple(lookup['key'] for lookup in lookups))
+                K_list = [K*gain + offset for K, gain, offset in zip(K_list, gains, offsets)]
+            M = self.multiband_blend(K_list, lookups)
+            return (M, tiles) if return_tiles else M
 
-        for cur_idx, (image_file, intrinsic_cal, extrinsic_cal) in enumerate(zip(image_files, intrinsic_cal_list, extrinsic_cal_list)):
-            #  print("loop",cur_idx,"calibrations:")
-            #  print(intrinsic_cal, extrinsic_cal)
-            # load camera calibration file and find pixel locations
-            camera_calibration = CameraCalibration(metadata, intrinsic_cal, extrinsic_cal, local_origin)
-            U, V, flag = self._find_distort_UV(camera_calibration)
-
-            # load image and apply weights to pixels
-            if fs:
-                # using fsspec for S3 files
-                with fs.open(image_file) as f:
-                    image = imageio.imread(f)
-            else:
-                # regular file system
-                image = imageio.imread(image_file)
-                
-            K = self.get_pixels(U, V, image, interp_method=interp_method)
-            W = self.assemble_image_weights(K)
-            K_weighted = self.apply_weights_to_pixels(K, W)
+        if balance:
+            if mask_list is None:
+                mask_list = [None]*len(image_files)
+            contributions = []
+            for cur_idx, (image_file, intrinsic_cal, extrinsic_cal, mask) in enumerate(zip(image_files, intrinsic_cal_list, extrinsic_cal_list, mask_list)):
+                contributions.append(self.accumulate_images(metadata, [image_file], [intrinsic_cal], [extrinsic_cal], local_origin, fs=fs, interp_method=interp_method, cameras=[str(cur_idx)], quality_weighting=quality_weighting, mask_list=[mask], tiles=tiles, resolution_weighting=resolution_weighting))
+            M = self.balance_contributions(contributions).merged()
+            return (M, tiles) if return_tiles else M
 
-            # add up weights and pixel itensities
-            totalW = totalW + W[:, :, np.newaxis]
-            K_weighted[np.isnan(K_weighted)] = 0
-            M = M + K_weighted
+        accumulator = self.accumulate_images(metadata, image_files, intrinsic_cal_list, extrinsic_cal_list, local_origin, fs=fs, interp_method=interp_method, quality_weighting=quality_weighting, mask_list=mask_list, tiles=tiles, resolution_weighting=resolution_weighting)
 
-        # stop divide by 0 warnings
-        with np.errstate(invalid='ignore'):
-            M = M / totalW
-        
-        #TODO - is there any need to retain the NaNs, or is replacing by zero ok?
-        M[np.isnan(M)]=0
-        
         #TODO - don't need to return W, K or flag...they are from last image processed
         # return M.astype(np.uint8), W, K, flag
 
-        return M.astype(np.uint8)
+        M = accumulator.merged()
+        return (M, tiles) if return_tiles else M
@@ -1,8 +1,14 @@
+import bisect
+import copy
 import datetime
+import hashlib
+import heapq
+import json
 from pathlib import Path
 
 import numpy as np
 import scipy.io
+import yaml
 
 from coastcam_funcs import *
 
@@ -26,8 +32,10 @@ class CameraCalibration(object):
             x (across shore), y (longshore), z (vertical), azimuth, tilt, roll
         lcp (dict): Lens Calibration Profile structure, the intrinsic camera calibration
         P (np.ndarray): Matrix containing intrinsic and extrinsic calibration
+        key (str): calibration_hash of the inputs, the cache key of everything derived from the calibration
     """
     def __init__(self, metadata, intrinsics, extrinsics, local_origin):
+        self.key = calibration_hash(metadata, intrinsics, extrinsics, local_origin)
         self.fname = metadata['name']
         # this assumes a file naming convention we have not adopted
         self.serial_number = metadata['serial_number']
@@ -124,6 +132,161 @@ class CameraCalibration(object):
 
         return P, R, IC
 
+    def pixel_rays(self, U, V, distorted=True):
+        """Returns the world direction of the ray through each pixel (not normalised)
+        Arguments:
+            U, V (np.ndarray): pixel coordinates, any matching shape
+            distorted (bool): U, V are raw (distorted) image coordinates
+        Returns:
+            rays (np.ndarray): (3, n) directions from the camera position beta[:3]
+        """
+        if distorted:
+            U, V = undistort_UV(self.lcp, U, V)
+        K = np.array([
+            [self.lcp['fx'], 0,               self.lcp['c0U']],
+            [0,              -self.lcp['fy'], self.lcp['c0V']],
+            [0,              0,               1]
+        ])
+        UV = np.vstack((np.ravel(U), np.ravel(V), np.ones(np.size(U))))
+        return np.matmul(self.R.T, np.linalg.solve(K, UV))
+
+    def image_to_world(self, U, V, z=0., dem=None, distorted=True, geo=False, niter=20, tol=1e-4):
+        """Maps image pixel coordinates to world coordinates on a horizontal plane or a DEM.
+        Notes:
+            - Inverse of the projection used to rectify: pixels are undistorted with
+              undistort_UV, turned into rays from the camera position with K and R, and
+              intersected with the plane at elevation z.
+            - With a DEM, the elevation where each ray meets the surface is found by a secant
+              search started from the plane z. dem is any function returning the surface
+              elevation at local x, y (e.g. a scipy RegularGridInterpolator wrapped in a lambda).
+            - Rays that do not reach the surface in front of the camera give NaN.
+        Arguments:
+            U, V (np.ndarray): pixel coordinates, any matching shape
+            z (float or np.ndarray): elevation of the plane (first guess with a DEM)
+            dem (callable): dem(x, y) -> z in local coordinates, or None for the plane
+            distorted (bool): U, V are raw (distorted) image coordinates
+            geo (bool): return geographical (E, N) instead of local x, y
+            niter (int): maximum secant steps for DEM intersections
+            tol (float): DEM intersection tolerance (m)
+        Returns:
+            x, y, z (np.ndarray): world coordinates, same shape as U
+        """
+        shape = np.shape(U)
+        # ray direction in world coordinates through each pixel
+        rays = self.pixel_rays(U, V, distorted)
+        C = self.beta[:3]
+
+        def intersect(zp):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                t = (zp - C[2]) / rays[2]
+                t[~(t > 0)] = np.nan
+            return C[0] + t*rays[0], C[1] + t*rays[1]
+
+        zw = np.array(np.broadcast_to(z, shape), dtype='float64').ravel()
+        x, y = intersect(zw)
+        if dem is not None:
+            # secant search on g(z) = dem(x(z), y(z)) - z along each ray, kept below the
+            # camera so every step still meets the ray in front of it
+            zmax = C[2] - 1e-3
+            z0 = zw
+            g0 = dem(x, y) - z0
+            zw = np.minimum(z0 + g0, zmax)
+            for _ in range(niter):
+                x, y = intersect(zw)
+                g1 = dem(x, y) - zw
+                moving = np.abs(g1) > tol
+                if not moving.any():
+                    break
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    step = g1*(zw - z0)/(g1 - g0)
+                # flat spots fall back to a fixed-point step
+                step = np.where(np.isfinite(step), step, -g1)
+                z0, g0 = zw, g1
+                zw = np.where(moving, np.minimum(zw - step, zmax), zw)
+            x, y = intersect(zw)
+            zw[np.isnan(x)] = np.nan
+        else:
+            zw[np.isnan(x)] = np.nan
+
+        if geo:
+            x, y = local_transform_points(self.local_origin['x'], self.local_origin['y'],
+                                          np.deg2rad(self.local_origin['angd']), 0, x, y)
+        return x.reshape(shape), y.reshape(shape), zw.reshape(shape)
+
+
+def parse_date(value):
+    """Returns a date or datetime from an ISO date(time) string, as YAML loads it; other values unchanged"""
+    if not isinstance(value, str):
+        return value
+    text = value.strip()
+    try:
+        if len(text) == 10:
+            return datetime.date.fromisoformat(text)
+        return datetime.datetime.fromisoformat(text[:-1] + '+00:00' if text.endswith('Z') else text)
+    except ValueError:
+        return value
+
+
+def calibration_hash(metadata, intrinsics, extrinsics, local_origin):
+    """Returns a stable content hash of the inputs of a CameraCalibration.
+    Notes:
+        - sha1 of canonical JSON (sorted keys, arrays as lists, dates as strings), so the same
+          YAML parsed twice, or in another process, gives the same hash
+        - calibration_date is parsed with parse_date first, so a date loaded from YAML and the
+          same date read back as a string from a station bundle hash the same
+    """
+    if 'calibration_date' in metadata:
+        metadata = dict(metadata, calibration_date=parse_date(metadata['calibration_date']))
+
+    def default(value):
+        if hasattr(value, 'tolist'):
+            return value.tolist()
+        return str(value)
+    content = json.dumps([metadata, intrinsics, extrinsics, local_origin], sort_keys=True, default=default)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+class CalibrationRegistry(object):
+    """Shared CameraCalibrations keyed by the content hash of their inputs.
+    Notes:
+        - A calibration is built once (extrinsics conversion, R, IC and P) and the same instance
+          is returned for equal inputs, so its key identifies every cached lookup table, weight
+          map and footprint derived from it.
+        - Instances are shared, so they are read-only: inputs are copied, and the P, R, IC and
+          beta arrays are not writeable.
+    Attributes:
+        calibrations (dict): CameraCalibration for each calibration_hash
+    """
+    def __init__(self):
+        self.calibrations = {}
+
+    def __len__(self):
+        return len(self.calibrations)
+
+    def get(self, metadata, intrinsics, extrinsics, local_origin):
+        """Returns the shared CameraCalibration for these inputs, building it on first use"""
+        key = calibration_hash(metadata, intrinsics, extrinsics, local_origin)
+        if key not in self.calibrations:
+            calibration = CameraCalibration(copy.deepcopy(metadata), copy.deepcopy(intrinsics),
+                                            copy.deepcopy(extrinsics), copy.deepcopy(local_origin))
+            for array in (calibration.P, calibration.R, calibration.IC, calibration.beta):
+                array.setflags(write=False)
+            self.calibrations[key] = calibration
+        return self.calibrations[key]
+
+    def clear(self):
+        """Forget all calibrations"""
+        self.calibrations = {}
+
+
+# calibrations shared by everything in the process (e.g. a warm Lambda container)
+CALIBRATIONS = CalibrationRegistry()
+
+
+def get_calibration(metadata, intrinsics, extrinsics, local_origin):
+    """Returns the shared CameraCalibration for these inputs from the process-wide registry"""
+    return CALIBRATIONS.get(metadata, intrinsics, extrinsics, local_origin)
+
 
 # def angle2R(azimuth, tilt, swing):
 #     """Assembles and returns a rotation matrix R from azimuth, tilt, and swing (roll)
@@ -158,3 +321,128 @@ class CameraCalibration(object):
 #     R[2, 2] = -np.cos(t)
 
 #     return R
+
+
+def to_unix_time(value):
+    """Returns unix seconds from a number, an ISO date(time) string, a date or a datetime (naive is UTC)"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            value = datetime.datetime.fromisoformat(value)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day, tzinfo=datetime.timezone.utc).timestamp()
+    return float(value)
+
+
+class CalibrationHistory(object):
+    """Calibrations of one camera over time, indexed by validity interval.
+    Notes:
+        - Intervals [start, end) in unix seconds are kept sorted by start. Where intervals overlap
+          the one that starts last wins (an earlier interval applies again once a later one ends),
+          and an end of None is open.
+        - The overlapping intervals are resolved once into disjoint segments, each with the
+          interval that applies throughout it, so the calibration of an image is found by one
+          bisection in O(log n). The segments are rebuilt (O(n log n)) on the first lookup after add.
+        - Each interval resolves to one shared calibration from the registry, kept per interval,
+          so lookup tables and other cached geometry are keyed by interval and reprocessing old
+          imagery reuses them.
+        - History YAML is a list of intervals with valid_from, valid_to (optional), extrinsics and
+          optionally intrinsics (defaults to the camera's current intrinsics).
+    Args:
+        metadata (dict) - camera metadata
+        local_origin (dict) - local origin of the station
+    Attributes:
+        starts (list): sorted interval start times
+        intervals (list): (start, end, intrinsics, extrinsics) of each interval, in the order of starts
+    """
+    def __init__(self, metadata, local_origin):
+        self.metadata = metadata
+        self.local_origin = local_origin
+        self.starts = []
+        self.intervals = []
+        # disjoint segments: start times and the index of the interval valid in each (None in gaps)
+        self._segment_starts = None
+        self._segment_intervals = None
+        self._calibrations = {}
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def add(self, start, end, intrinsics, extrinsics):
+        """Add a calibration valid from start up to (not including) end, times as in to_unix_time"""
+        start = to_unix_time(start)
+        end = to_unix_time(end)
+        # beta is built from the extrinsics in x, y, z, a, t, r order, whatever order they were read in
+        extrinsics = {k: extrinsics[k] for k in ('x', 'y', 'z', 'a', 't', 'r')}
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.intervals.insert(i, (start, end, intrinsics, extrinsics))
+        self._segment_starts = None
+        self._segment_intervals = None
+        self._calibrations = {}
+
+    def _build_segments(self):
+        """Resolve the intervals into disjoint segments by a sweep over their starts and ends"""
+        times = sorted(set(self.starts) | {end for _, end, _, _ in self.intervals if end is not None})
+        self._segment_starts = []
+        self._segment_intervals = []
+        # active intervals as a max-heap of index (the latest start wins); ended ones are dropped lazily
+        active = []
+        j = 0
+        for t in times:
+            while j < len(self.starts) and self.starts[j] <= t:
+                heapq.heappush(active, -j)
+                j += 1
+            while active and self.intervals[-active[0]][1] is not None and self.intervals[-active[0]][1] <= t:
+                heapq.heappop(active)
+            i = -active[0] if active else None
+            if not self._segment_intervals or self._segment_intervals[-1] != i:
+                self._segment_starts.append(t)
+                self._segment_intervals.append(i)
+
+    def interval(self, unix_time):
+        """Returns the index of the interval valid at unix_time, or None"""
+        if self._segment_starts is None:
+            self._build_segments()
+        k = bisect.bisect_right(self._segment_starts, float(unix_time)) - 1
+        return self._segment_intervals[k] if k >= 0 else None
+
+    def lookup(self, unix_time):
+        """Returns (intrinsics, extrinsics) valid at unix_time, or None"""
+        i = self.interval(unix_time)
+        if i is None:
+            return None
+        return self.intervals[i][2], self.intervals[i][3]
+
+    def calibration(self, unix_time):
+        """Returns the shared CameraCalibration valid at unix_time, or None"""
+        i = self.interval(unix_time)
+        if i is None:
+            return None
+        if i not in self._calibrations:
+            _, _, intrinsics, extrinsics = self.intervals[i]
+            self._calibrations[i] = get_calibration(self.metadata, intrinsics, extrinsics, self.local_origin)
+        return self._calibrations[i]
+
+    @classmethod
+    def from_yaml(cls, yamlfile, metadata, local_origin, intrinsics=None):
+        """Read a calibration history YAML file
+        Args:
+            yamlfile (str): history file
+            metadata, local_origin (dict): camera metadata and station local origin
+            intrinsics (dict): intrinsics of intervals that do not give their own
+        """
+        with open(yamlfile, 'r') as infile:
+            entries = yaml.safe_load(infile) or []
+        history = cls(metadata, local_origin)
+        for entry in entries:
+            history.add(entry['valid_from'], entry.get('valid_to'),
+                        entry.get('intrinsics', intrinsics), entry['extrinsics'])
+        return history
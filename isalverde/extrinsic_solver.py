@@ -0,0 +1,217 @@
+"""
+Extrinsic (pose) solver from ground control points: finds camera x, y, z, azimuth, tilt and roll that
+minimise the reprojection error of surveyed GCPs through the lcp distortion model, with residuals and
+an analytic Jacobian vectorized over points. Any number of solves (e.g. a pose per frame or per day)
+run together as one batched Levenberg-Marquardt problem.
+
+Solve from a GCP file (columns x, y, z, U, V in local coordinates and distorted pixels) and write the
+updated extrinsics:
+    python extrinsic_solver.py <intr.yaml> <extr.yaml> <gcps.csv> <new extr.yaml> [--fix-position]
+For a station calibrated in Geographical coordinates (coordinate_system 'geo'), pass its local origin;
+the extrinsics and GCPs are then read and written in Geographical coordinates and solved in local:
+    python extrinsic_solver.py <intr.yaml> <extr.yaml> <gcps.csv> <new extr.yaml> --local-origin <localOrigin.yaml>
+"""
+import argparse
+
+import numpy as np
+import yaml
+
+from coastcam_funcs import LocalTransform, angle2R_batch, lcp_distort, local_transform_extrinsics, yaml2dict
+
+# order of the pose parameters in beta, which is also the order CameraCalibration expects in extrinsics
+BETA_KEYS = ('x', 'y', 'z', 'a', 't', 'r')
+
+
+def _rotation_derivatives(angles):
+    """Return (m, 3, 3, 3) derivatives of angle2R with respect to azimuth, tilt and roll"""
+    a, t, s = angles[:, 0], angles[:, 1], angles[:, 2]
+    ca, sa = np.cos(a), np.sin(a)
+    ct, st = np.cos(t), np.sin(t)
+    cs, ss = np.cos(s), np.sin(s)
+    zero = np.zeros_like(a)
+    dR_da = np.stack([
+        np.stack([-sa*cs + ca*ct*ss, -cs*ca - ss*ct*sa, zero], -1),
+        np.stack([ss*sa + cs*ct*ca, ss*ca - cs*ct*sa, zero], -1),
+        np.stack([st*ca, -st*sa, zero], -1)], -2)
+    dR_dt = np.stack([
+        np.stack([-sa*st*ss, -ss*st*ca, ss*ct], -1),
+        np.stack([-cs*st*sa, -cs*st*ca, cs*ct], -1),
+        np.stack([ct*sa, ct*ca, st], -1)], -2)
+    dR_ds = np.stack([
+        np.stack([-ca*ss + sa*ct*cs, ss*sa + cs*ct*ca, cs*st], -1),
+        np.stack([-cs*ca - ss*ct*sa, cs*sa - ss*ct*ca, -ss*st], -1),
+        np.stack([zero, zero, zero], -1)], -2)
+    return np.stack([dR_da, dR_dt, dR_ds], 1)
+
+
+def project_points(beta, lcp, xyz, jacobian=False):
+    """Project world points through the pose beta and the lcp distortion model
+    Notes:
+        - Same projection as distort_UV (P = K R [I | -C], then lcp_distort), for m poses at once
+    Arguments:
+        beta (np.ndarray): (m, 6) or (6,) poses x, y, z, azimuth, tilt, roll
+        lcp (dict): Lens Calibration Profile (intrinsics)
+        xyz (np.ndarray): (n, 3) points shared by every pose, or (m, n, 3)
+        jacobian (bool): also return d(Ud, Vd)/d(beta)
+    Returns:
+        Ud, Vd (np.ndarray): (m, n) distorted pixel coordinates
+        front (np.ndarray): (m, n) points in front of the camera
+        J (np.ndarray): (m, n, 2, 6) if jacobian
+    """
+    beta = np.atleast_2d(np.asarray(beta, dtype=np.float64))
+    R = angle2R_batch(beta[:, 3], beta[:, 4], beta[:, 5])
+    d = np.asarray(xyz, dtype=np.float64) - beta[:, np.newaxis, :3]
+    # camera coordinates
+    p = np.einsum('mij,mnj->mni', R, d)
+    p0, p1, p2 = p[..., 0], p[..., 1], p[..., 2]
+    # normalized coordinates (K has -fy, so y is -p1/p2)
+    x = p0/p2
+    y = -p1/p2
+    if not jacobian:
+        xd, yd = lcp_distort(lcp, x, y)
+        return xd*lcp['fx'] + lcp['c0U'], yd*lcp['fy'] + lcp['c0V'], p2 > 0
+
+    xd, yd, (dxd_dx, dxd_dy, dyd_dx, dyd_dy) = lcp_distort(lcp, x, y, jacobian=True)
+    # dp/dbeta: -R for the position, dR/dangle (X - C) for the angles
+    dp = np.empty(p.shape + (6,))
+    dp[..., :3] = -R[:, np.newaxis]
+    dp[..., 3:] = np.einsum('mkij,mnj->mnik', _rotation_derivatives(beta[:, 3:]), d)
+    dx = (dp[..., 0, :] - x[..., np.newaxis]*dp[..., 2, :])/p2[..., np.newaxis]
+    dy = (-dp[..., 1, :] - y[..., np.newaxis]*dp[..., 2, :])/p2[..., np.newaxis]
+    J = np.stack((lcp['fx']*(dxd_dx[..., np.newaxis]*dx + dxd_dy[..., np.newaxis]*dy),
+                  lcp['fy']*(dyd_dx[..., np.newaxis]*dx + dyd_dy[..., np.newaxis]*dy)), axis=-2)
+    return xd*lcp['fx'] + lcp['c0U'], yd*lcp['fy'] + lcp['c0V'], p2 > 0, J
+
+
+def solve_extrinsics(beta0, lcp, xyz, UV, weights=None, free=None, max_iter=100, tol=1e-10):
+    """Solve for camera poses that minimise GCP reprojection error
+    Notes:
+        - Levenberg-Marquardt with the analytic Jacobian of project_points. Every pose is
+          solved at the same time with its own damping, so a series of thousands of poses
+          is a few batched 6x6 solves per iteration. Poses stop updating once converged.
+        - GCPs behind the camera are given zero weight. Picks should be inside the image: the
+          lcp polynomial is not valid far outside the calibrated field.
+    Arguments:
+        beta0 (np.ndarray): (m, 6) or (6,) starting poses x, y, z, azimuth, tilt, roll
+        lcp (dict): Lens Calibration Profile (intrinsics)
+        xyz (np.ndarray): (n, 3) GCP local coordinates, or (m, n, 3)
+        UV (np.ndarray): (m, n, 2) or (n, 2) distorted pixel picks of the GCPs
+        weights (np.ndarray): (m, n) or (n,) pick weights, 0 for GCPs not picked in a frame
+        free (sequence): 6 booleans, False for parameters kept at their starting value
+        max_iter (int): maximum iterations
+        tol (float): a pose has converged when the cost decreases by less than tol (relative)
+            or the step is smaller than sqrt(tol)
+    Returns:
+        beta (np.ndarray): (m, 6) solved poses
+        rms (np.ndarray): (m,) weighted rms reprojection error in pixels
+        niter (np.ndarray): (m,) iterations used
+    """
+    beta = np.atleast_2d(np.array(beta0, dtype=np.float64))
+    m = len(beta)
+    UV = np.broadcast_to(np.asarray(UV, dtype=np.float64), (m,) + np.shape(UV)[-2:])
+    n = UV.shape[1]
+    if weights is None:
+        weights = np.ones(n)
+    sw = np.sqrt(np.broadcast_to(np.asarray(weights, dtype=np.float64), (m, n)))
+    free = np.ones(6, dtype=bool) if free is None else np.asarray(free, dtype=bool)
+    xyz = np.asarray(xyz, dtype=np.float64)
+
+    def residuals(beta, index):
+        out = project_points(beta, lcp, xyz if xyz.ndim == 2 else xyz[index], jacobian=True)
+        w = sw[index]*out[2]
+        r = (np.stack(out[:2], axis=-1) - UV[index])*w[..., np.newaxis]
+        r = np.where(np.isfinite(r), r, 0.).reshape(len(beta), -1)
+        J = (out[3]*w[..., np.newaxis, np.newaxis]).reshape(len(beta), -1, 6)
+        return r, np.where(np.isfinite(J), J, 0.)*free
+
+    active = np.arange(m)
+    r, J = residuals(beta, active)
+    cost = np.sum(r*r, axis=1)
+    lam = np.full(m, 1e-3)
+    niter = np.zeros(m, dtype=int)
+    eye = np.eye(6)
+    for _ in range(max_iter):
+        if len(active) == 0:
+            break
+        Ja = J[active]
+        A = np.matmul(Ja.transpose(0, 2, 1), Ja)
+        g = np.matmul(Ja.transpose(0, 2, 1), r[active][..., np.newaxis])[..., 0]
+        D = np.where(free, np.diagonal(A, axis1=1, axis2=2), 1.)
+        D = np.maximum(D, 1e-12)
+        # fixed parameters get an identity row and column, so their step is 0
+        A = np.where(free[:, np.newaxis] & free[np.newaxis, :], A, eye)
+        step = -np.linalg.solve(A + lam[active, np.newaxis, np.newaxis]*D[:, np.newaxis, :]*eye, g[..., np.newaxis])[..., 0]
+
+        trial = beta[active] + step
+        r_trial, J_trial = residuals(trial, active)
+        cost_trial = np.sum(r_trial*r_trial, axis=1)
+        better = cost_trial < cost[active]
+        done = better & ((cost[active] - cost_trial <= tol*cost[active]) |
+                         (np.max(np.abs(step), axis=1) <= np.sqrt(tol)))
+
+        accepted = active[better]
+        beta[accepted] = trial[better]
+        r[accepted] = r_trial[better]
+        J[accepted] = J_trial[better]
+        cost[accepted] = cost_trial[better]
+        lam[accepted] /= 10.
+        lam[active[~better]] *= 10.
+        niter[active] += 1
+        # stop poses that converged or cannot improve any more
+        done |= lam[active] > 1e12
+        active = active[~done]
+
+    count = np.maximum(np.sum(sw*sw > 0, axis=1), 1)
+    rms = np.sqrt(cost/count)
+    return beta, rms, niter
+
+
+def read_gcps(gcp_file):
+    """Read a GCP csv file with a header and columns x, y, z, U, V (other columns are ignored)
+    Returns:
+        xyz (np.ndarray): (n, 3) x, y, z in the coordinates of the file
+        UV (np.ndarray): (n, 2) distorted pixel picks
+    """
+    gcps = np.genfromtxt(gcp_file, delimiter=',', names=True)
+    xyz = np.column_stack((gcps['x'], gcps['y'], gcps['z']))
+    UV = np.column_stack((gcps['U'], gcps['V']))
+    return xyz, UV
+
+
+def write_extrinsics_yaml(beta, yamlfile, local_origin=None):
+    """Write a pose to an extrinsics YAML file in x, y, z, a, t, r order
+    Arguments:
+        beta (np.ndarray): (6,) local pose x, y, z, azimuth, tilt, roll
+        yamlfile (str): file to write
+        local_origin (dict): if given, the pose is converted to geographical coordinates first
+    """
+    extrinsics = {k: float(v) for k, v in zip(BETA_KEYS, np.ravel(beta))}
+    if local_origin is not None:
+        extrinsics = local_transform_extrinsics(local_origin['x'], local_origin['y'], local_origin['angd'], 0, extrinsics)
+        extrinsics = {k: float(extrinsics[k]) for k in BETA_KEYS}
+    with open(yamlfile, 'w') as outfile:
+        yaml.safe_dump(extrinsics, outfile, sort_keys=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Solve camera extrinsics from ground control points')
+    parser.add_argument('intrinsics_file')
+    parser.add_argument('extrinsics_file', help='starting extrinsics (local, or Geographical with --local-origin)')
+    parser.add_argument('gcp_file', help='csv with columns x, y, z, U, V')
+    parser.add_argument('output_file')
+    parser.add_argument('--fix-position', action='store_true', help='only solve for azimuth, tilt and roll')
+    parser.add_argument('--local-origin', help='<station>_localOrigin.yaml of a Geographical (geo) calibration')
+    args = parser.parse_args()
+
+    lcp = yaml2dict(args.intrinsics_file)
+    extrinsics = yaml2dict(args.extrinsics_file)
+    xyz, UV = read_gcps(args.gcp_file)
+    local_origin = None
+    if args.local_origin is not None:
+        local_origin = yaml2dict(args.local_origin)
+        extrinsics = local_transform_extrinsics(local_origin['x'], local_origin['y'], local_origin['angd'], 1, extrinsics)
+        LocalTransform.from_local_origin(local_origin).to_local(xyz, out=xyz)
+    free = [not args.fix_position]*3 + [True]*3
+    beta, rms, niter = solve_extrinsics([extrinsics[k] for k in BETA_KEYS], lcp, xyz, UV, free=free)
+    write_extrinsics_yaml(beta[0], args.output_file, local_origin)
+    print(f'{args.output_file}: rms {rms[0]:.2f} pixels from {len(xyz)} GCPs after {niter[0]} iterations')
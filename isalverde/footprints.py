@@ -0,0 +1,257 @@
+"""
+Camera footprints: the ground area each camera sees, as a polygon found by projecting the image border
+onto a horizontal plane, clipped at the horizon (a maximum range) and by the target grid. Footprints
+are computed once per calibration, and a station's footprints are kept in a small CoverageIndex that
+answers which cameras see a point or an area, and the grid extent the cameras actually cover.
+
+Build a station's index from its calibration bundle:
+    python footprints.py build <bundle.json> <footprints.json> [--xlims -10 400 --ylims -400 0] [--z -0.91]
+Which cameras see a point or a region of interest:
+    python footprints.py query <footprints.json> --point x y
+    python footprints.py query <footprints.json> --roi xmin xmax ymin ymax
+"""
+import argparse
+import bisect
+import json
+
+import numpy as np
+
+from calibration_crs import get_calibration
+
+# footprint polygons by calibration and clipping, shared by every user in the process
+FOOTPRINTS = {}
+
+
+def image_border(NU, NV, nedge=64):
+    """Return U, V of pixels around the image border, clockwise from the top left corner"""
+    u = np.linspace(0., NU - 1., nedge + 1)[:-1]
+    v = np.linspace(0., NV - 1., nedge + 1)[:-1]
+    U = np.concatenate((u, np.full(nedge, NU - 1.), u[::-1] + (NU - 1.)/nedge, np.zeros(nedge)))
+    V = np.concatenate((np.zeros(nedge), v, np.full(nedge, NV - 1.), v[::-1] + (NV - 1.)/nedge))
+    return U, V
+
+
+def polygon_area(polygon):
+    """Return the area of a polygon ((n, 2) vertices) by the shoelace formula"""
+    if len(polygon) < 3:
+        return 0.
+    x, y = polygon[:, 0], polygon[:, 1]
+    return 0.5*abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def clip_polygon(polygon, xlims, ylims):
+    """Clip a polygon to a rectangle (Sutherland-Hodgman)
+    Arguments:
+        polygon (np.ndarray): (n, 2) vertices
+        xlims, ylims (sequence): min and max of the rectangle
+    Returns:
+        polygon (np.ndarray): (m, 2) vertices of the clipped polygon, m may be 0
+    """
+    # each edge of the rectangle as (axis, limit, keep the side above the limit)
+    for axis, limit, above in ((0, xlims[0], True), (0, xlims[1], False), (1, ylims[0], True), (1, ylims[1], False)):
+        if len(polygon) == 0:
+            break
+        inside = polygon[:, axis] >= limit if above else polygon[:, axis] <= limit
+        previous = np.roll(polygon, 1, axis=0)
+        previous_inside = np.roll(inside, 1)
+        clipped = []
+        for p, q, p_in, q_in in zip(polygon, previous, inside, previous_inside):
+            if p_in != q_in:
+                # crossing of the edge from q to p
+                t = (limit - q[axis])/(p[axis] - q[axis])
+                clipped.append(q + t*(p - q))
+            if p_in:
+                clipped.append(p)
+        polygon = np.array(clipped).reshape(-1, 2)
+    return polygon
+
+
+def points_in_polygon(polygon, x, y, chunk=1000000):
+    """Return which points are inside a polygon (even-odd rule), for any matching shapes of x, y
+    Notes:
+        - Every edge is tested against a block of points at once, with blocks of about
+          chunk point-edge pairs.
+    """
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    shape = x.shape
+    x = x.ravel()
+    y = y.ravel()
+    inside = np.zeros(x.size, dtype=bool)
+    x0, y0 = polygon[:, 0], polygon[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    edges = y0 != y1
+    x0, y0, x1, y1 = x0[edges], y0[edges], x1[edges], y1[edges]
+    slope = (x1 - x0)/(y1 - y0)
+    step = max(1, chunk//max(len(x0), 1))
+    for start in range(0, x.size, step):
+        xs = x[start:start + step, np.newaxis]
+        ys = y[start:start + step, np.newaxis]
+        crosses = ((y0 > ys) != (y1 > ys)) & (xs < x0 + (ys - y0)*slope)
+        inside[start:start + step] = np.count_nonzero(crosses, axis=1) % 2 == 1
+    return inside.reshape(shape)
+
+
+def camera_footprint(calibration, z=0., xlims=None, ylims=None, max_range=None, nedge=64):
+    """Return the cached ground footprint of a camera
+    Notes:
+        - Border pixels are undistorted and their rays intersected with the plane z. Rays above
+          the horizon, or meeting the plane beyond max_range, are stopped at max_range from
+          the camera in the ray's horizontal direction, which clips the footprint at the horizon.
+        - The polygon is then clipped to xlims, ylims if given.
+    Arguments:
+        calibration (CameraCalibration): camera calibration
+        z (float): elevation of the plane (e.g. the TargetGrid z)
+        xlims, ylims (sequence): grid limits to clip to, or None
+        max_range (float): horizontal range (m) of the horizon. Default: the farthest grid
+            corner, or 2000 m without grid limits.
+        nedge (int): border pixels per side of the image
+    Returns:
+        polygon (np.ndarray): (n, 2) local x, y vertices (read-only), empty if the camera sees none of the grid
+    """
+    clip = xlims is not None and ylims is not None
+    key = (calibration.key, float(z), tuple(xlims) if clip else None, tuple(ylims) if clip else None, max_range, nedge)
+    if key not in FOOTPRINTS:
+        C = calibration.beta[:3]
+        if max_range is None:
+            if clip:
+                corners = np.array([[x, y] for x in xlims for y in ylims], dtype=np.float64)
+                max_range = 1.01*np.max(np.hypot(corners[:, 0] - C[0], corners[:, 1] - C[1]))
+            else:
+                max_range = 2000.
+        U, V = image_border(calibration.lcp['NU'], calibration.lcp['NV'], nedge)
+        rays = calibration.pixel_rays(U, V)
+        keep = np.all(np.isfinite(rays), axis=0)
+        rays = rays[:, keep]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = (z - C[2])/rays[2]
+            horizontal = np.hypot(rays[0], rays[1])
+            hits = (t > 0) & (t*horizontal <= max_range)
+            t = np.where(hits, t, max_range/horizontal)
+        polygon = np.column_stack((C[0] + t*rays[0], C[1] + t*rays[1]))
+        polygon = polygon[np.all(np.isfinite(polygon), axis=1)]
+        if clip:
+            polygon = clip_polygon(polygon, xlims, ylims)
+        polygon.setflags(write=False)
+        FOOTPRINTS[key] = polygon
+    return FOOTPRINTS[key]
+
+
+class CoverageIndex(object):
+    """Spatial index of the footprints of a station's cameras.
+    Notes:
+        - Footprint bounding boxes are kept sorted by their minimum x, so the candidates for a
+          query are found by bisection (O(log n)) before the exact polygon tests.
+        - Saved as JSON ({camera: [[x, y], ...]}) to keep with the station parameters.
+    Args:
+        footprints (dict): {camera: (n, 2) polygon} in local coordinates
+    Attributes:
+        cameras (list): camera names, in the order of the rows returned by coverage
+        footprints (dict): {camera: polygon}
+        bounds (dict): {camera: (xmin, xmax, ymin, ymax)}
+    """
+    def __init__(self, footprints):
+        self.footprints = {camera: np.asarray(polygon, dtype=np.float64).reshape(-1, 2) for camera, polygon in footprints.items()}
+        self.cameras = list(self.footprints)
+        self.bounds = {}
+        for camera, polygon in self.footprints.items():
+            if len(polygon):
+                self.bounds[camera] = (polygon[:, 0].min(), polygon[:, 0].max(), polygon[:, 1].min(), polygon[:, 1].max())
+        self._order = sorted(self.bounds, key=lambda camera: self.bounds[camera][0])
+        self._xmin = [self.bounds[camera][0] for camera in self._order]
+        self._max_width = max([b[1] - b[0] for b in self.bounds.values()], default=0.)
+
+    def __len__(self):
+        return len(self.cameras)
+
+    @classmethod
+    def from_calibrations(cls, cameras, calibrations, **kwargs):
+        """Make the index of a station from each camera's calibration (kwargs go to camera_footprint)"""
+        return cls({camera: camera_footprint(calibration, **kwargs) for camera, calibration in zip(cameras, calibrations)})
+
+    def _candidates(self, xmin, xmax, ymin, ymax):
+        """Return cameras whose bounding box overlaps a box"""
+        start = bisect.bisect_left(self._xmin, xmin - self._max_width)
+        stop = bisect.bisect_right(self._xmin, xmax)
+        candidates = []
+        for camera in self._order[start:stop]:
+            bxmin, bxmax, bymin, bymax = self.bounds[camera]
+            if bxmax >= xmin and bymin <= ymax and bymax >= ymin:
+                candidates.append(camera)
+        return candidates
+
+    def cameras_at(self, x, y):
+        """Return the cameras whose footprint contains the point x, y"""
+        return [camera for camera in self._candidates(x, x, y, y) if points_in_polygon(self.footprints[camera], x, y)[()]]
+
+    def cameras_in(self, xlims, ylims):
+        """Return {camera: area of its footprint inside the region} for cameras that see any of a region"""
+        overlaps = {}
+        for camera in self._candidates(xlims[0], xlims[1], ylims[0], ylims[1]):
+            area = polygon_area(clip_polygon(self.footprints[camera], xlims, ylims))
+            if area > 0:
+                overlaps[camera] = float(area)
+        return overlaps
+
+    def coverage(self, x, y):
+        """Return an (ncameras, ...) boolean array of which cameras see each point (rows in self.cameras order)"""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        covered = np.zeros((len(self.cameras),) + np.broadcast(x, y).shape, dtype=bool)
+        for c, camera in enumerate(self.cameras):
+            if camera in self.bounds:
+                covered[c] = points_in_polygon(self.footprints[camera], x, y)
+        return covered
+
+    def grid_extent(self, cameras=None, dx=1., dy=1.):
+        """Return xlims, ylims enclosing the footprints of cameras (all by default), on multiples of dx, dy"""
+        bounds = np.array([self.bounds[camera] for camera in (cameras or self.cameras) if camera in self.bounds])
+        if len(bounds) == 0:
+            return None, None
+        xlims = [float(np.floor(bounds[:, 0].min()/dx)*dx), float(np.ceil(bounds[:, 1].max()/dx)*dx)]
+        ylims = [float(np.floor(bounds[:, 2].min()/dy)*dy), float(np.ceil(bounds[:, 3].max()/dy)*dy)]
+        return xlims, ylims
+
+    def save(self, file):
+        """Write the footprints as JSON"""
+        with open(file, 'w') as outfile:
+            json.dump({camera: polygon.tolist() for camera, polygon in self.footprints.items()}, outfile)
+
+    @classmethod
+    def load(cls, file):
+        """Read an index written by save"""
+        with open(file, 'r') as infile:
+            return cls(json.load(infile))
+
+
+if __name__ == '__main__':
+    from station_bundle import bundle_lists, load_bundle
+
+    parser = argparse.ArgumentParser(description='Build or query a station camera coverage index')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='build the index from a station bundle')
+    build.add_argument('bundle_file')
+    build.add_argument('index_file')
+    build.add_argument('--xlims', type=float, nargs=2)
+    build.add_argument('--ylims', type=float, nargs=2)
+    build.add_argument('--z', type=float, default=-0.91)
+    query = commands.add_parser('query', help='cameras that see a point or a region')
+    query.add_argument('index_file')
+    query.add_argument('--point', type=float, nargs=2)
+    query.add_argument('--roi', type=float, nargs=4, metavar=('XMIN', 'XMAX', 'YMIN', 'YMAX'))
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        bundle = load_bundle(args.bundle_file)
+        cameras = sorted(bundle['cameras'])
+        metadata_list, intrinsics_list, extrinsics_list, local_origin = bundle_lists(bundle, cameras)
+        calibrations = [get_calibration(m, i, e, local_origin) for m, i, e in zip(metadata_list, intrinsics_list, extrinsics_list)]
+        index = CoverageIndex.from_calibrations(cameras, calibrations, z=args.z, xlims=args.xlims, ylims=args.ylims)
+        index.save(args.index_file)
+        xlims, ylims = index.grid_extent()
+        print(f'{args.index_file}: {len(index)} cameras, covering x {xlims} y {ylims}')
+    else:
+        index = CoverageIndex.load(args.index_file)
+        if args.point is not None:
+            print(index.cameras_at(*args.point))
+        if args.roi is not None:
+            print(index.cameras_in(args.roi[:2], args.roi[2:]))
@@ -0,0 +1,141 @@
+"""
+Station calibration bundle: every camera's metadata, intrinsics and extrinsics plus the local origin
+of a station in one versioned JSON file, so a Lambda invocation needs one GET and one parse instead of
+3 x ncam + 1 YAML downloads.
+
+Build a bundle from the station YAML files (<station>_<CAM>_extr.yaml, _intr.yaml, _metadata.yaml
+and <station>_localOrigin.yaml) and upload it as cameras/parameters/<station>/<station>_bundle.json:
+    python station_bundle.py build <station> <yaml folder> <bundle file>
+Check a bundle:
+    python station_bundle.py validate <bundle file>
+"""
+import argparse
+import glob
+import json
+import os
+
+from calibration_crs import parse_date
+from coastcam_funcs import yaml2dict
+
+BUNDLE_VERSION = 1
+
+METADATA_KEYS = ('name', 'serial_number', 'camera_number', 'calibration_date', 'coordinate_system')
+INTRINSICS_KEYS = ('NU', 'NV', 'c0U', 'c0V', 'fx', 'fy', 'd1', 'd2', 'd3', 't1', 't2')
+# CameraCalibration builds beta from the extrinsics in this order
+EXTRINSICS_KEYS = ('x', 'y', 'z', 'a', 't', 'r')
+LOCAL_ORIGIN_KEYS = ('x', 'y', 'angd')
+
+
+def build_bundle(station, yaml_folder):
+    """Make a bundle from the YAML files of a station
+    Arguments:
+        station (str): station name used in the YAML file names (e.g. 'madeira_beach')
+        yaml_folder (str): folder with the YAML files
+    Returns:
+        bundle (dict)
+    """
+    local_origin = yaml2dict(os.path.join(yaml_folder, station + '_localOrigin.yaml'))
+    cameras = {}
+    for extr_file in sorted(glob.glob(os.path.join(yaml_folder, station + '_C*_extr.yaml'))):
+        camera = os.path.basename(extr_file)[len(station) + 1:-len('_extr.yaml')]
+        prefix = os.path.join(yaml_folder, station + '_' + camera)
+        extrinsics = yaml2dict(extr_file)
+        cameras[camera] = {
+            'metadata': yaml2dict(prefix + '_metadata.yaml'),
+            'intrinsics': yaml2dict(prefix + '_intr.yaml'),
+            'extrinsics': {k: extrinsics[k] for k in EXTRINSICS_KEYS},
+        }
+    bundle = {'version': BUNDLE_VERSION, 'station': station, 'local_origin': local_origin, 'cameras': cameras}
+    validate_bundle(bundle)
+    return bundle
+
+
+def validate_bundle(bundle):
+    """Raise ValueError listing everything wrong with a bundle"""
+    errors = []
+    if bundle.get('version') != BUNDLE_VERSION:
+        errors.append(f"version {bundle.get('version')} is not {BUNDLE_VERSION}")
+    local_origin = bundle.get('local_origin') or {}
+    errors += [f'local_origin: missing {k}' for k in LOCAL_ORIGIN_KEYS if k not in local_origin]
+    cameras = bundle.get('cameras')
+    if not cameras:
+        errors.append('no cameras')
+    for camera, parameters in (cameras or {}).items():
+        for part, keys in (('metadata', METADATA_KEYS), ('intrinsics', INTRINSICS_KEYS), ('extrinsics', EXTRINSICS_KEYS)):
+            values = parameters.get(part)
+            if not isinstance(values, dict):
+                errors.append(f'{camera}: missing {part}')
+                continue
+            for k in keys:
+                if k not in values:
+                    errors.append(f'{camera}: {part} missing {k}')
+                elif part != 'metadata' and not isinstance(values[k], (int, float)):
+                    errors.append(f'{camera}: {part} {k} is not a number')
+        extrinsics = parameters.get('extrinsics')
+        if isinstance(extrinsics, dict) and tuple(extrinsics)[:len(EXTRINSICS_KEYS)] != EXTRINSICS_KEYS:
+            errors.append(f'{camera}: extrinsics are not in {EXTRINSICS_KEYS} order')
+    if errors:
+        raise ValueError('invalid station bundle: ' + '; '.join(errors))
+
+
+def save_bundle(bundle, file):
+    """Write a bundle as JSON (dates are written as strings, and parsed back by parse_bundle)"""
+    with open(file, 'w') as outfile:
+        json.dump(bundle, outfile, indent=1, default=str)
+
+
+def parse_bundle(text):
+    """Parse and validate a bundle from JSON text or bytes
+    Notes:
+        - calibration_date strings are parsed back to the date or datetime the YAML files give,
+          so calibrations from a bundle and from the YAML files are the same (and share caches)
+    """
+    bundle = json.loads(text)
+    validate_bundle(bundle)
+    for parameters in bundle['cameras'].values():
+        metadata = parameters['metadata']
+        metadata['calibration_date'] = parse_date(metadata['calibration_date'])
+    return bundle
+
+
+def load_bundle(file):
+    """Read and validate a bundle file"""
+    with open(file, 'r') as infile:
+        return parse_bundle(infile.read())
+
+
+def bundle_lists(bundle, cameras):
+    """Return metadata, intrinsics and extrinsics lists in the order of cameras, and the local origin
+    Arguments:
+        bundle (dict): station bundle
+        cameras (list): camera names (e.g. ['C1', 'C2'])
+    Returns:
+        metadata_list, intrinsics_list, extrinsics_list (list), local_origin (dict)
+    """
+    missing = [camera for camera in cameras if camera not in bundle['cameras']]
+    if missing:
+        raise ValueError(f'station bundle has no parameters for {missing}')
+    metadata_list = [bundle['cameras'][camera]['metadata'] for camera in cameras]
+    intrinsics_list = [bundle['cameras'][camera]['intrinsics'] for camera in cameras]
+    extrinsics_list = [bundle['cameras'][camera]['extrinsics'] for camera in cameras]
+    return metadata_list, intrinsics_list, extrinsics_list, bundle['local_origin']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or check a station calibration bundle')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='build a bundle from the station YAML files')
+    build.add_argument('station')
+    build.add_argument('yaml_folder')
+    build.add_argument('bundle_file')
+    validate = commands.add_parser('validate', help='check a bundle file')
+    validate.add_argument('bundle_file')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        bundle = build_bundle(args.station, args.yaml_folder)
+        save_bundle(bundle, args.bundle_file)
+        print(f"{args.bundle_file}: {len(bundle['cameras'])} cameras")
+    else:
+        bundle = load_bundle(args.bundle_file)
+        print(f"{args.bundle_file} is valid: {sorted(bundle['cameras'])}")